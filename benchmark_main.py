@@ -0,0 +1,4 @@
+from kp.regression.benchmark import main_benchmark
+import sys
+
+sys.exit(main_benchmark())
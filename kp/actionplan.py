@@ -0,0 +1,58 @@
+from concurrent import futures
+from kp.confbase import KPConfBase
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+LOGGER = logging.getLogger('kodiproxy')
+
+OK = 'ok'
+TIMEOUT = 'timeout'
+
+
+class ActionPlan:
+    """Runs actions on the devices (receiver, projector...) in parallel.
+
+    The result of each action is logged. Unless background is set, run waits for them until the
+    deadline and returns their results"""
+
+    _DEFAULT_CONFIGURATION = {
+        'background': False,
+        'deadline': 5,
+        'workers': 4
+    }
+
+    def __init__(self, conf=None):
+        conf = KPConfBase(ActionPlan, conf)
+        self.background = conf.background
+        self.deadline = conf.deadline
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=conf.workers, thread_name_prefix='kodiproxy-actions')
+
+    def run(self, actions: Dict[str, Callable[[], Any]]) -> Optional[Dict[str, str]]:
+        """Starts the actions, given by name. Returns their results by name: ok, timeout or the
+        error that happened, or None if they are run in the background"""
+        start = time.monotonic()
+        running = {name: self.executor.submit(ActionPlan._run_action, name, action, start)
+                   for name, action in actions.items()}
+        if self.background:
+            return None
+        done, _ = futures.wait(running.values(), timeout=self.deadline)
+        results = dict()
+        for name, future in running.items():
+            if future in done:
+                results[name] = future.result()
+            else:
+                LOGGER.warning('Action %s did not finish within %ss', name, self.deadline)
+                results[name] = TIMEOUT
+        return results
+
+    @staticmethod
+    def _run_action(name: str, action: Callable[[], Any], start: float) -> str:
+        try:
+            action()
+            result = OK
+        except Exception as e:
+            result = 'failed: {}'.format(e)
+        LOGGER.info('Action %s: %s after %.3fs', name, result, time.monotonic() - start)
+        return result
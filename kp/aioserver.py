@@ -0,0 +1,248 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from kp import asynchttp, capture, httputils, metrics, tracing
+from kp.confbase import KPConfBase
+from kp.jrpc.jrpcserver import JRPCServer
+from kp.types import Headers
+import logging
+import socket
+import time
+import traceback
+from typing import Dict
+from urllib import parse
+
+LOGGER = logging.getLogger('kodiproxy')
+
+
+class _Connection:
+    """State of a client connection, which may carry several requests"""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.keep_alive = False
+        self.requests = 0
+        self.version = 'HTTP/1.1'
+        peer = writer.get_extra_info('peername')
+        self.client = peer[0] if peer else ''
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # asyncio only disables Nagle's algorithm on sockets created with IPPROTO_TCP, which
+            # socket.create_server does not give. Without it, the body of a streamed response waits
+            # for the client to acknowledge the headers (up to 40ms with delayed acks)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    async def send(self, code: int, payload, headers: Headers) -> int:
+        """Sends a response, returns the number of bytes of its body. The payload is either bytes or
+        an AsyncStreamedBody"""
+        headers = httputils.relayable_headers(headers or {})
+        chunked = False
+        if isinstance(payload, bytes):
+            headers['content-length'] = str(len(payload))
+        elif payload.length is not None:
+            headers['content-length'] = str(payload.length)
+        elif self.version == 'HTTP/1.1':
+            headers['transfer-encoding'] = 'chunked'
+            chunked = True
+        else:
+            # the end of the body is given by closing the connection
+            self.keep_alive = False
+        headers['connection'] = 'keep-alive' if self.keep_alive else 'close'
+        if isinstance(payload, bytes):
+            self.writer.write(asynchttp.serialize_message(
+                asynchttp.status_line(code), headers, payload))
+            await self.writer.drain()
+            return len(payload)
+        self.writer.write(asynchttp.serialize_message(
+            asynchttp.status_line(code), headers, b''))
+        size = 0
+        try:
+            async for chunk in payload.chunks():
+                self.writer.write(httputils.chunk(chunk) if chunked else chunk)
+                size += len(chunk)
+                # only one chunk is buffered at a time
+                await self.writer.drain()
+            if chunked:
+                self.writer.write(httputils.chunk(b''))
+            await self.writer.drain()
+            return size
+        except BaseException:
+            # the headers are sent, the client can only know something is wrong if we close
+            self.keep_alive = False
+            raise
+        finally:
+            payload.close()
+
+    async def send_error(self, code: int) -> None:
+        payload = bytes(asynchttp.status_line(code, ''), 'latin-1').strip()
+        await self.send(code, payload, {'content-type': 'text/plain'})
+
+
+class AsyncKodiProxyServer:
+    """Kodi proxy served from a single asyncio event loop instead of a thread per connection"""
+
+    _DEFAULT_CONFIGURATION = {
+        'engine': 'asyncio',
+        'host': '',
+        'keepAliveTimeout': 15,
+        'maxKeepAliveRequests': 100,
+        'port': 8080,
+        'requestTimeout': 60,
+        'workers': 4
+    }
+
+    def __init__(self, conf, jrpc_server: JRPCServer):
+        conf = KPConfBase(AsyncKodiProxyServer, conf)
+        LOGGER.info('Creating asyncio server %s:%d', conf.host, conf.port)
+        LOGGER.info('Server configuration:\n%s', conf)
+        self.port = conf.port
+        self.keep_alive_timeout = conf.keepAliveTimeout
+        self.request_timeout = conf.requestTimeout
+        self.max_keep_alive_requests = conf.maxKeepAliveRequests
+        self.jrpc_path = '/jsonrpc'
+        self.jrpc_server = jrpc_server
+        # overloaders are blocking, they run on this executor
+        self.executor = ThreadPoolExecutor(
+            max_workers=conf.workers, thread_name_prefix='kodiproxy')
+        # bound right away, like the threading server, so clients can connect before serve is called
+        self.socket = socket.create_server((conf.host, conf.port))
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        # writer of each connection, with the task handling it
+        self._connections: Dict[asyncio.StreamWriter, asyncio.Task] = dict()
+        self._stop = None
+        self._stop_requested = False
+
+    async def _dispatch_jrpc(self, conn: _Connection, request: bytes, headers: Headers) -> None:
+        start = time.perf_counter()
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        trace = tracing.TRACER.start()
+        handler = self.jrpc_server.get_handler(request, headers)
+        code = 500
+        size = 0
+        try:
+            with tracing.stage('dispatch'):
+                code, payload, headers = await handler.dispatch_async()
+            try:
+                with tracing.stage('write'):
+                    size = await conn.send(code, payload, headers)
+                LOGGER.debug('Reponse payload successfully sent: %s', payload)
+            except Exception as e:
+                LOGGER.error('Failed to send response with error: %s', e)
+                LOGGER.info('Trace: %s', traceback.format_exc())
+        finally:
+            duration = time.perf_counter() - start
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            metrics.observe_request(handler.method, handler.route, code, duration)
+            capture.CAPTURE.record(request, conn.client, duration, code, size)
+            tracing.TRACER.finish(trace, handler.method, handler.route, code)
+
+    async def _handle_request(self, conn: _Connection, req: asynchttp.HTTPRequest) -> None:
+        (_, _, path, _, query, _) = parse.urlparse(req.target)
+        LOGGER.info('Received %s %s', req.method, path)
+        if req.method == 'GET':
+            if path == '/quit':
+                conn.keep_alive = False
+                await conn.send(204, b'', {})
+                self._request_stop()
+            elif path == '/metrics':
+                await conn.send(200, metrics.REGISTRY.expose(), {'content-type': metrics.CONTENT_TYPE})
+            elif path != self.jrpc_path:
+                await conn.send_error(404)
+            else:
+                params = parse.parse_qs(query)
+                if ('request' not in params) or (len(params) != 1) or (len(params['request']) != 1):
+                    await conn.send_error(400)
+                else:
+                    await self._dispatch_jrpc(
+                        conn, bytes(params['request'][0], 'utf-8'), req.headers)
+        elif req.method == 'POST':
+            LOGGER.debug('%s', req.headers)
+            if path != self.jrpc_path:
+                await conn.send_error(404)
+            else:
+                await self._dispatch_jrpc(conn, req.body, req.headers)
+        else:
+            LOGGER.warning('Unsupported method %s', req.method)
+            await conn.send_error(501)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = _Connection(writer)
+        self._connections[writer] = asyncio.current_task()
+        metrics.CONNECTIONS.inc()
+        try:
+            while True:
+                try:
+                    # the first request gets the same delay as the following ones. Once started, a
+                    # large request may take longer to upload
+                    req = await asynchttp.read_request(
+                        reader, self.keep_alive_timeout, self.request_timeout)
+                except asyncio.TimeoutError:
+                    LOGGER.debug('Closing idle connection')
+                    break
+                if not req:
+                    break
+                conn.requests += 1
+                conn.version = req.version
+                conn.keep_alive = httputils.wants_keep_alive(req.version, req.headers) \
+                    and conn.requests < self.max_keep_alive_requests \
+                    and not self._stop_requested
+                await self._handle_request(conn, req)
+                if not conn.keep_alive:
+                    break
+        except asynchttp.HTTPParseError as e:
+            LOGGER.warning('Invalid request received: %s', e)
+            # we cannot know where the next request would start
+            conn.keep_alive = False
+            await conn.send_error(e.code)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            LOGGER.warning('Connection lost: %s', e)
+        except Exception as e:
+            LOGGER.error('Failed to handle request with error: %s', e)
+            LOGGER.info('Trace: %s', traceback.format_exc())
+        finally:
+            self._connections.pop(writer, None)
+            metrics.CONNECTIONS.dec()
+            writer.close()
+
+    def _request_stop(self) -> None:
+        self._stop_requested = True
+        if self._stop and not self._stop.done():
+            self._stop.set_result(None)
+
+    async def _serve(self) -> None:
+        self._stop = self.loop.create_future()
+        if self._stop_requested:
+            return
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket)
+        async with server:
+            await self._stop
+            # idle keep-alive connections would otherwise hold the shutdown
+            for writer in list(self._connections):
+                writer.close()
+
+    async def _close_connections(self) -> None:
+        """Cancels the connections still being handled and waits for them"""
+        tasks = [task for task in self._connections.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def serve(self) -> None:
+        """Starts the server"""
+        LOGGER.info('Starting asyncio server...')
+        try:
+            self.loop.run_until_complete(self._serve())
+        except KeyboardInterrupt:
+            LOGGER.info('Stopped by user')
+        LOGGER.info('Stopping server')
+        self.loop.run_until_complete(self._close_connections())
+        # the running overloaders finish before the loop they answer to is closed
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+        self.socket.close()
+
+    def shutdown(self) -> None:
+        """Stops the server. Can be called from any thread"""
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._request_stop)
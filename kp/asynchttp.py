@@ -0,0 +1,211 @@
+import asyncio
+from http import HTTPStatus
+from kp.types import Headers
+from typing import Optional, Tuple
+
+_MAX_LINE = 65536
+_MAX_HEADERS = 100
+
+
+class HTTPParseError(Exception):
+    """Raised when the peer sends something that is not valid HTTP"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class HTTPRequest:
+    """Minimal representation of an incoming HTTP request"""
+
+    def __init__(self, method: str, target: str, version: str, headers: Headers, body: bytes):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+
+async def _read_line(reader: asyncio.StreamReader) -> bytes:
+    try:
+        line = await reader.readuntil(b'\n')
+    except asyncio.LimitOverrunError:
+        raise HTTPParseError(431, 'Line too long')
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise HTTPParseError(400, 'Connection closed in the middle of a line')
+        raise
+    if len(line) > _MAX_LINE:
+        raise HTTPParseError(431, 'Line too long')
+    return line
+
+
+async def read_headers(reader: asyncio.StreamReader) -> Headers:
+    """Reads header lines until the empty line. Header names are lower cased"""
+    headers = dict()
+    while True:
+        line = await _read_line(reader)
+        if line in (b'\r\n', b'\n'):
+            return headers
+        if len(headers) >= _MAX_HEADERS:
+            raise HTTPParseError(431, 'Too many headers')
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            raise HTTPParseError(400, 'Invalid header line')
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _read_chunk_size(reader: asyncio.StreamReader) -> int:
+    line = await _read_line(reader)
+    try:
+        return int(line.split(b';', 1)[0].strip(), 16)
+    except ValueError:
+        raise HTTPParseError(400, 'Invalid chunk size')
+
+
+async def read_chunked(reader: asyncio.StreamReader) -> bytes:
+    """Reads a body sent with chunked transfer encoding"""
+    chunks = []
+    while True:
+        size = await _read_chunk_size(reader)
+        if size == 0:
+            # trailers are read and discarded
+            await read_headers(reader)
+            return b''.join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+async def iter_body(reader: asyncio.StreamReader, headers: Headers, chunk_size: int):
+    """Yields a message body in pieces of at most chunk_size bytes, as it is received.
+    Like read_response, a body without framing header runs until the end of the connection"""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size = await _read_chunk_size(reader)
+            if size == 0:
+                await read_headers(reader)
+                return
+            while size > 0:
+                piece = await reader.readexactly(min(size, chunk_size))
+                size -= len(piece)
+                yield piece
+            await reader.readexactly(2)
+    length = headers.get('content-length')
+    if length is not None:
+        remaining = int(length)
+        while remaining > 0:
+            piece = await reader.read(min(remaining, chunk_size))
+            if not piece:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(piece)
+            yield piece
+        return
+    while True:
+        piece = await reader.read(chunk_size)
+        if not piece:
+            return
+        yield piece
+
+
+async def read_body(reader: asyncio.StreamReader, headers: Headers, until_eof: bool) -> bytes:
+    """Reads a message body according to its framing headers"""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return await read_chunked(reader)
+    length = headers.get('content-length')
+    if length is not None:
+        try:
+            length = int(length)
+        except ValueError:
+            raise HTTPParseError(400, 'Invalid content-length')
+        return await reader.readexactly(length)
+    return await reader.read() if until_eof else b''
+
+
+async def _read_request_line(reader: asyncio.StreamReader) -> Optional[bytes]:
+    try:
+        line = await _read_line(reader)
+        # some clients send stray empty lines between requests
+        while line in (b'\r\n', b'\n'):
+            line = await _read_line(reader)
+    except asyncio.IncompleteReadError:
+        return None
+    return line
+
+
+async def _read_request_rest(reader: asyncio.StreamReader, line: bytes) -> HTTPRequest:
+    words = line.decode('latin-1').split()
+    if len(words) != 3 or not words[2].startswith('HTTP/'):
+        raise HTTPParseError(400, 'Invalid request line')
+    method, target, version = words
+    headers = await read_headers(reader)
+    framed = 'content-length' in headers or 'chunked' in headers.get(
+        'transfer-encoding', '').lower()
+    until_eof = False
+    if method == 'POST' and not framed:
+        if version != 'HTTP/1.0':
+            # the body would run until the end of the connection, which defeats keep-alive
+            raise HTTPParseError(411, 'Length required')
+        until_eof = True
+    # without any framing header, a request has no body
+    body = await read_body(reader, headers, until_eof)
+    return HTTPRequest(method, target, version, headers, body)
+
+
+async def read_request(reader: asyncio.StreamReader, idle_timeout: Optional[float] = None,
+                       timeout: Optional[float] = None) -> Optional[HTTPRequest]:
+    """Reads a full request from the stream. Returns None if the peer closed the connection.
+
+    Raises asyncio.TimeoutError if the request does not start within idle_timeout seconds, and a 408
+    HTTPParseError if the rest of it, headers and body, takes more than timeout seconds"""
+    line = await asyncio.wait_for(_read_request_line(reader), idle_timeout)
+    if line is None:
+        return None
+    try:
+        return await asyncio.wait_for(_read_request_rest(reader, line), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPParseError(408, 'Request timeout')
+
+
+def has_body(code: int) -> bool:
+    """Returns whether a response with the given code carries a body"""
+    return code >= 200 and code not in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED)
+
+
+async def read_response_head(reader: asyncio.StreamReader) -> Tuple[int, Headers]:
+    """Reads the status line and headers of a response"""
+    line = await _read_line(reader)
+    words = line.decode('latin-1').split(None, 2)
+    if len(words) < 2 or not words[0].startswith('HTTP/'):
+        raise HTTPParseError(502, 'Invalid status line')
+    try:
+        code = int(words[1])
+    except ValueError:
+        raise HTTPParseError(502, 'Invalid status code')
+    return code, await read_headers(reader)
+
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bytes, Headers]:
+    """Reads a full response from the stream"""
+    code, headers = await read_response_head(reader)
+    if not has_body(code):
+        return code, b'', headers
+    # without framing header, the body of a response ends with the connection
+    return code, await read_body(reader, headers, until_eof=True), headers
+
+
+def serialize_message(start_line: str, headers: Headers, body: bytes) -> bytes:
+    """Serializes a start line, headers and body into an HTTP message"""
+    lines = [start_line]
+    for k, v in headers.items():
+        lines.append('{}: {}'.format(k, v))
+    lines.append('\r\n')
+    return bytes('\r\n'.join(lines), 'latin-1') + body
+
+
+def status_line(code: int, version: str = 'HTTP/1.1') -> str:
+    """Returns the status line for a response code"""
+    try:
+        reason = HTTPStatus(code).phrase
+    except ValueError:
+        reason = ''
+    return '{} {} {}'.format(version, code, reason)
@@ -1,77 +1,506 @@
+from abc import abstractmethod, ABCMeta
+from concurrent import futures
+import contextvars
+from kp import metrics, tracing
+from kp.breaker import BackendGuard
 from kp.confbase import KPConfBase
+from kp.receiverio import CommandQueue, ReceiverConnection, TelnetSession
+import functools
+import http.client
 import logging
+import re
+import threading
 import time
-from typing import Optional, Tuple
-from urllib import request
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+from urllib import error
 import xml.etree.ElementTree as ET
 
 LOGGER = logging.getLogger('kodiproxy')
 
 
+# the value of a field of the status, right after its start tag: <Power><value>ON</value>
+_VALUE = re.compile(rb'\s*<value>([^<&]*)</value>')
+
+
+@functools.lru_cache(maxsize=16)
+def _start_tags(tags: Tuple[str, ...]) -> re.Pattern:
+    return re.compile(rb'<(' + b'|'.join(re.escape(bytes(tag, 'utf-8')) for tag in tags) + rb')[\s/>]')
+
+
+def scan_values(response: bytes, tags: Tuple[str, ...]) -> Optional[Dict[str, Optional[str]]]:
+    """Returns the text of the value of the last element of each tag, like parse_values, without
+    parsing the response.
+
+    Returns None when the response cannot be scanned safely (attributes, entities, CDATA, none of
+    the tags), in which case it has to be parsed"""
+    values = dict()
+    for match in _start_tags(tags).finditer(response):
+        tag = match.group(1).decode('utf-8')
+        value = _VALUE.match(response, match.end()) if response[match.end() - 1] == ord('>') else None
+        if value is None:
+            return None
+        try:
+            values[tag] = value.group(1).decode('utf-8') or None
+        except UnicodeDecodeError:
+            return None
+    # when nothing is found, the parser tells whether the response is even XML
+    return values or None
+
+
+def parse_values(response: bytes, tags: Tuple[str, ...]) -> Dict[str, Optional[str]]:
+    """Same as scan_values, by parsing the whole response. The last element of each tag wins"""
+    values = dict()
+    for element in ET.fromstring(response).iter():
+        if element.tag in tags:
+            values[element.tag] = element.find('value').text
+    return values
+
+
 class AVStatus:
-    """Holds the status of the AV receiver. Might not be complete depending on where it came from."""
+    """Holds the status of the AV receiver. Might not be complete depending on where it came from.
+
+    Other fields than the ones of FIELDS can be asked for with extra_tags: the text of their value
+    is then in extra, by tag"""
 
-    def __init__(self, response: bytes):
+    FIELDS = ('input', 'mute', 'power', 'volume')
+    TAGS = ('Power', 'InputFuncSelect', 'MasterVolume', 'Mute')
+
+    def __init__(self, response: Optional[bytes] = None, extra_tags: Tuple[str, ...] = ()):
         self.input = None
         self.mute = None
         self.power = None
         self.volume = None
-        tree = ET.fromstring(response)
-        for element in tree.iter():
-            if element.tag == 'Power':
-                self.power = element.find('value').text == 'ON'
-            elif element.tag == 'InputFuncSelect':
-                self.input = element.find('value').text
-            elif element.tag == 'MasterVolume':
-                volume = element.find('value').text
-                self.volume = volume if volume == '--' else float(volume)
-            elif element.tag == 'Mute':
-                self.mute = element.find('value').text == 'on'
+        self.extra: Dict[str, Optional[str]] = dict()
+        if response is None:
+            return
+        tags = AVStatus.TAGS + tuple(extra_tags)
+        values = scan_values(response, tags) if isinstance(response, bytes) else None
+        if values is None:
+            values = parse_values(response, tags)
+        for tag, text in values.items():
+            if tag == 'Power':
+                self.power = text == 'ON'
+            elif tag == 'InputFuncSelect':
+                self.input = text
+            elif tag == 'MasterVolume':
+                self.volume = text if text == '--' else float(text)
+            elif tag == 'Mute':
+                self.mute = text == 'on'
+            else:
+                self.extra[tag] = text
 
     def __str__(self) -> str:
         return 'Power: {}\nInput: {}\nVolume: {}\nMute: {}'.format(
             self.power, self.input, self.volume, self.mute)
 
 
-class AVReceiver:
-    """Wraps the interface of the AV receiver"""
-    _POWER = 'formiPhoneAppPower.xml?1+Power'
-    _SOURCE = 'formiPhoneAppDirect.xml?SI'
-    _VOLUME = 'formiPhoneAppVolume.xml?1+{:.1f}'
-    _VOLUME_MUTE = 'formiPhoneAppMute.xml?1+Mute'
+class AVState:
+    """Thread safe snapshot of the state of the receiver, built from all the statuses received.
+    Each field remembers when it was last updated"""
+
+    def __init__(self):
+        self._values = dict()
+        self._updated = dict()
+        self._lock = threading.Lock()
+
+    def update(self, status: AVStatus) -> None:
+        """Records the fields known by the status"""
+        now = time.monotonic()
+        with self._lock:
+            for field in AVStatus.FIELDS:
+                value = getattr(status, field, None)
+                if value is not None:
+                    self._values[field] = value
+                    self._updated[field] = now
+
+    def invalidate(self, *fields: str) -> None:
+        """Forgets the given fields, or all of them"""
+        with self._lock:
+            for field in fields or AVStatus.FIELDS:
+                self._updated.pop(field, None)
+
+    def age(self, fields: Tuple[str, ...] = AVStatus.FIELDS) -> float:
+        """Seconds since the oldest of the fields was updated, infinite if one never was"""
+        with self._lock:
+            updated = [self._updated.get(field) for field in fields]
+        if None in updated:
+            return float('inf')
+        return time.monotonic() - min(updated)
+
+    def snapshot(self) -> AVStatus:
+        """Returns a status with all the known fields, however old"""
+        status = AVStatus()
+        with self._lock:
+            for field, value in self._values.items():
+                if field in self._updated:
+                    setattr(status, field, value)
+        return status
+
+    def get(self, fields: Tuple[str, ...], max_age: float) -> Optional[AVStatus]:
+        """Returns a status with the given fields if they were all updated less than max_age
+        seconds ago"""
+        limit = time.monotonic() - max_age
+        status = AVStatus()
+        with self._lock:
+            for field in fields:
+                if self._updated.get(field, limit) <= limit:
+                    return None
+                setattr(status, field, self._values[field])
+        return status
+
+
+class _VolumeBatch:
+    def __init__(self):
+        self.delta = 0
+        self.done = threading.Event()
+        self.result: Optional[int] = None
+        self.error: Optional[Exception] = None
+
+
+class VolumeAggregator:
+    """Applies the volume increments with as few commands as possible. An increment is applied right
+    away, unless a command is already in flight: the increments received meanwhile are then summed
+    and applied with a single command once it is done. Every caller of a batch gets the resulting
+    volume. A window can delay each command to gather more increments"""
+
+    def __init__(self, apply: Callable[[int], int], window: float):
+        self._apply = apply
+        self.window = window
+        self._pending: Optional[_VolumeBatch] = None
+        self._lock = threading.Lock()
+        # batches are applied one after the other, each one starting from the result of the previous
+        self._apply_lock = threading.Lock()
+
+    def add(self, delta: int) -> int:
+        """Adds delta to the volume and returns the resulting volume"""
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = _VolumeBatch()
+                self._pending = batch
+            batch.delta += delta
+        if not leader:
+            batch.done.wait()
+        else:
+            try:
+                # the increments received while waiting for the previous batch join this one
+                with self._apply_lock:
+                    if self.window:
+                        time.sleep(self.window)
+                    with self._lock:
+                        self._pending = None
+                    LOGGER.debug('Applying volume increments: %d', batch.delta)
+                    batch.result = self._apply(batch.delta)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        if batch.error:
+            raise batch.error
+        return batch.result
+
+
+class PowerTransition:
+    """A power transition requested to the receiver. result is whether the receiver ended up on
+    the desired input, once done is set"""
+
+    def __init__(self, target: bool):
+        self.target = target
+        self.done = threading.Event()
+        self.result: Optional[bool] = None
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Waits for the transition to end, returns False if it did not in time"""
+        return self.done.wait(timeout)
+
+
+class PowerStateMachine:
+    """Runs the power transitions of the receiver in a background thread, one at a time.
+
+    A transition requested while an identical one is in flight joins it. A transition to the
+    opposite state interrupts the running one, which ends with result False"""
+
+    IDLE = 'idle'
+    POWERING_ON = 'powering on'
+    SWITCHING_INPUT = 'switching input'
+    POWERING_OFF = 'powering off'
+
+    def __init__(self, receiver: 'BaseAVReceiver', input_timeout: float,
+                 min_delay: float = 0.25, max_delay: float = 1):
+        self.receiver = receiver
+        self.input_timeout = input_timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.state = PowerStateMachine.IDLE
+        self._current: Optional[PowerTransition] = None
+        self._next: Optional[PowerTransition] = None
+        self._worker: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def request(self, on: bool) -> PowerTransition:
+        """Requests the receiver to be powered on or off, returns the transition doing it"""
+        with self._lock:
+            if self._next:
+                if self._next.target == on:
+                    return self._next
+                # never started, it is replaced by the new one
+                self._next.result = False
+                self._next.done.set()
+                self._next = None
+            current = self._current
+            if current and current.target == on and not current.done.is_set():
+                return current
+            transition = PowerTransition(on)
+            self._next = transition
+            if current:
+                self._wake.set()
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='kodiproxy-power', daemon=True)
+                self._worker.start()
+        return transition
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                transition = self._next
+                self._next = None
+                self._current = transition
+                if transition is None:
+                    self.state = PowerStateMachine.IDLE
+                    self._worker = None
+                    return
+                self._wake.clear()
+            try:
+                if transition.target:
+                    transition.result = self._power_on()
+                else:
+                    transition.result = self._power_off()
+            except Exception as e:
+                LOGGER.error('Power transition failed: %s', e)
+                transition.result = False
+            finally:
+                transition.done.set()
+
+    def _interrupted(self) -> bool:
+        with self._lock:
+            return self._next is not None
+
+    def _power_on(self) -> bool:
+        receiver = self.receiver
+        status = receiver._get_status()
+        if not status.power:
+            self.state = PowerStateMachine.POWERING_ON
+            receiver._power(True)
+        self.state = PowerStateMachine.SWITCHING_INPUT
+        deadline = time.monotonic() + self.input_timeout
+        delay = self.min_delay
+        # the receiver ignores the input until it is fully powered on
+        while status.input != receiver.desired_input:
+            if time.monotonic() + delay > deadline:
+                LOGGER.warning('Receiver did not switch to %s in time', receiver.desired_input)
+                return False
+            if self._wake.wait(delay) or self._interrupted():
+                return False
+            status = receiver._set_source()
+            delay = min(delay * 2, self.max_delay)
+        return True
+
+    def _power_off(self) -> bool:
+        receiver = self.receiver
+        status = receiver._get_status()
+        if status.input == receiver.desired_input:
+            self.state = PowerStateMachine.POWERING_OFF
+            receiver._power(False)
+        return False
+
+
+class StatusPoller:
+    """Refreshes the state of the receiver in the background, so that reads are served without
+    waiting for it.
+
+    The status is read every fast_interval seconds while the receiver is on the desired input or was
+    sent a command less than recent_window seconds ago, every slow_interval seconds otherwise (in
+    standby, or after a failure). Any status received in between, whatever asked for it, delays
+    the next poll"""
+
+    def __init__(self, receiver: 'AVReceiver', fast_interval: float, slow_interval: float,
+                 recent_window: float):
+        self.receiver = receiver
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.recent_window = recent_window
+        self.polls = 0
+        self.failures = 0
+        self._touched = float('-inf')
+        self._polled = float('-inf')
+        self._failed: Optional[float] = None
+        self._worker: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None
+
+    def start(self) -> None:
+        """Starts polling in the background, if it is not already"""
+        with self._lock:
+            if self._worker is None:
+                self._stopped.clear()
+                self._worker = threading.Thread(
+                    target=self._run, name='kodiproxy-receiver-poller', daemon=True)
+                self._worker.start()
+
+    def stop(self) -> None:
+        """Stops polling and waits for the poll in progress, if any"""
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker:
+            self._stopped.set()
+            self._wake.set()
+            worker.join()
+
+    def touch(self) -> None:
+        """Records that the receiver was sent a command, it is polled fast for a while"""
+        self._touched = time.monotonic()
+        if self.running:
+            self._wake.set()
+
+    def failing(self) -> bool:
+        """Whether the last poll failed and no status was received since"""
+        return self._failed is not None and self.receiver.state.age() > time.monotonic() - self._failed
+
+    def interval(self) -> float:
+        """Current time between two polls"""
+        if self.failing():
+            return self.slow_interval
+        if time.monotonic() - self._touched < self.recent_window:
+            return self.fast_interval
+        status = self.receiver.state.get(('power', 'input'), float('inf'))
+        if status and status.power and status.input == self.receiver.desired_input:
+            return self.fast_interval
+        return self.slow_interval
+
+    def max_age(self) -> float:
+        """Age up to which the polled state can be used instead of asking the receiver"""
+        if not self.running or self.failing():
+            return 0
+        # allows for the time the poll takes
+        return self.interval() + self.receiver.guard.timeout('status')
+
+    def poll(self) -> None:
+        """Reads the status of the receiver, behind the commands sent for the clients"""
+        receiver = self.receiver
+        start = self._polled = time.monotonic()
+        try:
+            receiver.commands.run(lambda: receiver._execute(receiver._status_command, 'status'),
+                                  CommandQueue.BACKGROUND, receiver._status_command)
+            self._failed = None
+            metrics.RECEIVER_POLLS.inc('ok')
+        except Exception as e:
+            if self._failed is None:
+                LOGGER.warning('Could not poll the receiver: %s', e)
+            self._failed = time.monotonic()
+            self.failures += 1
+            metrics.RECEIVER_POLLS.inc('error')
+        finally:
+            self.polls += 1
+            metrics.RECEIVER_POLL_SECONDS.inc(amount=time.monotonic() - start)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            # statuses read for the clients count as polls
+            since = min(self.receiver.state.age(), time.monotonic() - self._polled)
+            delay = self.interval() - since
+            if delay > 0:
+                # the interval is checked again often, it changes with the state of the receiver
+                self._wake.wait(min(delay, self.fast_interval))
+                self._wake.clear()
+            else:
+                self.poll()
+
+
+class BaseAVReceiver(metaclass=ABCMeta):
+    """What the backends of the receiver share: the power transitions and the volume, in
+    percentages of its range. The backends send the commands, which return the resulting status"""
 
     _DEFAULT_CONFIGURATION = {
+        'backend': 'http',
+        'breakerFailures': 3,
+        'breakerResetTimeout': 10,
         'desiredInput': 'AUXB',
         'ip': None,
+        'keepAlive': 10,
         'port': None,
         'minVolume': -80,
-        'maxVolume': -20
+        'maxVolume': -20,
+        'minTimeout': 0.5,
+        'name': 'receiver',
+        'pollInterval': 0,
+        'pollRecentWindow': 60,
+        'pollStandbyInterval': 30,
+        'powerOnTimeout': 6,
+        'statusMaxAge': 2,
+        'telnetCommandInterval': 0.05,
+        'telnetPort': 23,
+        'telnetProbeInterval': 30,
+        'timeout': 5,
+        'volumeWindow': 0,
+        'zone': 1
     }
 
-    def __init__(self, conf):
-        conf = KPConfBase(AVReceiver, conf)
+    def __init__(self, conf: KPConfBase):
         LOGGER.info('Receiver configuration:\n%s', conf)
-        if conf.port:
-            address = '{}:{}'.format(conf.ip, conf.port)
-        else:
-            address = conf.ip
-        self.address = 'http://{}/goform/'.format(address)
+        self.name = conf.name
+        self.zone = conf.zone
         self.desired_input = conf.desiredInput
         self.min_volume = conf.minVolume
         self.max_volume = conf.maxVolume
+        self.guard = BackendGuard(self.name, min(conf.minTimeout, conf.timeout), conf.timeout,
+                                  conf.breakerFailures, conf.breakerResetTimeout,
+                                  failures=(OSError, http.client.HTTPException),
+                                  answers=(error.HTTPError,))
+        self.state = AVState()
+        self.volume_aggregator = VolumeAggregator(
+            self._incr_volume, conf.volumeWindow)
+        self.power = PowerStateMachine(self, conf.powerOnTimeout)
 
-    def _send_command(self, command: str) -> AVStatus:
-        res = request.urlopen(self.address + command, timeout=5).read()
-        return AVStatus(res)
+    @abstractmethod
+    def start(self) -> None:
+        pass
 
+    @abstractmethod
+    def stop(self) -> None:
+        pass
+
+    @abstractmethod
     def _get_status(self) -> AVStatus:
-        return self._send_command('formMainZone_MainZoneXmlStatus.xml')
+        pass
 
-    def _set_source(self) -> bool:
-        # of course we don't get the source in response
-        request.urlopen(self.address + AVReceiver._SOURCE +
-                        self.desired_input, timeout=5)
-        return self._get_status()
+    @abstractmethod
+    def _get_state(self, *fields: str) -> AVStatus:
+        pass
+
+    @abstractmethod
+    def _set_source(self) -> AVStatus:
+        pass
+
+    @abstractmethod
+    def _power(self, on: bool) -> AVStatus:
+        pass
+
+    @abstractmethod
+    def _mute(self, mute: bool) -> AVStatus:
+        pass
+
+    @abstractmethod
+    def _set_volume_db(self, volume: float) -> AVStatus:
+        pass
 
     def _db_to_percent(self, volume: [float, str]) -> int:
         if volume == '--':  # I hate you
@@ -88,60 +517,447 @@ class AVReceiver:
 
     def get_power(self) -> bool:
         """Returns whether the AV receiver is up or not"""
-        status = self._get_status()
+        status = self._get_state('power', 'input')
         return status.power and status.input == self.desired_input
 
-    def set_power(self, onOff: bool) -> bool:
+    def set_power(self, onOff: bool, timeout: Optional[float] = 0) -> bool:
         """Power on or off the AV receiver.
 
         If onOff is True, it will power on the receiver on and swicth to the desired input.
 
-        If onOff is False, it will power off the receiver if it is currently on the desired input"""
-        status = self._get_status()
-        if onOff:
-            if not status.power:
-                self._send_command(AVReceiver._POWER + 'On')
-            i = 8  # arbitrary number of retries, 4 is usually enough
-            while status.input != self.desired_input and i > 0:
-                time.sleep(0.5)
-                status = self._set_source()
-                i -= 1
-            return True
-        else:
-            if status.input == self.desired_input:
-                status = self._send_command(AVReceiver._POWER + 'Standby')
-            return False
+        If onOff is False, it will power off the receiver if it is currently on the desired input.
+
+        The transition runs in the background. The method returns onOff right away, unless timeout
+        is not 0: it then waits up to timeout seconds (None for ever) for the actual result"""
+        transition = self.power.request(onOff)
+        if timeout != 0 and transition.wait(timeout):
+            return transition.result
+        return onOff
 
     def get_mute(self) -> bool:
         """Returns whether the receiver is muted or not"""
-        return self._get_status().mute
+        return self._get_state('mute').mute
 
     def set_mute(self, mute: bool) -> bool:
         """Mutes or unmutes the receiver"""
-        return self._send_command(
-            AVReceiver._VOLUME_MUTE + ('On' if mute else 'Off')).mute
+        return self._mute(mute).mute
 
     def incr_volume(self, incr: bool) -> int:
-        """Increases or decreases the volume"""
+        """Increases or decreases the volume. Increments received at the same time are applied
+        together"""
+        return self.volume_aggregator.add(1 if incr else -1)
+
+    def _incr_volume(self, delta: int) -> int:
         # setting the volume works better than using the actual
         # commands to increase/decrease
-        volume = self._get_status().volume
+        volume = self._get_state('volume').volume
         if volume == '--':  # why ?
             volume = self.min_volume
-        volume = volume + (1 if incr else -1)
+        volume = volume + delta
         volume = max(self.min_volume, min(
             volume, self.max_volume))
-        return self._db_to_percent(
-            self._send_command(AVReceiver._VOLUME.format(volume)).volume)
+        return self._db_to_percent(self._set_volume_db(volume).volume)
 
     def get_volume(self) -> Tuple[int, bool]:
         """Returns the volume in percentage and the mute status"""
-        status = self._get_status()
+        status = self._get_state('volume', 'mute')
         return self._db_to_percent(status.volume), status.mute
 
     def set_volume(self, volume: int) -> int:
         """Sets the volume in percentage"""
         volume = max(0, min(volume, 100))
         volume = self._percent_to_db(volume)
-        return self._db_to_percent(
-            self._send_command(AVReceiver._VOLUME.format(volume)).volume)
+        return self._db_to_percent(self._set_volume_db(volume).volume)
+
+
+class AVReceiver(BaseAVReceiver):
+    """Wraps the web interface of the AV receiver"""
+    # the commands take the number of the zone
+    _STATUS = 'formMainZone_MainZoneXmlStatus.xml'
+    _ZONE_STATUS = 'formZone{0}_Zone{0}XmlStatus.xml'
+    _POWER = 'formiPhoneAppPower.xml?{}+Power'
+    _SOURCE = 'formiPhoneAppDirect.xml?SI'
+    _ZONE_SOURCE = 'formiPhoneAppDirect.xml?Z{}'
+    _VOLUME = 'formiPhoneAppVolume.xml?{}+{{:.1f}}'
+    _VOLUME_MUTE = 'formiPhoneAppMute.xml?{}+Mute'
+    _COMMAND_TYPES = (('formiPhoneAppPower.xml', 'power'), ('formiPhoneAppDirect.xml', 'source'),
+                      ('formiPhoneAppMute.xml', 'mute'), ('formiPhoneAppVolume.xml', 'volume'))
+
+    def __init__(self, conf):
+        conf = KPConfBase(AVReceiver, conf)
+        super().__init__(conf)
+        if self.zone == 1:
+            self._status_command = AVReceiver._STATUS
+            self._source_command = AVReceiver._SOURCE
+        else:
+            self._status_command = AVReceiver._ZONE_STATUS.format(self.zone)
+            self._source_command = AVReceiver._ZONE_SOURCE.format(self.zone)
+        self._power_command = AVReceiver._POWER.format(self.zone)
+        self._volume_command = AVReceiver._VOLUME.format(self.zone)
+        self._mute_command = AVReceiver._VOLUME_MUTE.format(self.zone)
+        self.connection = ReceiverConnection(conf.ip, conf.port)
+        self.commands = CommandQueue('kodiproxy-' + self.name, conf.keepAlive, self.connection.close)
+        self.status_max_age = conf.statusMaxAge
+        self.poller = StatusPoller(self, conf.pollInterval,
+                                   max(conf.pollInterval, conf.pollStandbyInterval),
+                                   conf.pollRecentWindow)
+        self.poll_enabled = conf.pollInterval > 0
+
+    def start(self) -> None:
+        """Starts polling the status in the background, if enabled"""
+        if self.poll_enabled:
+            self.poller.start()
+
+    def stop(self) -> None:
+        """Stops the background polling"""
+        self.poller.stop()
+
+    @staticmethod
+    def _command_type(command: str) -> str:
+        """Name of the kind of command, for the metrics"""
+        for path, name in AVReceiver._COMMAND_TYPES:
+            if command.startswith(path):
+                return name
+        return 'status'
+
+    def _request(self, command: str, command_type: str) -> bytes:
+        """Sends the command to the receiver. Only to be called from the thread of the commands"""
+        with metrics.RECEIVER_DURATION.time(command_type):
+            return self.guard.call(lambda timeout: self.connection.get(command, timeout), command_type)
+
+    def _execute(self, command: str, command_type: str) -> AVStatus:
+        status = AVStatus(self._request(command, command_type))
+        self.state.update(status)
+        return status
+
+    def _send_command(self, command: str) -> AVStatus:
+        command_type = AVReceiver._command_type(command)
+        if command_type != 'status':
+            self.poller.touch()
+        with tracing.stage('receiver:' + command_type):
+            if command_type == 'status':
+                # concurrent reads of the status are sent once
+                return self.commands.run(lambda: self._execute(command, command_type),
+                                         CommandQueue.STATUS, command)
+            return self.commands.run(lambda: self._execute(command, command_type))
+
+    def _get_status(self) -> AVStatus:
+        return self._send_command(self._status_command)
+
+    def _get_state(self, *fields: str) -> AVStatus:
+        """Returns the given fields from the state if they are recent enough, otherwise asks the
+        receiver for its status. While polling, the state is kept recent by the poller"""
+        max_age = max(self.status_max_age, self.poller.max_age())
+        return self.state.get(fields, max_age) or self._get_status()
+
+    def _set_source(self) -> AVStatus:
+        # of course we don't get the source in response
+        with tracing.stage('receiver:source'):
+            self.commands.run(lambda: self._request(
+                self._source_command + self.desired_input, 'source'))
+        self.state.invalidate('input')
+        return self._get_status()
+
+    def _power(self, on: bool) -> AVStatus:
+        return self._send_command(self._power_command + ('On' if on else 'Standby'))
+
+    def _mute(self, mute: bool) -> AVStatus:
+        return self._send_command(self._mute_command + ('On' if mute else 'Off'))
+
+    def _set_volume_db(self, volume: float) -> AVStatus:
+        return self._send_command(self._volume_command.format(volume))
+
+
+class TelnetAVReceiver(BaseAVReceiver):
+    """Same as AVReceiver, through the telnet control protocol of the receiver instead of its web
+    interface. The receiver pushes the changes of its state, which is then always up to date: reads
+    do not wait for the receiver as long as the session is open"""
+
+    _QUERIES = (('PW?', 'power'), ('SI?', 'input'), ('MV?', 'volume'), ('MU?', 'mute'))
+    # the other zones answer Z2? with their input, power and volume
+    _ZONE_QUERIES = (('Z{}?', 'power'), ('Z{}MU?', 'mute'))
+    # events of the other zones that are not inputs, like Z2CSST or Z2SLPOFF
+    _ZONE_SETTINGS = ('CS', 'CV', 'HDA', 'HPF', 'PS', 'QUICK', 'SLP', 'SMART', 'STBY')
+    # the volume is sent in half dB steps from -80 dB: MV455 is -34.5 dB
+    _VOLUME_ORIGIN = 80
+
+    def __init__(self, conf):
+        conf = KPConfBase(AVReceiver, conf)
+        super().__init__(conf)
+        if self.zone == 1:
+            self._codes = {'power': 'PW', 'input': 'SI', 'mute': 'MU', 'volume': 'MV'}
+            self._standby_value = 'STANDBY'
+            queries = TelnetAVReceiver._QUERIES
+        else:
+            zone = 'Z{}'.format(self.zone)
+            self._codes = {'power': zone, 'input': zone, 'mute': zone + 'MU', 'volume': zone}
+            self._standby_value = 'OFF'
+            queries = tuple((query.format(self.zone), field)
+                            for query, field in TelnetAVReceiver._ZONE_QUERIES)
+        self._queries = queries
+        self.session = TelnetSession(conf.ip, conf.telnetPort, self._on_event, queries,
+                                     conf.telnetCommandInterval, self.state.invalidate,
+                                     probe=queries[0], probe_interval=conf.telnetProbeInterval)
+
+    def start(self) -> None:
+        """Opens the session with the receiver in the background"""
+        self.session.start()
+
+    def stop(self) -> None:
+        """Closes the session with the receiver"""
+        self.session.stop()
+
+    @staticmethod
+    def _db_to_telnet(volume: float) -> str:
+        volume += TelnetAVReceiver._VOLUME_ORIGIN
+        if volume == int(volume):
+            return '{:02d}'.format(int(volume))
+        return '{:02d}5'.format(int(volume))
+
+    @staticmethod
+    def _telnet_to_db(value: str) -> float:
+        volume = float(value) / 10 if len(value) == 3 else float(value)
+        return volume - TelnetAVReceiver._VOLUME_ORIGIN
+
+    def _parse_event(self, line: str) -> Tuple[Optional[str], Any]:
+        """Returns the field of the state changed by the event and its new value"""
+        if self.zone == 1:
+            code, value = line[:2], line[2:]
+            if code == 'PW':
+                return 'power', value == 'ON'
+            elif code == 'SI':
+                return 'input', value
+            elif code == 'MU':
+                return 'mute', value == 'ON'
+            elif code == 'MV' and value.isdigit():
+                return 'volume', TelnetAVReceiver._telnet_to_db(value)
+            # MVMAX, other zones, surround modes...
+            return None, None
+        code = self._codes['power']
+        if not line.startswith(code):
+            return None, None
+        value = line[len(code):]
+        if value in ('ON', 'OFF'):
+            return 'power', value == 'ON'
+        elif value in ('MUON', 'MUOFF'):
+            return 'mute', value == 'MUON'
+        elif value.isdigit():
+            return 'volume', TelnetAVReceiver._telnet_to_db(value)
+        elif value and not value.startswith(TelnetAVReceiver._ZONE_SETTINGS):
+            return 'input', value
+        return None, None
+
+    def _on_event(self, line: str) -> Optional[str]:
+        """Records an event of the receiver in the state, returns the field it changed"""
+        field, value = self._parse_event(line)
+        if field is None:
+            return None
+        metrics.RECEIVER_EVENTS.inc(field)
+        status = AVStatus()
+        setattr(status, field, value)
+        self.state.update(status)
+        return field
+
+    def _telnet(self, line: str, field: Optional[str], command_type: str,
+                required: bool = True) -> AVStatus:
+        """Sends a command and waits for the event of the field, which is required unless the
+        receiver may ignore the command"""
+        def run(timeout: float) -> None:
+            if not self.session.command(line, field, timeout) and required:
+                raise TimeoutError('The receiver did not answer {}'.format(line))
+
+        with metrics.RECEIVER_DURATION.time(command_type), tracing.stage('receiver:' + command_type):
+            self.guard.call(run, command_type)
+        return self.state.snapshot()
+
+    def _known_status(self) -> Optional[AVStatus]:
+        """The status from the pushed state, if it is known enough"""
+        if not self.session.connected.is_set():
+            return None
+        status = self.state.get(AVStatus.FIELDS, float('inf'))
+        if status:
+            return status
+        status = self.state.snapshot()
+        if status.power is False and status.input is not None:
+            return TelnetAVReceiver._standby(status)
+        return None
+
+    def _get_status(self) -> AVStatus:
+        status = self._known_status()
+        if status:
+            return status
+        with metrics.RECEIVER_DURATION.time('status'), tracing.stage('receiver:status'):
+            return self.guard.call(self._query, 'status')
+
+    @staticmethod
+    def _standby(status: AVStatus) -> AVStatus:
+        # the receiver may not tell its volume in standby, the web interface shows it as --
+        if status.volume is None:
+            status.volume = '--'
+        if status.mute is None:
+            status.mute = False
+        return status
+
+    def _query(self, timeout: float) -> AVStatus:
+        deadline = time.monotonic() + timeout
+        self.session.wait_connected(timeout)
+        # the queries sent on connection may have been answered
+        status = self._known_status()
+        if status:
+            return status
+        # or may still be waiting for their answers, only the unknown fields are asked again
+        known = self.state.snapshot()
+        tickets = [(query, field, self.session.query(query, field, deadline - time.monotonic()))
+                   for query, field in self._queries if getattr(known, field) is None]
+        for query, field, ticket in tickets:
+            # the receiver may not answer the others in standby
+            if not self.session.wait(field, ticket, deadline - time.monotonic()) and field == 'power':
+                raise TimeoutError('The receiver did not answer {}'.format(query))
+        return TelnetAVReceiver._standby(self.state.snapshot())
+
+    def _get_state(self, *fields: str) -> AVStatus:
+        if self.session.connected.is_set():
+            status = self.state.get(fields, float('inf'))
+            if status:
+                return status
+        return self._get_status()
+
+    def _set_source(self) -> AVStatus:
+        # ignored while the receiver is powering on
+        return self._telnet(self._codes['input'] + self.desired_input, 'input', 'source',
+                            required=False)
+
+    def _power(self, on: bool) -> AVStatus:
+        return self._telnet(self._codes['power'] + ('ON' if on else self._standby_value),
+                            'power', 'power')
+
+    def _mute(self, mute: bool) -> AVStatus:
+        return self._telnet(self._codes['mute'] + ('ON' if mute else 'OFF'), 'mute', 'mute')
+
+    def _set_volume_db(self, volume: float) -> AVStatus:
+        return self._telnet(self._codes['volume'] + TelnetAVReceiver._db_to_telnet(volume),
+                            'volume', 'volume')
+
+
+class AVReceiverGroup:
+    """Receivers, or zones of receivers, following the same commands. Each command is sent to all
+    the members at the same time: the group takes as long as its slowest member. Each member maps
+    the volume percentages to its own range.
+
+    The policy tells how the results of the members make the one of the group:
+    - primary: the result of the first member, the failures of the others are only logged
+    - all: fails if any member fails, power and mute are on only if they are on all the members
+    - any: fails if all the members fail, power and mute are on if they are on any member
+    The volume is the one of the first member that succeeded. With the primary policy, reads only
+    ask the first member"""
+
+    PRIMARY = 'primary'
+    ALL = 'all'
+    ANY = 'any'
+
+    _DEFAULT_CONFIGURATION = {
+        'members': None,
+        'policy': 'primary'
+    }
+
+    def __init__(self, conf):
+        if isinstance(conf, list):
+            conf = {'members': conf}
+        group_conf = KPConfBase(AVReceiverGroup, conf)
+        self.policy = group_conf.policy
+        if self.policy not in (AVReceiverGroup.PRIMARY, AVReceiverGroup.ALL, AVReceiverGroup.ANY):
+            raise ValueError('Incorrect receiver group policy: {}'.format(self.policy))
+        # the other keys are shared by all the members
+        shared = {k: v for k, v in conf.items() if k not in AVReceiverGroup._DEFAULT_CONFIGURATION}
+        name = shared.get('name') or AVReceiver._DEFAULT_CONFIGURATION['name']
+        self.members = []
+        for i, member in enumerate(group_conf.members):
+            member = dict(shared, **member)
+            if 'name' not in member or member['name'] == name:
+                member['name'] = name if i == 0 else '{}{}'.format(name, i + 1)
+            self.members.append(create_receiver(member))
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=len(self.members), thread_name_prefix='kodiproxy-receivers')
+
+    def start(self) -> None:
+        for member in self.members:
+            member.start()
+
+    def stop(self) -> None:
+        for member in self.members:
+            member.stop()
+
+    def _fan_out(self, function: Callable[[BaseAVReceiver], Any], readers: bool = False) -> list:
+        """Calls function on the members at the same time. Returns the results of the members that
+        succeeded, in order, unless the group fails according to its policy"""
+        members = self.members
+        if readers and self.policy == AVReceiverGroup.PRIMARY:
+            members = members[:1]
+        if len(members) == 1:
+            return [function(members[0])]
+        # each call keeps the trace of the request
+        calls = [self._executor.submit(contextvars.copy_context().run, function, member)
+                 for member in members]
+        results = []
+        errors = []
+        for member, call in zip(members, calls):
+            try:
+                results.append(call.result())
+            except Exception as e:
+                errors.append((member, e))
+        if errors:
+            if self.policy == AVReceiverGroup.ALL or not results or (
+                    self.policy == AVReceiverGroup.PRIMARY and errors[0][0] is members[0]):
+                raise errors[0][1]
+            for member, e in errors:
+                LOGGER.warning('Receiver %s failed: %s', member.name, e)
+        return results
+
+    def _combine(self, values: list) -> bool:
+        if self.policy == AVReceiverGroup.ALL:
+            return all(values)
+        elif self.policy == AVReceiverGroup.ANY:
+            return any(values)
+        return values[0]
+
+    def get_power(self) -> bool:
+        """Returns whether the receivers are up"""
+        return self._combine(self._fan_out(lambda member: member.get_power(), readers=True))
+
+    def set_power(self, onOff: bool, timeout: Optional[float] = 0) -> bool:
+        """Powers on or off all the receivers, see BaseAVReceiver.set_power"""
+        return self._combine(self._fan_out(lambda member: member.set_power(onOff, timeout)))
+
+    def get_mute(self) -> bool:
+        """Returns whether the receivers are muted"""
+        return self._combine(self._fan_out(lambda member: member.get_mute(), readers=True))
+
+    def set_mute(self, mute: bool) -> bool:
+        """Mutes or unmutes all the receivers"""
+        return self._combine(self._fan_out(lambda member: member.set_mute(mute)))
+
+    def incr_volume(self, incr: bool) -> int:
+        """Increases or decreases the volume of all the receivers"""
+        return self._fan_out(lambda member: member.incr_volume(incr))[0]
+
+    def get_volume(self) -> Tuple[int, bool]:
+        """Returns the volume in percentage and the mute status"""
+        results = self._fan_out(lambda member: member.get_volume(), readers=True)
+        return results[0][0], self._combine([muted for _, muted in results])
+
+    def set_volume(self, volume: int) -> int:
+        """Sets the volume of all the receivers in percentage"""
+        return self._fan_out(lambda member: member.set_volume(volume))[0]
+
+
+def create_receiver(conf) -> Union[BaseAVReceiver, AVReceiverGroup]:
+    """Creates the receiver matching the backend chosen in the configuration, or the group of
+    receivers if it has members"""
+    if isinstance(conf, list) or (conf and conf.get('members')):
+        return AVReceiverGroup(conf)
+    backend = KPConfBase(AVReceiver, conf).backend
+    if backend == 'http':
+        return AVReceiver(conf)
+    elif backend == 'telnet':
+        return TelnetAVReceiver(conf)
+    raise ValueError('Incorrect receiver backend: {}'.format(backend))
@@ -0,0 +1,213 @@
+import asyncio
+import collections
+from kp import metrics
+from kp.tracing import percentile
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, Type, TypeVar
+
+LOGGER = logging.getLogger('kodiproxy')
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend that is considered down"""
+
+
+class AdaptiveTimeout:
+    """Timeout following the latency of a backend, bounded by min_timeout and max_timeout.
+
+    It is the largest of the smoothed latency plus 4 times its deviation (like TCP retransmission
+    timeouts) and 2 times the 99th percentile of the recent latencies. It is max_timeout until
+    enough latencies are known"""
+
+    _ALPHA = 0.125
+    _BETA = 0.25
+    _MIN_SAMPLES = 8
+
+    def __init__(self, min_timeout: float, max_timeout: float, window: int = 100):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.average: Optional[float] = None
+        self.deviation = 0.
+        self._samples: Deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float) -> None:
+        with self._lock:
+            if self.average is None:
+                self.average = latency
+                self.deviation = latency / 2
+            else:
+                self.deviation += AdaptiveTimeout._BETA * \
+                    (abs(latency - self.average) - self.deviation)
+                self.average += AdaptiveTimeout._ALPHA * (latency - self.average)
+            self._samples.append(latency)
+
+    def on_timeout(self, timeout: float) -> None:
+        """The latency was at least timeout, which pushes the timeout up"""
+        self.observe(timeout * 2)
+
+    def get(self) -> float:
+        with self._lock:
+            if len(self._samples) < AdaptiveTimeout._MIN_SAMPLES:
+                return self.max_timeout
+            p99 = percentile(sorted(self._samples), 99)
+            timeout = max(self.average + 4 * self.deviation, 2 * p99)
+        return max(self.min_timeout, min(timeout, self.max_timeout))
+
+
+class CircuitBreaker:
+    """Stops calling a backend after failure_threshold consecutive failures. Once reset_timeout
+    seconds are elapsed, a single trial call is let through: the circuit closes if it succeeds and
+    opens again otherwise. A failure_threshold of 0 disables the breaker"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self._opened_at = 0.
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Tells whether a call can be made. If it is, its outcome must be recorded"""
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN and \
+                    time.monotonic() - self._opened_at >= self.reset_timeout:
+                LOGGER.info('Circuit of %s half-open, trying a call', self.name)
+                self.state = CircuitBreaker.HALF_OPEN
+            if self.state == CircuitBreaker.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return self.state == CircuitBreaker.CLOSED
+
+    def record_success(self) -> None:
+        if self.state == CircuitBreaker.CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self.state != CircuitBreaker.CLOSED:
+                LOGGER.info('Circuit of %s closed', self.name)
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self._trial = False
+
+    def release(self) -> None:
+        """The outcome of the call is unknown (it was cancelled)"""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == CircuitBreaker.HALF_OPEN or (
+                    self.failure_threshold and self.failures >= self.failure_threshold):
+                if self.state != CircuitBreaker.OPEN:
+                    LOGGER.warning('Circuit of %s opened after %d failures',
+                                   self.name, self.failures)
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+
+
+class BackendGuard:
+    """Circuit breaker and adaptive timeouts of a backend. The timeouts are adapted separately for
+    each kind of call (given by a key), as some are expected to be much slower than others"""
+
+    def __init__(self, name: str, min_timeout: float, max_timeout: float,
+                 failure_threshold: int, reset_timeout: float,
+                 failures: Tuple[Type[BaseException], ...] = (OSError,),
+                 answers: Tuple[Type[BaseException], ...] = ()):
+        self.name = name
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        # the exceptions showing that the backend is down, unless they are answers of the backend;
+        # any other exception leaves the circuit as it is
+        self.failures = failures
+        self.answers = answers
+        self.timeouts: Dict[str, AdaptiveTimeout] = dict()
+        _GUARDS[name] = self
+
+    def timeout(self, key: str = '') -> float:
+        return self._adaptive(key).get()
+
+    def _adaptive(self, key: str) -> AdaptiveTimeout:
+        adaptive = self.timeouts.get(key)
+        if adaptive is None:
+            adaptive = self.timeouts.setdefault(
+                key, AdaptiveTimeout(self.min_timeout, self.max_timeout))
+        return adaptive
+
+    def _before(self) -> None:
+        if not self.breaker.allow():
+            _REJECTIONS.inc(self.name)
+            raise CircuitOpenError('{} is unavailable'.format(self.name))
+
+    def _after(self, key: str, timeout: float, start: float, error: Optional[BaseException]) -> None:
+        elapsed = time.monotonic() - start
+        if error is None:
+            self._adaptive(key).observe(elapsed)
+            self.breaker.record_success()
+        elif isinstance(error, self.answers):
+            # the backend answered, even if it was to say something went wrong
+            self.breaker.record_success()
+        elif isinstance(error, self.failures):
+            if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or elapsed >= timeout * 0.9:
+                self._adaptive(key).on_timeout(timeout)
+            self.breaker.record_failure()
+        else:
+            # whether the backend is up is unknown (the call was cancelled, or failed on our side)
+            self.breaker.release()
+
+    def call(self, function: Callable[[float], T], key: str = '') -> T:
+        """Calls function with the timeout to use, unless the circuit is open in which case
+        CircuitOpenError is raised"""
+        self._before()
+        timeout = self.timeout(key)
+        start = time.monotonic()
+        try:
+            result = function(timeout)
+        except BaseException as e:
+            self._after(key, timeout, start, e)
+            raise
+        self._after(key, timeout, start, None)
+        return result
+
+    async def call_async(self, function: Callable[[float], Awaitable[T]], key: str = '') -> T:
+        """Same as call, for a coroutine function"""
+        self._before()
+        timeout = self.timeout(key)
+        start = time.monotonic()
+        try:
+            result = await function(timeout)
+        except BaseException as e:
+            self._after(key, timeout, start, e)
+            raise
+        self._after(key, timeout, start, None)
+        return result
+
+
+# the last guard created for each backend, for the metrics
+_GUARDS: Dict[str, BackendGuard] = dict()
+_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+_REJECTIONS = metrics.REGISTRY.counter(
+    'kodiproxy_breaker_rejections_total', 'Calls not made because the circuit was open', ('backend',))
+metrics.REGISTRY.gauge(
+    'kodiproxy_breaker_state', 'State of the circuit breakers: 0 closed, 1 half-open, 2 open',
+    ('backend',), function=lambda: {name: _STATES[guard.breaker.state] for name, guard in list(_GUARDS.items())})
+metrics.REGISTRY.gauge(
+    'kodiproxy_adaptive_timeout_seconds', 'Current timeouts of the backends', ('backend', 'key'),
+    function=lambda: {(name, key): adaptive.get() for name, guard in list(_GUARDS.items())
+                      for key, adaptive in list(guard.timeouts.items())})
@@ -0,0 +1,85 @@
+from kp.confbase import KPConfBase
+from kp.log import JSONL_CONFIGURATION, JSONLWriter
+import json
+import time
+from typing import Any, Dict
+
+
+class CaptureConf:
+    _DEFAULT_CONFIGURATION = dict(
+        JSONL_CONFIGURATION, backupCount=3, path='kodiproxy_capture.jsonl')
+
+
+class Capture:
+    """Records the jrpc requests received by the proxy to a rotating JSONL file, so the traffic can be
+    replayed later (see kp.replay)"""
+
+    def __init__(self, conf=None):
+        self._writer = JSONLWriter('kodiproxy.capture', KPConfBase(CaptureConf, conf))
+        self.enabled = self._writer.enabled
+
+    def record(self, request: bytes, client: str, duration: float, code: int, size: int) -> None:
+        """Records a request once answered. size is the number of bytes of the response body"""
+        if not self.enabled:
+            return
+        entry = {
+            # when the request was received
+            'time': round(time.time() - duration, 6),
+            'client': client,
+            'duration': round(duration, 6),
+            'code': code,
+            'size': size
+        }
+        entry.update(describe(request))
+        self._writer.write(entry)
+
+
+CAPTURE = Capture()
+
+
+def config_capture(conf) -> None:
+    """Configures the capture used by the servers"""
+    global CAPTURE
+    CAPTURE = Capture(conf)
+
+
+def _describe_call(call: Any) -> Dict[str, Any]:
+    if not isinstance(call, dict):
+        return {'raw': call}
+    described = {'method': call.get('method'), 'params': call.get('params')}
+    # notifications have no id
+    if 'id' in call:
+        described['id'] = call['id']
+    return described
+
+
+def describe(request: bytes) -> Dict[str, Any]:
+    """Method, params and id of a jrpc request, or the list of them for a batch. What is not a jrpc
+    request is kept as it is, as raw json or as text if it is not even json"""
+    try:
+        decoded = json.loads(request)
+    except ValueError:
+        return {'text': request.decode('utf-8', 'replace')}
+    if isinstance(decoded, list):
+        return {'batch': [_describe_call(call) for call in decoded]}
+    return _describe_call(decoded)
+
+
+def encode(entry: Dict[str, Any]) -> bytes:
+    """Rebuilds the jrpc request of a captured entry"""
+    def call(described: Dict[str, Any]) -> Any:
+        if 'raw' in described:
+            return described['raw']
+        request = {'jsonrpc': '2.0', 'method': described['method']}
+        if described.get('params') is not None:
+            request['params'] = described['params']
+        if 'id' in described:
+            request['id'] = described['id']
+        return request
+
+    if 'batch' in entry:
+        return bytes(json.dumps([call(c) for c in entry['batch']]), 'utf-8')
+    if 'text' in entry:
+        return bytes(entry['text'], 'utf-8')
+    return bytes(json.dumps(call(entry)), 'utf-8')
+
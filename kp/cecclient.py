@@ -1,16 +1,234 @@
+from kp import metrics, tracing
+from kp.confbase import KPConfBase
+import logging
+import queue
 import subprocess
+import threading
+import time
+from typing import List, Optional
+
+LOGGER = logging.getLogger('kodiproxy')
+
+
+class CECError(Exception):
+    """Raised when cec-client could not run a command"""
+
+
+class _Command:
+    def __init__(self, line: str, expect: Optional[str], timeout: float):
+        self.line = line
+        self.expect = expect
+        self.timeout = timeout
+        self.done = threading.Event()
+        self.abandoned = False
+        self.result: Optional[str] = None
+        self.error: Optional[Exception] = None
+
+
+class _Exited:
+    """Queued when a cec-client process exits"""
+
+    def __init__(self, process: subprocess.Popen):
+        self.process = process
 
 
 class CECClient:
-    """Very basic class to switch on and off the projector"""
+    """Very basic class to switch on and off the projector.
+
+    A single cec-client process is kept running, as opening the CEC adapter takes seconds. Commands
+    are queued and written one at a time by a background thread, which restarts the process as soon
+    as it dies."""
+
+    _DEFAULT_CONFIGURATION = {
+        'args': ['-d', '1'],
+        'binary': 'cec-client',
+        'commandTimeout': 2,
+        'startTimeout': 15
+    }
+
+    # printed by cec-client once the adapter is opened
+    _READY = 'waiting for input'
+
+    def __init__(self, conf=None):
+        conf = KPConfBase(CECClient, conf)
+        self.command_line: List[str] = [conf.binary] + list(conf.args)
+        self.command_timeout = conf.commandTimeout
+        self.start_timeout = conf.startTimeout
+        self.restarts = 0
+        self._spawned = False
+        self._process: Optional[subprocess.Popen] = None
+        # lines printed by the current process, None once it exited
+        self._lines: queue.Queue = queue.Queue()
+        self._commands: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts cec-client in the background, if it is not already"""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='kodiproxy-cec', daemon=True)
+                self._worker.start()
 
-    def pipe(self, cmd: str):
-        process = subprocess.Popen(
-            ['cec-client', '-s', '-d', '1'], stdin=subprocess.PIPE)
-        process.communicate(bytes(cmd, 'ascii'))
+    def stop(self) -> None:
+        """Stops cec-client once the queued commands are done"""
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker:
+            self._commands.put(None)
+            worker.join()
+
+    def pipe(self, cmd: str, expect: Optional[str] = None, timeout: Optional[float] = None) -> Optional[str]:
+        """Sends a command to cec-client.
+
+        If expect is given, waits up to timeout seconds for a line of output containing it and
+        returns it. Otherwise returns as soon as the command is written"""
+        with tracing.stage('cec:' + cmd.partition(' ')[0]):
+            return self._pipe(cmd, expect, timeout)
+
+    def _pipe(self, cmd: str, expect: Optional[str], timeout: Optional[float]) -> Optional[str]:
+        self.start()
+        command = _Command(cmd, expect, self.command_timeout if timeout is None else timeout)
+        self._commands.put(command)
+        # cec-client may have to be restarted first
+        if not command.done.wait(self.start_timeout + command.timeout):
+            command.abandoned = True
+            raise CECError('Timeout while running "{}"'.format(cmd))
+        if command.error:
+            raise command.error
+        return command.result
 
     def switch_on(self) -> None:
         self.pipe('on 0')
 
     def switch_off(self) -> None:
         self.pipe('standby 0')
+
+    def power_status(self) -> str:
+        """Returns the power status of the projector as reported by cec-client"""
+        return self.pipe('pow 0', expect='power status:').partition('power status:')[2].strip()
+
+    def _run(self) -> None:
+        try:
+            self._ensure_process()
+        except CECError as e:
+            LOGGER.error('Could not start cec-client: %s', e)
+        while True:
+            command = self._commands.get()
+            if command is None:
+                break
+            if isinstance(command, _Exited):
+                self._restart(command.process)
+                continue
+            if command.abandoned:
+                continue
+            try:
+                with metrics.CEC_DURATION.time(command.line.partition(' ')[0]):
+                    command.result = self._execute(command)
+            except Exception as e:
+                command.error = e if isinstance(e, CECError) else CECError(str(e))
+            finally:
+                command.done.set()
+        self._close()
+
+    def _restart(self, process: subprocess.Popen) -> None:
+        """Restarts cec-client if the process that exited was the running one, rather than letting
+        the next command wait for it"""
+        if process is not self._process:
+            return
+        try:
+            self._ensure_process()
+        except CECError as e:
+            LOGGER.error('Could not restart cec-client: %s', e)
+
+    def _execute(self, command: _Command) -> Optional[str]:
+        # a command that could not be written because cec-client died is sent again once restarted
+        for _ in range(2):
+            process = self._ensure_process()
+            self._drain()
+            try:
+                process.stdin.write(bytes(command.line + '\n', 'ascii'))
+                process.stdin.flush()
+            except OSError as e:
+                LOGGER.warning('cec-client died: %s', e)
+                self._close()
+                continue
+            LOGGER.debug('CEC command sent: %s', command.line)
+            if command.expect is None:
+                return None
+            return self._expect(command.expect, command.timeout)
+        raise CECError('cec-client is not running')
+
+    def _ensure_process(self) -> subprocess.Popen:
+        if self._process and self._process.poll() is None and not self._process.stdout.closed:
+            return self._process
+        self._close()
+        if self._spawned:
+            LOGGER.warning('cec-client exited, restarting it')
+            self.restarts += 1
+        self._spawned = True
+        start = time.monotonic()
+        try:
+            self._process = subprocess.Popen(
+                self.command_line, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise CECError('Could not run {}: {}'.format(self.command_line[0], e))
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read, args=[self._process, self._lines],
+                         name='kodiproxy-cec-reader', daemon=True).start()
+        try:
+            self._expect(CECClient._READY, self.start_timeout)
+        except CECError:
+            self._close()
+            raise
+        LOGGER.info('cec-client started in %.2fs', time.monotonic() - start)
+        return self._process
+
+    def _read(self, process: subprocess.Popen, lines: queue.Queue) -> None:
+        with process.stdout:
+            for line in process.stdout:
+                lines.put(line.decode('utf-8', errors='replace').rstrip())
+        lines.put(None)
+        self._commands.put(_Exited(process))
+
+    def _drain(self) -> None:
+        """Drops the lines printed before the command, they are not its response"""
+        try:
+            while True:
+                if self._lines.get_nowait() is None:
+                    # keeps the end of the process visible for _expect
+                    self._lines.put(None)
+                    return
+        except queue.Empty:
+            pass
+
+    def _expect(self, expected: str, timeout: float) -> str:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise CECError('cec-client did not answer "{}" in time'.format(expected))
+            if line is None:
+                self._close()
+                raise CECError('cec-client exited')
+            if expected in line:
+                return line
+
+    def _close(self) -> None:
+        process = self._process
+        self._process = None
+        if not process:
+            return
+        try:
+            if process.poll() is None:
+                process.stdin.write(b'q\n')
+                process.stdin.flush()
+            process.stdin.close()
+            process.wait(2)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
@@ -8,6 +8,10 @@ class KPConfiguration:
         with open(path) as conf:
             conf = json.loads(conf.read())
 
+            self.capture = conf.get('capture', None)
+
+            self.cec = conf.get('cec', None)
+
             self.jrpc = conf.get('jrpc', None)
 
             self.logging = conf.get('logging', None)
@@ -15,3 +19,7 @@ class KPConfiguration:
             self.receiver = conf.get('receiver', None)
 
             self.server = conf.get('server', None)
+
+            self.shutdown = conf.get('shutdown', None)
+
+            self.tracing = conf.get('tracing', None)
@@ -0,0 +1,335 @@
+import asyncio
+import collections
+import http.client
+from kp import asynchttp, httputils, metrics
+from kp.types import Headers, Response
+import logging
+import select
+import threading
+import time
+from typing import Any, Deque, Optional, Tuple
+from urllib import parse
+
+LOGGER = logging.getLogger('kodiproxy')
+
+# errors showing that the server closed a kept alive connection before we used it
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                 ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+
+class PoolStats:
+    """Counters of a connection pool"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.retries = 0
+
+    def as_dict(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'retries': self.retries
+        }
+
+    def __str__(self) -> str:
+        return 'hits: {hits}, misses: {misses}, evictions: {evictions}, retries: {retries}'.format(
+            **self.as_dict())
+
+
+class _PoolBase:
+    def __init__(self, url: str, max_size: int, idle_timeout: float, timeout: float, chunk_size: int):
+        url = parse.urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.netloc = url.netloc
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.stats = PoolStats()
+
+    def _request_headers(self, body: bytes, headers: Headers) -> Headers:
+        headers = httputils.relayable_headers(headers or {}, dropped=('host',))
+        headers['host'] = self.netloc
+        headers['content-length'] = str(len(body))
+        return headers
+
+
+class HTTPConnectionPool(_PoolBase):
+    """Thread safe pool of kept alive connections to a single HTTP server.
+
+    At most max_size idle connections are kept. More connections are opened if needed, they are
+    closed once used instead of being returned to the pool."""
+
+    def __init__(self, url: str, max_size: int = 4, idle_timeout: float = 10, timeout: float = 5,
+                 chunk_size: int = 65536):
+        super().__init__(url, max_size, idle_timeout, timeout, chunk_size)
+        self._idle: Deque[Tuple[http.client.HTTPConnection, float]] = collections.deque()
+        self._lock = threading.Lock()
+
+    def _is_stale(self, conn: http.client.HTTPConnection, last_used: float, now: float) -> bool:
+        if now - last_used > self.idle_timeout:
+            return True
+        # an idle connection should have nothing to read. If it has, it is most likely closed
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        return bool(readable)
+
+    def _acquire(self, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                # most recently used first, they are the least likely to have been closed
+                conn, last_used = self._idle.pop()
+                if not self._is_stale(conn, last_used, now):
+                    self.stats.hits += 1
+                    metrics.UPSTREAM_POOL.inc('hit')
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                self.stats.evictions += 1
+                metrics.UPSTREAM_POOL.inc('eviction')
+                conn.close()
+            self.stats.misses += 1
+            metrics.UPSTREAM_POOL.inc('miss')
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def _release(self, conn: http.client.HTTPConnection, reusable: bool) -> None:
+        with self._lock:
+            if reusable and len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def open(self, body: bytes, headers: Headers, retry: bool = False,
+             timeout: Optional[float] = None) -> Tuple[int, 'StreamedBody', Any]:
+        """Posts the body to the server and returns its response, without reading its body.
+
+        If retry is True and a reused connection turns out to be closed, the request is sent
+        again on a new connection. It must only be set for requests that are safe to repeat.
+
+        timeout, which defaults to the one of the pool, applies until the headers of the response
+        are received. The body is read with the timeout of the pool."""
+        headers = self._request_headers(body, headers)
+        timeout = self.timeout if timeout is None else timeout
+        conn, reused = self._acquire(timeout)
+        try:
+            return self._send(conn, body, headers)
+        except STALE_ERRORS as e:
+            if not (reused and retry):
+                raise
+            LOGGER.info('Pooled connection was closed (%s), retrying', e)
+            with self._lock:
+                self.stats.retries += 1
+            metrics.UPSTREAM_POOL.inc('retry')
+            conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=timeout)
+            return self._send(conn, body, headers)
+
+    def request(self, body: bytes, headers: Headers, retry: bool = False,
+                timeout: Optional[float] = None) -> Response:
+        """Same as open, but reads the whole body"""
+        code, res_body, res_headers = self.open(body, headers, retry, timeout)
+        return code, res_body.read(), res_headers
+
+    def _send(self, conn: http.client.HTTPConnection, body: bytes, headers: Headers) -> Tuple[int, 'StreamedBody', Any]:
+        try:
+            conn.request('POST', self.path, body=body, headers=headers)
+            res = conn.getresponse()
+            if conn.sock:
+                # the body may take longer to come than the headers
+                conn.sock.settimeout(self.timeout)
+        except BaseException:
+            conn.close()
+            raise
+        return res.status, StreamedBody(self, conn, res, self.chunk_size), res.msg
+
+    def close(self) -> None:
+        """Closes all the idle connections"""
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+class AsyncHTTPConnectionPool(_PoolBase):
+    """Same as HTTPConnectionPool, for a single event loop"""
+
+    def __init__(self, url: str, max_size: int = 4, idle_timeout: float = 10, timeout: float = 5,
+                 chunk_size: int = 65536):
+        super().__init__(url, max_size, idle_timeout, timeout, chunk_size)
+        self._idle: Deque[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]] = \
+            collections.deque()
+
+    def _is_stale(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                  last_used: float, now: float) -> bool:
+        # the loop already noticed if the server closed the connection or sent something
+        return now - last_used > self.idle_timeout or writer.is_closing() or reader.at_eof()
+
+    async def _acquire(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if not self._is_stale(reader, writer, last_used, now):
+                self.stats.hits += 1
+                metrics.UPSTREAM_POOL.inc('hit')
+                return reader, writer, True
+            self.stats.evictions += 1
+            metrics.UPSTREAM_POOL.inc('eviction')
+            writer.close()
+        self.stats.misses += 1
+        metrics.UPSTREAM_POOL.inc('miss')
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return reader, writer, False
+
+    def _release(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, reusable: bool) -> None:
+        if reusable and len(self._idle) < self.max_size:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def open(self, body: bytes, headers: Headers, retry: bool = False,
+                   timeout: Optional[float] = None) -> Tuple[int, 'AsyncStreamedBody', Headers]:
+        """See HTTPConnectionPool.open. The timeout applies until the headers are received"""
+        return await asyncio.wait_for(self._open(body, headers, retry),
+                                      self.timeout if timeout is None else timeout)
+
+    async def request(self, body: bytes, headers: Headers, retry: bool = False,
+                      timeout: Optional[float] = None) -> Response:
+        """Same as open, but reads the whole body"""
+        code, res_body, res_headers = await self.open(body, headers, retry, timeout)
+        return code, await res_body.read(), res_headers
+
+    async def _open(self, body: bytes, headers: Headers, retry: bool) -> Tuple[int, 'AsyncStreamedBody', Headers]:
+        headers = self._request_headers(body, headers)
+        reader, writer, reused = await self._acquire()
+        try:
+            return await self._send(reader, writer, body, headers)
+        except (asyncio.IncompleteReadError,) + STALE_ERRORS as e:
+            if not (reused and retry):
+                raise
+            LOGGER.info('Pooled connection was closed (%s), retrying', e)
+            self.stats.retries += 1
+            metrics.UPSTREAM_POOL.inc('retry')
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            return await self._send(reader, writer, body, headers)
+
+    async def _send(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    body: bytes, headers: Headers) -> Tuple[int, 'AsyncStreamedBody', Headers]:
+        try:
+            writer.write(asynchttp.serialize_message(
+                'POST {} HTTP/1.1'.format(self.path), headers, body))
+            await writer.drain()
+            code, res_headers = await asynchttp.read_response_head(reader)
+        except BaseException:
+            writer.close()
+            raise
+        return code, AsyncStreamedBody(self, reader, writer, code, res_headers), res_headers
+
+    def close(self) -> None:
+        """Closes all the idle connections"""
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+class StreamedBody:
+    """Body of a response, read from the server as it is iterated over.
+
+    The connection goes back to the pool once the body has been entirely read. It is closed
+    if the body is closed before that."""
+
+    def __init__(self, pool: HTTPConnectionPool, conn: http.client.HTTPConnection,
+                 response: http.client.HTTPResponse, chunk_size: int):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self._chunk_size = chunk_size
+        # None if the server did not announce it
+        self.length: Optional[int] = response.length
+
+    def chunks(self):
+        """Yields the body in pieces of at most chunk_size bytes, as soon as they are received"""
+        received = 0
+        try:
+            while True:
+                chunk = self._response.read1(self._chunk_size)
+                if not chunk:
+                    break
+                received += len(chunk)
+                yield chunk
+            if self.length is not None and received < self.length:
+                raise http.client.IncompleteRead(b'', self.length - received)
+            # lets the connection send another request
+            self._response.close()
+        except BaseException:
+            self.close()
+            raise
+        if self._conn:
+            self._pool._release(self._conn, not self._response.will_close)
+            self._conn = None
+
+    def read(self) -> bytes:
+        """Reads the whole body"""
+        return b''.join(self.chunks())
+
+    def close(self) -> None:
+        """Abandons the body, closing the connection if it was not entirely read"""
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class AsyncStreamedBody:
+    """Same as StreamedBody, for AsyncHTTPConnectionPool"""
+
+    def __init__(self, pool: AsyncHTTPConnectionPool, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, code: int, headers: Headers):
+        self._pool = pool
+        self._reader = reader
+        self._writer = writer
+        self._headers = headers
+        self._has_body = asynchttp.has_body(code)
+        self.length: Optional[int] = None
+        if not self._has_body:
+            self.length = 0
+        elif 'chunked' not in headers.get('transfer-encoding', '').lower() \
+                and 'content-length' in headers:
+            self.length = int(headers['content-length'])
+
+    async def chunks(self):
+        """Yields the body in pieces of at most chunk_size bytes, as soon as they are received.
+        Each piece has to arrive within the timeout of the pool"""
+        try:
+            if self._has_body:
+                pieces = asynchttp.iter_body(
+                    self._reader, self._headers, self._pool.chunk_size)
+                while True:
+                    try:
+                        piece = await asyncio.wait_for(pieces.__anext__(), self._pool.timeout)
+                    except StopAsyncIteration:
+                        break
+                    yield piece
+        except BaseException:
+            self.close()
+            raise
+        if self._writer:
+            # a body running until the end of the connection cannot be followed by anything
+            reusable = self.length is not None or not self._has_body \
+                or 'chunked' in self._headers.get('transfer-encoding', '').lower()
+            reusable = reusable and httputils.wants_keep_alive(
+                'HTTP/1.1', self._headers)
+            self._pool._release(self._reader, self._writer, reusable)
+            self._writer = None
+
+    async def read(self) -> bytes:
+        """Reads the whole body"""
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    def close(self) -> None:
+        """Abandons the body, closing the connection if it was not entirely read"""
+        if self._writer:
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,36 @@
+from kp.types import Headers
+
+# headers that only make sense for a single connection and must not be relayed
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'
+}
+
+
+def lower_headers(headers) -> Headers:
+    """Copies headers from a message to a dict, with lower case names"""
+    return {k.lower(): v for k, v in headers.items()}
+
+
+def relayable_headers(headers, dropped=()) -> Headers:
+    """Copies headers from a message, dropping the ones specific to a connection.
+    The content-length is dropped too, as the sender is responsible for setting it"""
+    res = dict()
+    for k, v in headers.items():
+        k = k.lower()
+        if k not in HOP_BY_HOP_HEADERS and k != 'content-length' and k not in dropped:
+            res[k] = v
+    return res
+
+
+def wants_keep_alive(version: str, headers: Headers) -> bool:
+    """Returns whether the client of a request expects the connection to persist"""
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def chunk(data: bytes) -> bytes:
+    """Frames data as a chunk of a chunked transfer encoded body. Empty data is the last chunk"""
+    return b'%x\r\n' % len(data) + data + b'\r\n'
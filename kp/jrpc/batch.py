@@ -0,0 +1,138 @@
+import json
+from kp.types import Response
+import logging
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LOGGER = logging.getLogger('kodiproxy')
+
+INVALID_REQUEST = -32600
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+# implementation defined server error
+SERVER_UNAVAILABLE = -32000
+
+
+def error_response(req_id: Any, code: int, message: str) -> dict:
+    """Builds a jrpc error response"""
+    return {
+        'jsonrpc': '2.0',
+        'error': {'code': code, 'message': message},
+        'id': req_id
+    }
+
+
+def _is_notification(req: Any) -> bool:
+    return isinstance(req, dict) and 'id' not in req
+
+
+def encode(response: Any) -> Response:
+    """Encodes a jrpc response object. None means there is nothing to answer"""
+    if response is None:
+        return 204, b'', {'content-length': '0'}
+    payload = bytes(json.dumps(response), 'utf-8')
+    return 200, payload, {
+        'content-length': str(len(payload)),
+        'content-type': 'application/json; charset=utf-8'
+    }
+
+
+def error_for(request: bytes, code: int, message: str) -> Response:
+    """Builds the jrpc error response to an encoded request or batch, with the matching ids"""
+    try:
+        req = json.loads(request)
+    except ValueError:
+        req = None
+    if isinstance(req, list):
+        return encode([error_response(r.get('id') if isinstance(r, dict) else None, code, message)
+                       for r in req if not _is_notification(r)] or None)
+    return encode(error_response(req.get('id') if isinstance(req, dict) else None, code, message))
+
+
+class BatchPlan:
+    """Splits a jrpc batch between the requests handled by overloaders and the ones forwarded
+    together to the jrpc server, then puts the responses back together in the order of the batch"""
+
+    def __init__(self, batch: list, get_overloader: Callable[[dict], Any]):
+        self.batch = batch
+        # (position in the batch, request, overloader)
+        self.local: List[Tuple[int, dict, Any]] = []
+        self.upstream: List[Tuple[int, Any]] = []
+        for index, req in enumerate(batch):
+            overloader = get_overloader(req) if isinstance(req, dict) else None
+            if overloader:
+                self.local.append((index, req, overloader))
+            else:
+                self.upstream.append((index, req))
+
+    def upstream_request(self) -> Optional[bytes]:
+        """The batch to send to the jrpc server, if any"""
+        if not self.upstream:
+            return None
+        return bytes(json.dumps([req for _, req in self.upstream]), 'utf-8')
+
+    @staticmethod
+    def run_local(req: dict, overloader: Any, forwarder: Any = None) -> Optional[dict]:
+        """Runs an overloader on a request of the batch and returns its response object. forwarder
+        is the handler of the batch, through which the overloader can forward queries"""
+        req_id = req.get('id', None)
+        try:
+            code, payload, _ = overloader.handle_query(req, forwarder)
+            response = json.loads(payload)
+            if code >= 400:
+                response = error_response(
+                    req_id, INVALID_PARAMS if code == 400 else INTERNAL_ERROR, str(response.get('result')))
+        except Exception as e:
+            LOGGER.error('Something went wrong with the overloader: %s', e)
+            LOGGER.info('Trace: %s', traceback.format_exc())
+            response = error_response(req_id, INTERNAL_ERROR, 'Internal error')
+        return None if _is_notification(req) else response
+
+    def _upstream_responses(self, upstream: Optional[Response]) -> Tuple[Dict[Any, List[dict]], List[dict]]:
+        """Indexes the responses of the jrpc server by id. Those that cannot be matched are
+        returned aside"""
+        by_id: Dict[Any, List[dict]] = dict()
+        unmatched: List[dict] = []
+        if upstream is None:
+            return by_id, unmatched
+        code, payload, _ = upstream
+        try:
+            responses = json.loads(payload) if payload else []
+            if code >= 400:
+                raise ValueError('jrpc server answered with code {}'.format(code))
+        except ValueError as e:
+            LOGGER.warning('Invalid batch response from the jrpc server: %s', e)
+            for _, req in self.upstream:
+                if not _is_notification(req):
+                    req_id = req.get('id') if isinstance(req, dict) else None
+                    unmatched.append(error_response(
+                        req_id, INTERNAL_ERROR, 'Invalid response of the jrpc server'))
+            return by_id, unmatched
+        if not isinstance(responses, list):
+            # happens when the server could not parse the batch at all
+            responses = [responses]
+        for response in responses:
+            req_id = response.get('id') if isinstance(response, dict) else None
+            if req_id is None:
+                unmatched.append(response)
+            else:
+                by_id.setdefault(json.dumps(req_id), []).append(response)
+        return by_id, unmatched
+
+    def assemble(self, local: Dict[int, Optional[dict]], upstream: Optional[Response]) -> Response:
+        """Builds the response to the batch, from the responses of the overloaders indexed by their
+        position in the batch and the response of the jrpc server"""
+        by_id, unmatched = self._upstream_responses(upstream)
+        upstream_indexes = {index for index, _ in self.upstream}
+        responses = []
+        for index, req in enumerate(self.batch):
+            if index in upstream_indexes:
+                if not isinstance(req, dict) or _is_notification(req):
+                    continue
+                matches = by_id.get(json.dumps(req.get('id')))
+                if matches:
+                    responses.append(matches.pop(0))
+            elif local.get(index) is not None:
+                responses.append(local[index])
+        responses.extend(unmatched)
+        return encode(responses or None)
@@ -0,0 +1,187 @@
+import collections
+import fnmatch
+import json
+from kp import metrics
+from kp.jrpc import notifications
+from kp.types import Response
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+LOGGER = logging.getLogger('kodiproxy')
+
+# notifications of Kodi after which the cached responses of a namespace are outdated
+INVALIDATING_NOTIFICATIONS = {
+    'AudioLibrary.OnCleanFinished': ('AudioLibrary.', 'Files.'),
+    'AudioLibrary.OnRemove': ('AudioLibrary.', 'Files.'),
+    'AudioLibrary.OnScanFinished': ('AudioLibrary.', 'Files.'),
+    'AudioLibrary.OnUpdate': ('AudioLibrary.', 'Files.'),
+    'VideoLibrary.OnCleanFinished': ('VideoLibrary.', 'Files.'),
+    'VideoLibrary.OnRemove': ('VideoLibrary.', 'Files.'),
+    'VideoLibrary.OnScanFinished': ('VideoLibrary.', 'Files.'),
+    'VideoLibrary.OnUpdate': ('VideoLibrary.', 'Files.')
+}
+
+
+def request_key(req: dict) -> str:
+    """Canonical representation of the method and parameters of a request"""
+    return json.dumps([req.get('method'), req.get('params')], sort_keys=True, separators=(',', ':'))
+
+
+class CacheStats:
+    """Counters of the response cache"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+
+class _Entry:
+    def __init__(self, body: bytes, headers: dict, expires: float, size: int):
+        # the serialized response without its id
+        self.body = body
+        self.headers = headers
+        self.expires = expires
+        self.size = size
+
+
+class ResponseCache:
+    """LRU cache of the responses of the jrpc server to read only methods.
+
+    ttls maps method names to the number of seconds their responses are kept. Names can be patterns
+    like VideoLibrary.Get*. The cache holds at most max_bytes of responses."""
+
+    def __init__(self, ttls: Dict[str, float], max_bytes: int):
+        self._exact = {k: v for k, v in ttls.items() if not any(
+            c in k for c in '*?[')}
+        self._patterns = [(k, v) for k, v in ttls.items() if k not in self._exact]
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = CacheStats()
+        self._entries: 'collections.OrderedDict[str, _Entry]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return bool(self._exact or self._patterns)
+
+    def ttl(self, method: Any) -> Optional[float]:
+        """Returns how long the responses of the method are kept, None if they are not cached"""
+        if not isinstance(method, str):
+            return None
+        ttl = self._exact.get(method)
+        if ttl is None:
+            for pattern, pattern_ttl in self._patterns:
+                if fnmatch.fnmatchcase(method, pattern):
+                    return pattern_ttl
+        return ttl
+
+    @staticmethod
+    def _with_id(body: bytes, req_id: Any) -> bytes:
+        prefix = b'{"id": ' + bytes(json.dumps(req_id), 'utf-8')
+        return prefix + b'}' if body == b'{}' else prefix + b', ' + body[1:]
+
+    def get(self, req: dict) -> Optional[Response]:
+        """Returns the cached response to the request, with its id, if there is a fresh one"""
+        key = request_key(req)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires > now:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                metrics.CACHE_LOOKUPS.inc('hit')
+            else:
+                if entry:
+                    self._remove(key)
+                self.stats.misses += 1
+                metrics.CACHE_LOOKUPS.inc('miss')
+                return None
+        payload = ResponseCache._with_id(entry.body, req.get('id'))
+        headers = dict(entry.headers)
+        headers['content-length'] = str(len(payload))
+        return 200, payload, headers
+
+    def put(self, req: dict, response: Response) -> None:
+        """Stores the response to a request if it is a success"""
+        ttl = self.ttl(req.get('method'))
+        code, payload, headers = response
+        if ttl is None or code != 200:
+            return
+        try:
+            decoded = json.loads(payload)
+        except ValueError:
+            return
+        if not isinstance(decoded, dict) or 'result' not in decoded:
+            return
+        decoded.pop('id', None)
+        body = bytes(json.dumps(decoded), 'utf-8')
+        key = request_key(req)
+        size = len(body) + len(key)
+        if size > self.max_bytes:
+            return
+        headers = {k: v for k, v in headers.items() if k != 'content-length'}
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(
+                body, headers, time.monotonic() + ttl, size)
+            self.size += size
+            metrics.CACHE_ENTRIES.inc()
+            metrics.CACHE_BYTES.inc(amount=size)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+                metrics.CACHE_REMOVALS.inc('eviction')
+
+    def _remove(self, key: str) -> None:
+        size = self._entries.pop(key).size
+        self.size -= size
+        metrics.CACHE_ENTRIES.dec()
+        metrics.CACHE_BYTES.dec(amount=size)
+
+    def invalidate(self, prefix: str = '') -> None:
+        """Forgets the responses of the methods starting with prefix"""
+        with self._lock:
+            # the method is the first item of the key
+            key_prefix = '["' + prefix
+            for key in [k for k in self._entries if k.startswith(key_prefix)]:
+                self._remove(key)
+                self.stats.invalidations += 1
+                metrics.CACHE_REMOVALS.inc('invalidation')
+        LOGGER.debug('Cache invalidated for "%s"', prefix)
+
+    def on_notification(self, method: str, params: Any) -> None:
+        """To be called with the notifications of Kodi"""
+        if method == notifications.DISCONNECTED:
+            self.invalidate()
+        for prefix in INVALIDATING_NOTIFICATIONS.get(method, ()):
+            self.invalidate(prefix)
+
+    def on_forward(self, req: Any, read_only: bool) -> None:
+        """To be called with the requests forwarded to the jrpc server. Modifying a library
+        through the proxy makes its cached responses outdated"""
+        if read_only or not self or not isinstance(req, dict):
+            return
+        method = req.get('method')
+        if isinstance(method, str) and method.startswith(('VideoLibrary.', 'AudioLibrary.')):
+            self.invalidate(method.partition('.')[0] + '.')
+            self.invalidate('Files.')
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'hits': self.stats.hits,
+                'misses': self.stats.misses,
+                'hit_rate': self.stats.hit_rate(),
+                'evictions': self.stats.evictions,
+                'invalidations': self.stats.invalidations
+            }
@@ -1,32 +1,90 @@
 from abc import abstractmethod, ABCMeta
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+import contextvars
+import functools
+import http.client
 import json
 from unittest.mock import Base
+from kp import httputils, metrics, tracing
+from kp.breaker import BackendGuard, CircuitOpenError
 from kp.confbase import KPConfBase
+from kp.httppool import AsyncHTTPConnectionPool, HTTPConnectionPool
+from kp.jrpc import batch
+from kp.jrpc.cache import ResponseCache
+from kp.jrpc.notifications import KodiNotificationListener
+from kp.jrpc.singleflight import SingleFlight
 from kp.types import Headers, Response
 import logging
 from socket import timeout
-from urllib import error, request
+from urllib import error, parse
+import time
 import traceback
-from typing import Any, Callable, Dict, Tuple
+from typing import Any, Dict, Tuple
 
 LOGGER = logging.getLogger('kodiproxy')
 
+# methods that do not start with Get but do not modify anything either
+_READ_ONLY_METHODS = {'JSONRPC.Introspect', 'JSONRPC.Permission',
+                      'JSONRPC.Ping', 'JSONRPC.Version'}
+
+
+def is_read_only(req: Any) -> bool:
+    """Returns whether a decoded jrpc request only reads data, and so can safely be sent twice"""
+    if isinstance(req, list):
+        return bool(req) and all(map(is_read_only, req))
+    if not isinstance(req, dict):
+        return False
+    method = req.get('method')
+    if not isinstance(method, str):
+        return False
+    return method.partition('.')[2].startswith('Get') or method in _READ_ONLY_METHODS
+
+
+class RequestContext:
+    """What an overloader knows of the request it handles. The overloaders are shared by all the
+    requests, so everything specific to one of them is kept here"""
+
+    def __init__(self, req_id: Any, headers: Headers = None, forwarder: 'JRPCHandler' = None):
+        self.id = req_id
+        self.headers = headers or dict()
+        # handler of the request, to forward queries to the jrpc server
+        self.forwarder = forwarder
+
+    def forward(self, method: str, params: dict) -> Response:
+        """Forwards a query to the jrpc server, with the id and the headers of the request"""
+        query = {
+            'method': method,
+            'params': params
+        }
+        payload, headers = JRPCOverloader._enrich_http(query, self.id, dict(self.headers))
+
+        handler = self.forwarder
+        read_only = is_read_only(query)
+        if handler.single_flight and handler.single_flight.handles(query):
+            query['id'] = self.id
+            return handler.single_flight.do(
+                query, lambda: handler.forward(payload, headers, read_only, method=method))
+        return handler.forward(payload, headers, read_only, method=method)
+
 
 class JRPCOverloader(metaclass=ABCMeta):
-    """Base class of the JRPC overloaders"""
+    """Base class of the JRPC overloaders. A single instance handles all the requests of the
+    methods it is registered on, possibly at the same time: it must not keep any state about them"""
 
-    def handle_query(self, query: dict) -> Response:
-        self.id = query.get('id', None)
-        code, payload, headers = self.overload_query(
-            query.get('params', None))
-        response, headers = self._enrich_http({'result': payload}, headers)
+    def handle_query(self, query: dict, forwarder: 'JRPCHandler' = None) -> Response:
+        context = RequestContext(query.get('id', None),
+                                 forwarder.headers if forwarder else None, forwarder)
+        code, payload, headers = self.overload_query(query.get('params', None), context)
+        response, headers = self._enrich_http({'result': payload}, context.id, headers)
         return code, response, headers
 
-    def _enrich_http(self, payload: dict, headers: Headers = None) -> Tuple[bytes, Headers]:
+    @staticmethod
+    def _enrich_http(payload: dict, req_id: Any, headers: Headers = None) -> Tuple[bytes, Headers]:
         headers = headers or dict()
         response = {
             'jsonrpc': '2.0',
-            'id': self.id
+            'id': req_id
         }
         response.update(payload)
         response = bytes(json.dumps(response), 'utf-8')
@@ -35,7 +93,7 @@ class JRPCOverloader(metaclass=ABCMeta):
         return response, headers
 
     @abstractmethod
-    def overload_query(self, params: Any) -> Tuple[int, Any, Headers]:
+    def overload_query(self, params: Any, context: RequestContext) -> Tuple[int, Any, Headers]:
         pass
 
 
@@ -43,21 +101,35 @@ class JRPCHandler:
     """Dispatches the jrpc requests either to the actual JRPC server or an overloader"""
 
     def __init__(self, target: str,
-                 overloaders: Dict[str, Callable[[], JRPCOverloader]],
-                 jrpc_request: bytes, headers: Headers):
+                 overloaders: Dict[str, JRPCOverloader],
+                 jrpc_request: bytes, headers: Headers,
+                 pool: HTTPConnectionPool = None, async_pool: AsyncHTTPConnectionPool = None,
+                 executor: Executor = None, cache: ResponseCache = None,
+                 single_flight: SingleFlight = None, guard: BackendGuard = None):
         self.headers = headers
         self.jrpc_request = jrpc_request
         self.overloaders = overloaders
         self.target = target
+        # without pools, a new connection is used for each request
+        self.pool = pool or HTTPConnectionPool(target, max_size=0)
+        self.async_pool = async_pool or AsyncHTTPConnectionPool(
+            target, max_size=0)
+        # runs the overloaded requests of batches. Without it, they are run one after the other
+        self.executor = executor
+        self.cache = cache
+        self.single_flight = single_flight
+        # circuit breaker and adaptive timeouts of the jrpc server
+        self.guard = guard
+        # known once dispatched, for the metrics
+        self.method = 'other'
+        self.route = 'forwarded'
 
     def _read(self, response: Any) -> bytes:
         length = response.info()['content-length']
         return response.read(int(length)) if length else response.read()
 
     def _get_overloader(self, req: dict) -> JRPCOverloader:
-        provider = self.overloaders.get(
-            req.get('method', '__none__'), None)
-        return provider(self) if provider else None
+        return self.overloaders.get(req.get('method', '__none__'), None)
 
     def _return_error(self, code: int, payload) -> Response:
         return code, payload, {'content-type': 'text/plain'}
@@ -65,91 +137,294 @@ class JRPCHandler:
     def _forward_error(self, err: error.HTTPError) -> Response:
         return err.getcode(), self._read(err), err.info()
 
-    def dispatch(self) -> Response:
-        """Handles a jrpc request."""
+    def _decode(self) -> Tuple[Any, JRPCOverloader]:
         req = None
         overloader = None
         try:
-            req = json.loads(self.jrpc_request)
-            overloader = self._get_overloader(req)
+            with tracing.stage('decode'):
+                req = json.loads(self.jrpc_request)
+            if isinstance(req, list):
+                self.method = self.route = 'batch'
+            else:
+                self.method = metrics.method_label(req.get('method'))
+                overloader = self._get_overloader(req)
+                if overloader:
+                    self.route = 'overloaded'
         except Exception as e:
             LOGGER.warning(
                 'Could not decode jrpc request with error "%s". Will try forwarding it', e)
             LOGGER.debug(traceback.format_exc())
+        return req, overloader
+
+    def _run_overloader(self, overloader: JRPCOverloader, req: dict) -> Response:
+        try:
+            with tracing.stage('overloader'):
+                return overloader.handle_query(req, self)
+        except error.HTTPError as e:
+            return self._forward_error(e)
+        except Exception as e:
+            LOGGER.error('Something went wrong with the overloader: %s', e)
+            LOGGER.info('Trace: %s', traceback.format_exc())
+            return 500, bytes('Unkown error occurred', 'ascii'), {}
+
+    def dispatch(self) -> Response:
+        """Handles a jrpc request."""
+        req, overloader = self._decode()
+        if isinstance(req, list):
+            return self._dispatch_batch(req)
         if overloader:
-            try:
-                return overloader.handle_query(req)
-            except error.HTTPError as e:
-                return self._forward_error(e)
-            except Exception as e:
-                LOGGER.error('Something went wrong with the overloader: %s', e)
-                LOGGER.info('Trace: %s', traceback.format_exc())
-                return 500, bytes('Unkown error occurred', 'ascii'), {}
-        return self.forward(self.jrpc_request, self.headers)
-
-    def forward(self, jrpc_request: bytes, headers: Headers) -> Response:
-        """Send a jrpc request to the actual jrpc server"""
+            return self._run_overloader(overloader, req)
+        read_only = is_read_only(req)
+        if self._is_cached(req):
+            return self._get_cached(req) or self._store(req, self._forward_buffered(req))
+        if self.single_flight and self.single_flight.handles(req):
+            return self._forward_buffered(req)
+        if self.cache:
+            self.cache.on_forward(req, read_only)
+        # the response does not need to be parsed, so it is streamed back to the client
+        return self.forward(self.jrpc_request, self.headers, read_only, stream=True)
+
+    async def dispatch_async(self) -> Response:
+        """Handles a jrpc request from an event loop.
+
+        Forwarded requests do not block the loop. Overloaders are blocking, so they are run in the
+        default executor of the loop."""
+        req, overloader = self._decode()
+        if isinstance(req, list):
+            return await self._dispatch_batch_async(req)
+        if overloader:
+            # the executor does not carry the context, which holds the trace
+            return await asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run, self._run_overloader, overloader, req)
+        read_only = is_read_only(req)
+        if self._is_cached(req):
+            return self._get_cached(req) or self._store(req, await self._forward_buffered_async(req))
+        if self.single_flight and self.single_flight.handles(req):
+            return await self._forward_buffered_async(req)
+        if self.cache:
+            self.cache.on_forward(req, read_only)
+        return await self.forward_async(self.jrpc_request, self.headers, read_only, stream=True)
+
+    def _is_cached(self, req: Any) -> bool:
+        return bool(self.cache) and isinstance(req, dict) and self.cache.ttl(req.get('method')) is not None
+
+    def _get_cached(self, req: dict) -> Response:
+        response = self.cache.get(req)
+        if response:
+            self.route = 'cached'
+        return response
+
+    def _store(self, req: dict, response: Response) -> Response:
+        self.cache.put(req, response)
+        return response
+
+    def _forward_buffered(self, req: dict) -> Response:
+        """Forwards a read only request, sharing the call with identical requests if possible"""
+        if self.single_flight and self.single_flight.handles(req):
+            return self.single_flight.do(req, lambda: self.forward(self.jrpc_request, self.headers, True))
+        return self.forward(self.jrpc_request, self.headers, True)
+
+    async def _forward_buffered_async(self, req: dict) -> Response:
+        if self.single_flight and self.single_flight.handles(req):
+            return await self.single_flight.do_async(
+                req, lambda: self.forward_async(self.jrpc_request, self.headers, True))
+        return await self.forward_async(self.jrpc_request, self.headers, True)
+
+    def _plan_batch(self, req: list) -> batch.BatchPlan:
+        plan = batch.BatchPlan(req, self._get_overloader)
+        LOGGER.debug('Batch of %d requests, %d overloaded',
+                     len(req), len(plan.local))
+        return plan
+
+    def _dispatch_batch(self, req: list) -> Response:
+        """Runs the overloaded requests of a batch on the executor while the others are forwarded
+        to the jrpc server as a single batch"""
+        if not req:
+            return batch.encode(batch.error_response(None, batch.INVALID_REQUEST, 'Invalid Request'))
+        plan = self._plan_batch(req)
+        if not plan.local:
+            return self.forward(self.jrpc_request, self.headers, is_read_only(req), stream=True)
+        if self.executor:
+            results = [(index, self.executor.submit(contextvars.copy_context().run,
+                                                    batch.BatchPlan.run_local, query, overloader, self))
+                       for index, query, overloader in plan.local]
+        upstream = plan.upstream_request()
+        if upstream:
+            upstream = self.forward(upstream, self.headers, is_read_only(
+                [query for _, query in plan.upstream]))
+        if self.executor:
+            local = {index: future.result() for index, future in results}
+        else:
+            local = {index: batch.BatchPlan.run_local(query, overloader, self)
+                     for index, query, overloader in plan.local}
+        return plan.assemble(local, upstream)
+
+    async def _dispatch_batch_async(self, req: list) -> Response:
+        """Same as _dispatch_batch, using the default executor of the loop"""
+        if not req:
+            return batch.encode(batch.error_response(None, batch.INVALID_REQUEST, 'Invalid Request'))
+        plan = self._plan_batch(req)
+        if not plan.local:
+            return await self.forward_async(self.jrpc_request, self.headers, is_read_only(req), stream=True)
+        loop = asyncio.get_running_loop()
+        results = [loop.run_in_executor(None, contextvars.copy_context().run,
+                                        batch.BatchPlan.run_local, query, overloader, self)
+                   for _, query, overloader in plan.local]
+        upstream = plan.upstream_request()
+        if upstream:
+            upstream = await self.forward_async(upstream, self.headers, is_read_only(
+                [query for _, query in plan.upstream]))
+        local = dict(zip([index for index, _, _ in plan.local], await asyncio.gather(*results)))
+        return plan.assemble(local, upstream)
+
+    def _relay(self, code: int, payload, headers) -> Response:
+        """Prepares a response of the jrpc server to be sent back. The payload is either bytes or a
+        streamed body"""
+        LOGGER.debug('Received response with code %s', code)
+        if code >= 400:
+            LOGGER.warning(
+                'Request to the jrpc server failed with code: %s', code)
+        headers = httputils.relayable_headers(headers)
+        if isinstance(payload, bytes):
+            LOGGER.debug('Payload received: %s', payload)
+            headers['content-length'] = str(len(payload))
+        elif payload.length is not None:
+            headers['content-length'] = str(payload.length)
+        return code, payload, headers
+
+    def _unavailable(self, jrpc_request: bytes) -> Response:
+        LOGGER.warning('The jrpc server is unavailable, the request is not forwarded')
+        metrics.UPSTREAM_ERRORS.inc('unavailable')
+        code, payload, headers = batch.error_for(
+            jrpc_request, batch.SERVER_UNAVAILABLE, 'Kodi is unavailable')
+        return 503, payload, headers
+
+    def forward(self, jrpc_request: bytes, headers: Headers, idempotent: bool = False,
+                stream: bool = False, method: str = None) -> Response:
+        """Send a jrpc request to the actual jrpc server.
+
+        idempotent tells whether the request can be sent again if the pooled connection was closed.
+        If stream is True, the payload of the response is a StreamedBody instead of bytes.
+        method, which defaults to the one of the handled request, selects the adaptive timeout."""
         LOGGER.debug('Forwarding query to jrpc server %s: %s',
                      self.target, jrpc_request)
-        req = request.Request(self.target,
-                              data=jrpc_request,
-                              headers=headers)
+        call = functools.partial(self.pool.open if stream else self.pool.request,
+                                 jrpc_request, headers, idempotent)
+        start = time.perf_counter()
         try:
-            with request.urlopen(req, timeout=5) as res:
-                LOGGER.debug('Received response with code %s', res.getcode())
-                payload = self._read(res)
-                LOGGER.debug('Payload received: %s', payload)
-                return res.getcode(), payload, res.info()
+            with tracing.stage('forward'):
+                if self.guard is None:
+                    response = call()
+                else:
+                    response = self.guard.call(
+                        lambda t: call(timeout=t), metrics.method_label(method or self.method))
+        except CircuitOpenError:
+            return self._unavailable(jrpc_request)
         except timeout:
             LOGGER.error('Request to jrpc server timeouted')
+            metrics.UPSTREAM_ERRORS.inc('timeout')
             return self._return_error(408, b'Request to the jrpc server timeouted')
-        except error.HTTPError as e:
-            LOGGER.warning(
-                'Request to the jrpc server failed with error: %s', e)
-            return self._forward_error(e)
         except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc('error')
             LOGGER.error(
                 'Something went wrong while calling the jrpc server: %s', e)
             LOGGER.info('Trace: %s', traceback.format_exc())
             return self._return_error(500, b'Unknown error')
+        metrics.UPSTREAM_DURATION.observe(time.perf_counter() - start)
+        return self._relay(*response)
 
-
-class JRPCOverloaderWithHandler(JRPCOverloader):
-    """Base class for overloaders able to forward queries the jrpc server"""
-
-    def __init__(self, handler: JRPCHandler):
-        super().__init__()
-        self.jrpc_handler = handler
-
-    def forward(self, method: str, params: dict) -> Response:
-        """Forwards a query to the jrpc server"""
-        payload = {
-            'method': method,
-            'params': params
-        }
-        headers = self.jrpc_handler.headers
-        payload, headers = self._enrich_http(payload, headers)
-
-        return self.jrpc_handler.forward(payload, headers)
+    async def forward_async(self, jrpc_request: bytes, headers: Headers, idempotent: bool = False,
+                            stream: bool = False) -> Response:
+        """Send a jrpc request to the actual jrpc server without blocking the event loop.
+        If stream is True, the payload of the response is an AsyncStreamedBody"""
+        LOGGER.debug('Forwarding query to jrpc server %s: %s',
+                     self.target, jrpc_request)
+        call = functools.partial(self.async_pool.open if stream else self.async_pool.request,
+                                 jrpc_request, headers, idempotent)
+        start = time.perf_counter()
+        try:
+            with tracing.stage('forward'):
+                if self.guard is None:
+                    response = await call()
+                else:
+                    response = await self.guard.call_async(
+                        lambda t: call(timeout=t), metrics.method_label(self.method))
+        except CircuitOpenError:
+            return self._unavailable(jrpc_request)
+        except asyncio.TimeoutError:
+            LOGGER.error('Request to jrpc server timeouted')
+            metrics.UPSTREAM_ERRORS.inc('timeout')
+            return self._return_error(408, b'Request to the jrpc server timeouted')
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc('error')
+            LOGGER.error(
+                'Something went wrong while calling the jrpc server: %s', e)
+            LOGGER.info('Trace: %s', traceback.format_exc())
+            return self._return_error(500, b'Unknown error')
+        metrics.UPSTREAM_DURATION.observe(time.perf_counter() - start)
+        return self._relay(*response)
 
 
 class JRPCServer:
     """Provides jrpc handler for request, with set targets and overloaders"""
 
     _DEFAULT_CONFIGURATION = {
-        'target': 'http://localhost:8081/jsonrpc'
+        'batchWorkers': 4,
+        'breakerFailures': 5,
+        'breakerResetTimeout': 5,
+        'cacheMaxBytes': 16 * 1024 * 1024,
+        'cacheTtl': {},
+        'coalescedMethods': ['Application.GetProperties', 'Player.GetActivePlayers', 'Player.GetItem',
+                             'Player.GetProperties', 'XBMC.GetInfoBooleans', 'XBMC.GetInfoLabels'],
+        'minTimeout': 1,
+        'notificationPort': 9090,
+        'poolIdleTimeout': 10,
+        'poolSize': 4,
+        'streamChunkSize': 65536,
+        'target': 'http://localhost:8081/jsonrpc',
+        'timeout': 5
     }
 
     def __init__(self, conf):
         conf = KPConfBase(JRPCServer, conf)
         LOGGER.info('JRPC configuration:\n%s', conf)
-        self.overloaders: Dict[str, Callable[[
-            JRPCHandler], JRPCOverloader]] = {}
+        self.overloaders: Dict[str, JRPCOverloader] = {}
         self.target = conf.target
+        self.pool = HTTPConnectionPool(
+            conf.target, conf.poolSize, conf.poolIdleTimeout, conf.timeout, conf.streamChunkSize)
+        # only used by the asyncio engine, from its event loop
+        self.async_pool = AsyncHTTPConnectionPool(
+            conf.target, conf.poolSize, conf.poolIdleTimeout, conf.timeout, conf.streamChunkSize)
+        self.executor = ThreadPoolExecutor(
+            max_workers=conf.batchWorkers, thread_name_prefix='kodiproxy-batch')
+        self.cache = ResponseCache(conf.cacheTtl, conf.cacheMaxBytes)
+        self.guard = BackendGuard('kodi', min(conf.minTimeout, conf.timeout), conf.timeout,
+                                  conf.breakerFailures, conf.breakerResetTimeout,
+                                  failures=(OSError, http.client.HTTPException, asyncio.TimeoutError))
+        # only read only methods can safely share their responses
+        self.single_flight = SingleFlight(
+            [m for m in conf.coalescedMethods if is_read_only({'method': m})])
+        self.notification_listener = None
+        if self.cache and conf.notificationPort:
+            # the library notifications tell when the cached responses are outdated
+            self.notification_listener = KodiNotificationListener(
+                parse.urlsplit(conf.target).hostname, conf.notificationPort)
+            self.notification_listener.add_listener(self.cache.on_notification)
+            self.notification_listener.start()
+
+    def close(self) -> None:
+        """Stops listening to the notifications and closes the connections to the jrpc server"""
+        if self.notification_listener:
+            self.notification_listener.stop()
+        self.executor.shutdown(wait=True)
+        self.pool.close()
 
     def get_handler(self, jrpc_request: bytes, headers: Headers) -> JRPCHandler:
-        return JRPCHandler(self.target, self.overloaders, jrpc_request, headers)
+        return JRPCHandler(self.target, self.overloaders, jrpc_request, headers,
+                           self.pool, self.async_pool, self.executor, self.cache, self.single_flight,
+                           self.guard)
 
-    def register_overloader(self, method: str, overloader_provider: Callable[[JRPCHandler], JRPCOverloader]) -> None:
-        """Register an overloader provider on a jrpc method"""
-        self.overloaders[method] = overloader_provider
+    def register_overloader(self, method: str, overloader: JRPCOverloader) -> None:
+        """Register an overloader on a jrpc method. The same overloader handles all its requests"""
+        self.overloaders[method] = overloader
+        metrics.register_method(method)
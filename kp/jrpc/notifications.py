@@ -0,0 +1,100 @@
+import codecs
+import json
+import logging
+import socket
+import threading
+from typing import Any, Callable, List
+
+LOGGER = logging.getLogger('kodiproxy')
+
+Listener = Callable[[str, Any], None]
+
+# given to the listeners when the connection is lost, as notifications may have been missed
+DISCONNECTED = 'KodiProxy.OnDisconnected'
+
+
+class KodiNotificationListener:
+    """Listens to the notifications Kodi pushes on its raw TCP jrpc interface (port 9090 by
+    default) and gives them to the registered listeners.
+
+    The connection is reopened with an increasing delay whenever it is lost."""
+
+    _MIN_RETRY_DELAY = 1
+    _MAX_RETRY_DELAY = 60
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.listeners: List[Listener] = []
+        self._stop = threading.Event()
+        self._socket = None
+        self._thread = None
+
+    def add_listener(self, listener: Listener) -> None:
+        self.listeners.append(listener)
+
+    def start(self) -> None:
+        """Starts listening in a background thread"""
+        self._thread = threading.Thread(
+            target=self._run, name='kodiproxy-notifications', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        sock = self._socket
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        delay = KodiNotificationListener._MIN_RETRY_DELAY
+        while not self._stop.is_set():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=5) as sock:
+                    LOGGER.info('Listening to Kodi notifications on %s:%d',
+                                self.host, self.port)
+                    sock.settimeout(None)
+                    self._socket = sock
+                    delay = KodiNotificationListener._MIN_RETRY_DELAY
+                    self._read(sock)
+            except OSError as e:
+                LOGGER.warning('Connection to Kodi notifications failed: %s', e)
+            if self._socket:
+                self._socket = None
+                self._notify(DISCONNECTED, None)
+            if self._stop.wait(delay):
+                break
+            delay = min(delay * 2, KodiNotificationListener._MAX_RETRY_DELAY)
+
+    def _read(self, sock: socket.socket) -> None:
+        decoder = json.JSONDecoder()
+        # a character can be split between two reads
+        utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buffer = ''
+        while not self._stop.is_set():
+            data = sock.recv(65536)
+            if not data:
+                return
+            # the stream is a sequence of json objects without separators
+            buffer += utf8.decode(data)
+            while buffer:
+                buffer = buffer.lstrip()
+                try:
+                    message, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    break
+                buffer = buffer[end:]
+                if isinstance(message, dict) and 'method' in message and 'id' not in message:
+                    self._notify(message['method'], message.get('params'))
+
+    def _notify(self, method: str, params: Any) -> None:
+        LOGGER.debug('Kodi notification: %s', method)
+        for listener in self.listeners:
+            try:
+                listener(method, params)
+            except Exception as e:
+                LOGGER.error('Notification listener failed: %s', e)
@@ -1,6 +1,7 @@
-from kp.avreceiver import AVReceiver
+from kp.actionplan import ActionPlan
+from kp.avreceiver import BaseAVReceiver
 from kp.cecclient import CECClient
-from kp.jrpc.jrpcserver import JRPCOverloader, JRPCOverloaderWithHandler
+from kp.jrpc.jrpcserver import JRPCOverloader, RequestContext
 from kp.jrpc.volumeoverloaders import JRPCAVReceiverOverloader
 from kp.types import Response
 
@@ -8,7 +9,7 @@ from kp.types import Response
 class SystemPropertiesOverloader(JRPCOverloader):
     """Overrides what the Kodi is supposed to be able to do in terms of powering off etc."""
 
-    def overload_query(self, params) -> Response:
+    def overload_query(self, params, context: RequestContext) -> Response:
         res = dict()
         for key in params['properties']:
             res[key] = key == 'canreboot'
@@ -16,13 +17,17 @@ class SystemPropertiesOverloader(JRPCOverloader):
 
 
 class ApplicationQuitOverloader(JRPCAVReceiverOverloader):
-    """Class to intercept queries quit Kodi"""
+    """Class to intercept queries quit Kodi. The receiver and the projector are switched off at the
+    same time"""
 
-    def __init__(self, receiver: AVReceiver):
-        super().__init__(None, receiver)
-        self.cecclient = CECClient()
+    def __init__(self, receiver: BaseAVReceiver, cecclient: CECClient, plan: ActionPlan):
+        super().__init__(receiver)
+        self.cecclient = cecclient
+        self.plan = plan
 
-    def overload_query(self, params) -> Response:
-        self.receiver.set_power(False)
-        self.cecclient.switch_off()
+    def overload_query(self, params, context: RequestContext) -> Response:
+        self.plan.run({
+            'receiver standby': lambda: self.receiver.set_power(False, timeout=self.plan.deadline),
+            'projector standby': self.cecclient.switch_off
+        })
         return 200, 'OK', None
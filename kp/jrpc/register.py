@@ -3,21 +3,15 @@ from kp.jrpc.volumeoverloaders import GetPropertiesOverloader, SetMuteOverloader
 from kp.jrpc.poweroverloaders import ApplicationQuitOverloader, SystemPropertiesOverloader
 
 
-def register_overloaders(jrpc_server: JRPCServer, receiver) -> None:
-    """Registers all the JRPC overloaders in the jrpc server"""
-    jrpc_server.register_overloader(
-        'Application.GetProperties', lambda server: GetPropertiesOverloader(server, receiver))
-    jrpc_server.register_overloader(
-        'Application.SetMute', lambda server: SetMuteOverloader(receiver))
-    jrpc_server.register_overloader(
-        'Application.SetVolume', lambda server: SetVolumeOverloader(receiver))
-    jrpc_server.register_overloader(
-        'Application.Quit', lambda server: ApplicationQuitOverloader(receiver))
-    jrpc_server.register_overloader(
-        'System.Hibernate', lambda server: ApplicationQuitOverloader(receiver))
-    jrpc_server.register_overloader(
-        'System.Shutdown', lambda server: ApplicationQuitOverloader(receiver))
-    jrpc_server.register_overloader(
-        'System.Suspend', lambda server: ApplicationQuitOverloader(receiver))
-    jrpc_server.register_overloader(
-        'System.GetProperties', lambda server: SystemPropertiesOverloader())
+def register_overloaders(jrpc_server: JRPCServer, receiver, cecclient, shutdown_plan) -> None:
+    """Registers all the JRPC overloaders in the jrpc server. Each one is created once, for all the
+    requests"""
+    quit_overloader = ApplicationQuitOverloader(receiver, cecclient, shutdown_plan)
+    jrpc_server.register_overloader('Application.GetProperties', GetPropertiesOverloader(receiver))
+    jrpc_server.register_overloader('Application.SetMute', SetMuteOverloader(receiver))
+    jrpc_server.register_overloader('Application.SetVolume', SetVolumeOverloader(receiver))
+    jrpc_server.register_overloader('Application.Quit', quit_overloader)
+    jrpc_server.register_overloader('System.Hibernate', quit_overloader)
+    jrpc_server.register_overloader('System.Shutdown', quit_overloader)
+    jrpc_server.register_overloader('System.Suspend', quit_overloader)
+    jrpc_server.register_overloader('System.GetProperties', SystemPropertiesOverloader())
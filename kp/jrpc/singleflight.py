@@ -0,0 +1,106 @@
+import asyncio
+import functools
+import json
+from kp import metrics
+from kp.jrpc.cache import request_key
+from kp.types import Response
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterable
+
+LOGGER = logging.getLogger('kodiproxy')
+
+
+def with_id(response: Response, req_id: Any) -> Response:
+    """Returns the response with the id of another request"""
+    code, payload, headers = response
+    try:
+        decoded = json.loads(payload)
+    except ValueError:
+        return response
+    if not isinstance(decoded, dict):
+        return response
+    decoded['id'] = req_id
+    payload = bytes(json.dumps(decoded), 'utf-8')
+    headers = dict(headers)
+    headers['content-length'] = str(len(payload))
+    return code, payload, headers
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: Response = None
+
+
+class SingleFlight:
+    """Makes concurrent identical requests share a single call to the jrpc server.
+
+    The first request (the leader) makes the call, the ones arriving while it is in flight wait
+    for its response and get it with their own id."""
+
+    def __init__(self, methods: Iterable[str]):
+        self.methods = set(methods)
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+
+    def handles(self, req: Any) -> bool:
+        """Returns whether the request can share its call with others"""
+        return isinstance(req, dict) and req.get('method') in self.methods
+
+    def do(self, req: dict, call: Callable[[], Response]) -> Response:
+        """Calls call, unless an identical request is already doing it"""
+        key = request_key(req)
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Call()
+                self._calls[key] = flight
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        metrics.SINGLE_FLIGHT.inc('leader' if leader else 'coalesced')
+        if not leader:
+            flight.done.wait()
+            return with_id(flight.response, req.get('id'))
+        try:
+            flight.response = call()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if flight.response is None:
+                flight.response = 500, b'Unknown error', {'content-type': 'text/plain'}
+            flight.done.set()
+        return flight.response
+
+    async def do_async(self, req: dict, call: Callable[[], Awaitable[Response]]) -> Response:
+        """Same as do, from the event loop"""
+        key = request_key(req)
+        flight = self._async_calls.get(key)
+        if flight:
+            self.coalesced += 1
+            metrics.SINGLE_FLIGHT.inc('coalesced')
+            return with_id(await asyncio.shield(flight), req.get('id'))
+        # the call runs in its own task, which the leader being cancelled does not cancel
+        flight = asyncio.ensure_future(call())
+        self._async_calls[key] = flight
+        flight.add_done_callback(functools.partial(self._landed, key))
+        self.leaders += 1
+        metrics.SINGLE_FLIGHT.inc('leader')
+        return await asyncio.shield(flight)
+
+    def _landed(self, key: str, flight: asyncio.Task) -> None:
+        del self._async_calls[key]
+        if not flight.cancelled():
+            # the error may have no one left to await it, it is not to be logged as lost
+            flight.exception()
+
+    def get_stats(self) -> dict:
+        return {
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
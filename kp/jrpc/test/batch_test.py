@@ -0,0 +1,121 @@
+import json
+from kp.jrpc import batch
+import kp.jrpc.jrpcserver
+from kp.log import config_logger
+import unittest
+from unittest.mock import MagicMock
+
+config_logger({
+    'type': 'null'
+})
+
+
+def make_overloader(result):
+    overloader = MagicMock()
+
+    def handle_query(req, forwarder=None):
+        payload = {'jsonrpc': '2.0', 'id': req.get('id'), 'result': result}
+        return 200, bytes(json.dumps(payload), 'utf-8'), {}
+    overloader.handle_query.side_effect = handle_query
+    return overloader
+
+
+class TestBatchPlan(unittest.TestCase):
+    def test_split(self):
+        '''Overloaded requests are run locally, the others go upstream in one batch'''
+        overloader = make_overloader('local')
+        req = [
+            {'id': 1, 'method': 'Remote.Method'},
+            {'id': 2, 'method': 'Local.Method'},
+            {'method': 'Remote.Notification'},
+            {'id': 3, 'method': 'Remote.Method'}
+        ]
+        plan = batch.BatchPlan(
+            req, lambda r: overloader if r['method'].startswith('Local') else None)
+
+        self.assertEqual([index for index, _, _ in plan.local], [1])
+        self.assertEqual(json.loads(plan.upstream_request()), [
+                         req[0], req[2], req[3]])
+
+        local = {1: batch.BatchPlan.run_local(req[1], overloader)}
+        # the jrpc server does not answer in order
+        upstream = 200, b'[{"id": 3, "result": "r3"}, {"id": 1, "result": "r1"}]', {}
+        code, payload, headers = plan.assemble(local, upstream)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['content-length'], str(len(payload)))
+        self.assertEqual(json.loads(payload), [
+            {'id': 1, 'result': 'r1'},
+            {'jsonrpc': '2.0', 'id': 2, 'result': 'local'},
+            {'id': 3, 'result': 'r3'}
+        ])
+
+    def test_notifications(self):
+        '''Notifications do not get any response'''
+        overloader = make_overloader('local')
+        req = [{'method': 'Local.Method'}]
+        plan = batch.BatchPlan(req, lambda r: overloader)
+
+        self.assertIsNone(plan.upstream_request())
+        local = {0: batch.BatchPlan.run_local(req[0], overloader)}
+        overloader.handle_query.assert_called_once()
+        code, payload, _ = plan.assemble(local, None)
+        self.assertEqual(code, 204)
+        self.assertEqual(payload, b'')
+
+    def test_errors(self):
+        '''Failures are reported per request'''
+        overloader = MagicMock()
+        overloader.handle_query.side_effect = ValueError('failure')
+        req = [{'id': 1, 'method': 'Local.Method'},
+               {'id': 2, 'method': 'Remote.Method'}]
+        plan = batch.BatchPlan(
+            req, lambda r: overloader if r['method'].startswith('Local') else None)
+
+        local = {0: batch.BatchPlan.run_local(req[0], overloader)}
+        _, payload, _ = plan.assemble(local, (408, b'timeout', {}))
+        payload = json.loads(payload)
+
+        self.assertEqual([r['id'] for r in payload], [1, 2])
+        self.assertEqual(payload[0]['error']['code'], batch.INTERNAL_ERROR)
+        self.assertEqual(payload[1]['error']['code'], batch.INTERNAL_ERROR)
+
+
+class TestBatchDispatch(unittest.TestCase):
+    def test_dispatch(self):
+        '''Batches mixing overloaded and forwarded requests'''
+        pool_mock = MagicMock()
+        pool_mock.request.return_value = 200, b'[{"id": 1, "result": "r1"}]', {}
+        req = [{'id': 1, 'method': 'Remote.Method'},
+               {'id': 2, 'method': 'Local.Method'}]
+
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {'Local.Method': make_overloader('local')},
+            bytes(json.dumps(req), 'utf-8'), {}, pool_mock)
+        code, payload, _ = handler.dispatch()
+
+        self.assertEqual(code, 200)
+        self.assertEqual([r['result'] for r in json.loads(payload)], ['r1', 'local'])
+        pool_mock.request.assert_called_once_with(
+            b'[{"id": 1, "method": "Remote.Method"}]', {}, False)
+
+    def test_dispatch_forward(self):
+        '''Batches without overloaded requests are forwarded as is'''
+        pool_mock = MagicMock()
+        pool_mock.open.return_value = 200, b'[]', {}
+        payload = b'[{"id": 1, "method": "Player.GetItem"}]'
+
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {}, payload, {}, pool_mock)
+        handler.dispatch()
+
+        pool_mock.open.assert_called_once_with(payload, {}, True)
+
+    def test_empty(self):
+        '''An empty batch is invalid'''
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {}, b'[]', {}, MagicMock())
+        code, payload, _ = handler.dispatch()
+
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(payload)['error']['code'], batch.INVALID_REQUEST)
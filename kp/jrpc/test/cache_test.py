@@ -0,0 +1,182 @@
+import json
+from kp import metrics
+from kp.jrpc import cache, notifications
+import kp.jrpc.jrpcserver
+from kp.log import config_logger
+import socket
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+config_logger({
+    'type': 'null'
+})
+
+
+def response(req_id, result) -> tuple:
+    payload = bytes(json.dumps(
+        {'jsonrpc': '2.0', 'id': req_id, 'result': result}), 'utf-8')
+    return 200, payload, {'content-type': 'application/json', 'content-length': str(len(payload))}
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_ttl(self):
+        '''Methods can be given exactly or with patterns'''
+        res_cache = cache.ResponseCache(
+            {'VideoLibrary.Get*': 60, 'JSONRPC.Version': 600}, 1000)
+
+        self.assertEqual(res_cache.ttl('VideoLibrary.GetMovies'), 60)
+        self.assertEqual(res_cache.ttl('JSONRPC.Version'), 600)
+        self.assertIsNone(res_cache.ttl('VideoLibrary.Scan'))
+        self.assertIsNone(res_cache.ttl(None))
+        self.assertFalse(cache.ResponseCache({}, 1000))
+
+    def test_get(self):
+        '''Cached responses get the id of the request'''
+        res_cache = cache.ResponseCache({'JSONRPC.Version': 600}, 1000)
+        req = {'id': 1, 'method': 'JSONRPC.Version'}
+        hits = metrics.CACHE_LOOKUPS.collect().get(('hit',), [0])[0]
+
+        self.assertIsNone(res_cache.get(req))
+        res_cache.put(req, response(1, {'version': 12}))
+        code, payload, headers = res_cache.get(
+            {'id': 'other', 'method': 'JSONRPC.Version', 'params': None})
+
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(payload), {
+                         'jsonrpc': '2.0', 'id': 'other', 'result': {'version': 12}})
+        self.assertEqual(headers['content-length'], str(len(payload)))
+        self.assertEqual(headers['content-type'], 'application/json')
+        self.assertEqual(res_cache.get_stats()['hits'], 1)
+        self.assertEqual(res_cache.get_stats()['hit_rate'], 0.5)
+        self.assertEqual(metrics.CACHE_LOOKUPS.collect()[('hit',)][0], hits + 1)
+
+    def test_canonical_params(self):
+        '''The order of the parameters does not matter'''
+        res_cache = cache.ResponseCache({'Files.GetDirectory': 600}, 1000)
+        res_cache.put({'id': 1, 'method': 'Files.GetDirectory', 'params': {
+                      'a': 1, 'b': 2}}, response(1, []))
+
+        self.assertIsNotNone(res_cache.get(
+            {'id': 2, 'method': 'Files.GetDirectory', 'params': {'b': 2, 'a': 1}}))
+        self.assertIsNone(res_cache.get(
+            {'id': 2, 'method': 'Files.GetDirectory', 'params': {'b': 3, 'a': 1}}))
+
+    def test_errors_not_cached(self):
+        '''Only successes are kept'''
+        res_cache = cache.ResponseCache({'JSONRPC.Version': 600}, 1000)
+        req = {'id': 1, 'method': 'JSONRPC.Version'}
+        res_cache.put(req, (200, b'{"id": 1, "error": {"code": -1}}', {}))
+        res_cache.put(req, (500, b'Unknown error', {}))
+        res_cache.put(req, (200, b'not json', {}))
+
+        self.assertIsNone(res_cache.get(req))
+
+    @patch('kp.jrpc.cache.time.monotonic')
+    def test_expiry(self, monotonic_mock: MagicMock):
+        '''Responses are only kept for their ttl'''
+        res_cache = cache.ResponseCache({'JSONRPC.Version': 10}, 1000)
+        req = {'id': 1, 'method': 'JSONRPC.Version'}
+        monotonic_mock.return_value = 100
+        res_cache.put(req, response(1, 12))
+
+        monotonic_mock.return_value = 109
+        self.assertIsNotNone(res_cache.get(req))
+        monotonic_mock.return_value = 111
+        self.assertIsNone(res_cache.get(req))
+        self.assertEqual(res_cache.size, 0)
+
+    def test_lru(self):
+        '''The least recently used responses are evicted to respect the size'''
+        res_cache = cache.ResponseCache({'Files.GetDirectory': 600}, 250)
+        reqs = [{'id': i, 'method': 'Files.GetDirectory', 'params': i}
+                for i in range(3)]
+        res_cache.put(reqs[0], response(0, 'x' * 50))
+        res_cache.put(reqs[1], response(1, 'x' * 50))
+        res_cache.get(reqs[0])
+        res_cache.put(reqs[2], response(2, 'x' * 50))
+
+        self.assertIsNotNone(res_cache.get(reqs[0]))
+        self.assertIsNone(res_cache.get(reqs[1]))
+        self.assertIsNotNone(res_cache.get(reqs[2]))
+        self.assertLessEqual(res_cache.size, 250)
+        self.assertEqual(res_cache.get_stats()['evictions'], 1)
+
+    def test_invalidation(self):
+        '''Library notifications invalidate the library responses'''
+        res_cache = cache.ResponseCache(
+            {'VideoLibrary.Get*': 600, 'AudioLibrary.Get*': 600}, 1000)
+        video = {'id': 1, 'method': 'VideoLibrary.GetMovies'}
+        audio = {'id': 1, 'method': 'AudioLibrary.GetSongs'}
+        res_cache.put(video, response(1, []))
+        res_cache.put(audio, response(1, []))
+
+        res_cache.on_notification('VideoLibrary.OnScanFinished', None)
+        self.assertIsNone(res_cache.get(video))
+        self.assertIsNotNone(res_cache.get(audio))
+
+        res_cache.on_forward(
+            {'id': 1, 'method': 'AudioLibrary.SetSongDetails'}, False)
+        self.assertIsNone(res_cache.get(audio))
+
+    def test_handler(self):
+        '''The handler only forwards cache misses'''
+        res_cache = cache.ResponseCache({'JSONRPC.Version': 600}, 1000)
+        pool_mock = MagicMock()
+        pool_mock.request.return_value = response(0, 12)
+
+        for i in range(2):
+            handler = kp.jrpc.jrpcserver.JRPCHandler(
+                'http://mock_url', {}, bytes(json.dumps({'id': i, 'method': 'JSONRPC.Version'}), 'utf-8'),
+                {}, pool_mock, cache=res_cache)
+            _, payload, _ = handler.dispatch()
+            self.assertEqual(json.loads(payload)['id'], i)
+
+        pool_mock.request.assert_called_once()
+        pool_mock.open.assert_not_called()
+
+
+class TestNotificationListener(unittest.TestCase):
+    def test_notifications(self):
+        '''Notifications are read from the stream of json objects'''
+        server = socket.create_server(('localhost', 0))
+        received = []
+        done = threading.Event()
+
+        def on_notification(method, params):
+            received.append((method, params))
+            if len(received) == 3:
+                done.set()
+
+        listener = notifications.KodiNotificationListener(
+            'localhost', server.getsockname()[1])
+        listener.add_listener(on_notification)
+        listener.start()
+        conn, _ = server.accept()
+        conn.sendall(b'{"jsonrpc": "2.0", "method": "VideoLibrary.OnScanFinished", "params": {}}'
+                     b'{"jsonrpc": "2.0", "id": 1, "result": "ignored"}\n{"jsonrpc": "2.0", '
+                     b'"method": "Player.OnPlay", ')
+        conn.sendall(b'"params": {"data": 1}}')
+        conn.close()
+        done.wait(5)
+        listener.stop()
+        server.close()
+
+        self.assertEqual(received, [
+            ('VideoLibrary.OnScanFinished', {}),
+            ('Player.OnPlay', {'data': 1}),
+            (notifications.DISCONNECTED, None)
+        ])
+
+    def test_split_character(self):
+        '''A character split between two reads is decoded'''
+        payload = bytes('{"method": "Player.OnPlay", "params": {"title": "Amélie"}}', 'utf-8')
+        split = payload.index(bytes('é', 'utf-8')) + 1
+        sock = MagicMock()
+        sock.recv.side_effect = [payload[:split], payload[split:], b'']
+        listener = notifications.KodiNotificationListener('localhost', 0)
+        on_notification = MagicMock()
+        listener.add_listener(on_notification)
+
+        listener._read(sock)
+        on_notification.assert_called_once_with('Player.OnPlay', {'title': 'Amélie'})
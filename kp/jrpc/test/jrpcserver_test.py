@@ -1,7 +1,11 @@
+import asyncio
+import json
+from kp.breaker import BackendGuard
 import kp.jrpc.jrpcserver
 from kp.log import config_logger
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
+import socket
 
 config_logger({
     'type': 'null'
@@ -9,50 +13,35 @@ config_logger({
 
 
 class TestJRPCHandler(unittest.TestCase):
-    @patch('kp.jrpc.jrpcserver.request.Request')
-    @patch('kp.jrpc.jrpcserver.request.urlopen')
-    def test_error_decoding(self, open_mock, request_mock):
+    def test_error_decoding(self):
         '''If we fail to decode the request, we forward it'''
 
         # Prepare mocks
-        res_mock = MagicMock()
-        open_mock.return_value = MagicMock()
-        open_mock.return_value.__enter__ = MagicMock(return_value=res_mock)
-        res_mock.getcode.return_value = 666
-        res_mock.read.return_value = b'result'
-        res_mock.info.return_value = {'content-length': '39'}
+        pool_mock = MagicMock()
+        pool_mock.open.return_value = 666, b'result', {
+            'content-length': '39', 'connection': 'keep-alive'}
 
         # Actual test
         handler = kp.jrpc.jrpcserver.JRPCHandler(
-            'http://mock_url', MagicMock(), b'"astring"', {'Header': 'header-value'})
+            'http://mock_url', MagicMock(), b'"astring"', {'Header': 'header-value'}, pool_mock)
 
         code, payload, headers = handler.dispatch()
 
         # Checks
         self.assertEqual(code, 666)
         self.assertEqual(payload, b'result')
-        self.assertEqual(headers, {'content-length': '39'})
-        res_mock.read.assert_called_once_with(39)
+        self.assertEqual(headers, {'content-length': '6'})
 
-        open_mock.assert_called_once()
-        args, kwargs = request_mock.call_args
-        self.assertEqual(args[0], 'http://mock_url')
-        self.assertEqual(kwargs['data'], b'"astring"')
-        self.assertEqual(kwargs['headers'], {'Header': 'header-value'})
+        pool_mock.open.assert_called_once_with(
+            b'"astring"', {'Header': 'header-value'}, False)
 
         handler.overloaders.get.assert_not_called()
 
-    @patch('kp.jrpc.jrpcserver.request.Request')
-    @patch('kp.jrpc.jrpcserver.request.urlopen')
-    def test_no_match(self, open_mock, request_mock):
+    def test_no_match(self):
         '''Check that if no overloader matches, we forward the query'''
         # Prepare mocks
-        res_mock = MagicMock()
-        open_mock.return_value = MagicMock()
-        open_mock.return_value.__enter__ = MagicMock(return_value=res_mock)
-        res_mock.getcode.return_value = 666
-        res_mock.read.return_value = b'result'
-        res_mock.info.return_value = {'content-length': '39'}
+        pool_mock = MagicMock()
+        pool_mock.open.return_value = 666, b'result', {}
 
         payload = b'{"id": 254, "method": "any_other_method", "params": "parameters"}'
 
@@ -60,28 +49,84 @@ class TestJRPCHandler(unittest.TestCase):
         overloaders_mock.get.return_value = None
 
         handler = kp.jrpc.jrpcserver.JRPCHandler(
-            'http://mock_url', overloaders_mock, payload, {'Header': 'header-value'})
+            'http://mock_url', overloaders_mock, payload, {'Header': 'header-value'}, pool_mock)
 
         code, response, headers = handler.dispatch()
 
         # Checks
         self.assertEqual(code, 666)
         self.assertEqual(response, b'result')
-        self.assertEqual(headers, {'content-length': '39'})
-        res_mock.read.assert_called_once_with(39)
+        self.assertEqual(headers, {'content-length': '6'})
+        pool_mock.open.assert_called_once_with(
+            payload, {'Header': 'header-value'}, False)
 
         handler.overloaders.get.assert_called_once_with(
             'any_other_method', None)
 
+    def test_forward_read_only(self):
+        '''Read only queries can be retried by the pool'''
+        pool_mock = MagicMock()
+        pool_mock.open.return_value = 200, b'result', {}
+
+        payload = b'{"id": 254, "method": "Player.GetActivePlayers"}'
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {}, payload, {}, pool_mock)
+        handler.dispatch()
+
+        pool_mock.open.assert_called_once_with(payload, {}, True)
+        self.assertEqual(handler.method, 'Player.GetActivePlayers')
+        self.assertEqual(handler.route, 'forwarded')
+
+    def test_forward_timeout(self):
+        '''A timeout of the jrpc server is reported as such'''
+        pool_mock = MagicMock()
+        pool_mock.open.side_effect = socket.timeout()
+
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {}, b'{}', {}, pool_mock)
+        code, _, _ = handler.dispatch()
+
+        self.assertEqual(code, 408)
+
+    def test_forward_unavailable(self):
+        '''While the circuit is open, requests fail right away with a jrpc error'''
+        pool_mock = MagicMock()
+        guard = BackendGuard('test', 1, 5, 1, 10)
+        guard.breaker.record_failure()
+
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {}, b'{"id": 3, "method": "Player.GetItem"}', {}, pool_mock,
+            guard=guard)
+        code, payload, _ = handler.dispatch()
+
+        self.assertEqual(code, 503)
+        self.assertEqual(json.loads(payload), {
+            'jsonrpc': '2.0', 'id': 3,
+            'error': {'code': -32000, 'message': 'Kodi is unavailable'}})
+        pool_mock.open.assert_not_called()
+
+    def test_forward_guarded(self):
+        '''The adaptive timeout is given to the pool'''
+        pool_mock = MagicMock()
+        pool_mock.open.return_value = 200, b'result', {}
+        guard = BackendGuard('test', 1, 5, 1, 10)
+
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {}, b'{"id": 3, "method": "Player.GetItem"}', {}, pool_mock,
+            guard=guard)
+        handler.dispatch()
+
+        pool_mock.open.assert_called_once_with(ANY, {}, True, timeout=5)
+        self.assertIn('Player.GetItem', guard.timeouts)
+
     def test_match(self):
         '''Check that if an overloader matches, it handles the query'''
         overloader_mock = MagicMock()
-        overloader_provider_mock = MagicMock(return_value=overloader_mock)
 
         overloader_mock.handle_query.return_value = 666, b'response', {
             'Header': 'header-value'}
 
-        overloaders = {'some_method': overloader_provider_mock}
+        overloaders = {'some_method': overloader_mock}
 
         payload = b'{"id": 254, "method": "some_method", "params": "parameters"}'
 
@@ -92,6 +137,100 @@ class TestJRPCHandler(unittest.TestCase):
         self.assertEqual(code, 666)
         self.assertEqual(response, b'response')
         self.assertEqual(headers, {'Header': 'header-value'})
+        # the method does not look like a jrpc one
+        self.assertEqual(handler.method, 'other')
+        self.assertEqual(handler.route, 'overloaded')
 
         overloader_mock.handle_query.assert_called_once_with(
-            {"id": 254, "method": "some_method", "params": "parameters"})
+            {"id": 254, "method": "some_method", "params": "parameters"}, handler)
+
+
+class TestJRPCHandlerAsync(unittest.IsolatedAsyncioTestCase):
+    async def test_match(self):
+        '''Overloaders are run outside of the event loop'''
+        overloader_mock = MagicMock()
+        overloader_mock.handle_query.return_value = 200, b'response', {}
+
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://mock_url', {'some_method': overloader_mock},
+            b'{"id": 254, "method": "some_method"}', {})
+        code, response, _ = await handler.dispatch_async()
+
+        self.assertEqual(code, 200)
+        self.assertEqual(response, b'response')
+
+    async def test_forward(self):
+        '''Requests are forwarded to the jrpc server without blocking'''
+        received = []
+
+        async def upstream(reader, writer):
+            received.append(await reader.readuntil(b'\r\n\r\n'))
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 6\r\n'
+                         b'Connection: keep-alive\r\n\r\nresult')
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(upstream, 'localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            handler = kp.jrpc.jrpcserver.JRPCHandler(
+                'http://localhost:{}/jsonrpc'.format(port), {}, b'"astring"',
+                {'connection': 'keep-alive', 'header': 'header-value'})
+            code, payload, headers = await handler.dispatch_async()
+            # the response is streamed
+            self.assertEqual(payload.length, 6)
+            self.assertEqual(await payload.read(), b'result')
+
+        self.assertEqual(code, 200)
+        self.assertEqual(headers, {'content-length': '6'})
+        self.assertTrue(received[0].startswith(b'POST /jsonrpc HTTP/1.1'))
+        self.assertIn(b'header: header-value', received[0])
+
+    async def test_forward_unreachable(self):
+        '''Failing to reach the jrpc server gives an error'''
+        handler = kp.jrpc.jrpcserver.JRPCHandler(
+            'http://localhost:1/jsonrpc', {}, b'"astring"', {})
+        code, _, _ = await handler.dispatch_async()
+        self.assertEqual(code, 500)
+
+    async def test_timeout_opens_circuit(self):
+        '''The jrpc server timeouting opens the circuit'''
+        writers = []
+
+        async def upstream(reader, writer):
+            # never answers
+            writers.append(writer)
+            await reader.read()
+
+        server = await asyncio.start_server(upstream, 'localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+        jrpc_server = kp.jrpc.jrpcserver.JRPCServer({
+            'breakerFailures': 2, 'minTimeout': 0.1, 'target': 'http://localhost:{}/jsonrpc'.format(port),
+            'timeout': 0.1})
+        async with server:
+            for expected in (408, 408, 503):
+                handler = jrpc_server.get_handler(b'{"id": 1, "method": "Player.Stop"}', {})
+                code, _, _ = await handler.dispatch_async()
+                self.assertEqual(code, expected)
+            for writer in writers:
+                writer.close()
+                await writer.wait_closed()
+        jrpc_server.close()
+        jrpc_server.async_pool.close()
+
+
+class TestReadOnly(unittest.TestCase):
+    def test_read_only(self):
+        '''Only getters are considered read only'''
+        is_read_only = kp.jrpc.jrpcserver.is_read_only
+        self.assertTrue(is_read_only({'method': 'VideoLibrary.GetMovies'}))
+        self.assertTrue(is_read_only({'method': 'JSONRPC.Version'}))
+        self.assertTrue(is_read_only([{'method': 'Player.GetItem'}, {
+                        'method': 'Application.GetProperties'}]))
+        self.assertFalse(is_read_only({'method': 'Player.PlayPause'}))
+        self.assertFalse(is_read_only({'method': 'JSONRPC.NotifyAll'}))
+        self.assertFalse(is_read_only([{'method': 'Player.GetItem'}, {
+                         'method': 'Player.Stop'}]))
+        self.assertFalse(is_read_only([]))
+        self.assertFalse(is_read_only('Player.GetItem'))
+        self.assertFalse(is_read_only(None))
@@ -1,11 +1,14 @@
 import json
-from kp.jrpc.jrpcserver import JRPCOverloader
+from kp.jrpc.jrpcserver import JRPCHandler, JRPCOverloader
+from kp.jrpc.singleflight import SingleFlight
+from kp.jrpc.volumeoverloaders import GetPropertiesOverloader
+import threading
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import ANY, MagicMock
 
 
 class MockOverloader(JRPCOverloader):
-    def overload_query(self, params):
+    def overload_query(self, params, context):
         pass
 
 
@@ -37,4 +40,52 @@ class TestOverloader(unittest.TestCase):
         self.assertEqual(headers['header_key'], 'header value')
 
         overloader.overload_query.assert_called_once_with(
-            {'param_key': 'param value'})
+            {'param_key': 'param value'}, ANY)
+
+    def test_shared(self):
+        '''A single overloader answers concurrent requests with their own ids'''
+        overloader = MockOverloader()
+        barrier = threading.Barrier(2)
+
+        def overload_query(params, context):
+            # both requests are in the overloader at the same time
+            barrier.wait(1)
+            return 200, context.id, None
+        overloader.overload_query = overload_query
+
+        results = dict()
+
+        def run(req_id):
+            results[req_id] = json.loads(overloader.handle_query({'id': req_id})[1])
+        threads = [threading.Thread(target=run, args=(i,)) for i in (1, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {i: {'jsonrpc': '2.0', 'id': i, 'result': i} for i in (1, 2)})
+
+    def test_forward(self):
+        '''Overloaders forward queries through the handler of their request'''
+        pool_mock = MagicMock()
+        pool_mock.request.return_value = 200, b'{"id": 7, "result": {"name": "Kodi"}}', {}
+        receiver = MagicMock()
+        receiver.get_volume.return_value = 30, True
+        headers = {'Authorization': 'Basic abc'}
+        handler = JRPCHandler(
+            'http://mock_url', {}, b'', headers, pool_mock,
+            single_flight=SingleFlight(['Application.GetProperties']))
+
+        code, res, _ = GetPropertiesOverloader(receiver).handle_query({
+            'id': 7, 'params': {'properties': ['name', 'volume']}}, handler)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(res)['result'], {'name': 'Kodi', 'volume': 30})
+        payload, forwarded_headers, read_only = pool_mock.request.call_args[0]
+        self.assertEqual(json.loads(payload), {
+            'jsonrpc': '2.0', 'id': 7, 'method': 'Application.GetProperties',
+            'params': {'properties': ['name']}})
+        self.assertEqual(forwarded_headers['Authorization'], 'Basic abc')
+        self.assertTrue(read_only)
+        # the headers of the request are left as they were
+        self.assertEqual(headers, {'Authorization': 'Basic abc'})
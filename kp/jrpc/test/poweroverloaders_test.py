@@ -0,0 +1,22 @@
+import json
+from kp.actionplan import ActionPlan
+from kp.jrpc.poweroverloaders import ApplicationQuitOverloader
+import unittest
+from unittest.mock import MagicMock
+
+
+class TestApplicationQuitOverloader(unittest.TestCase):
+    def test_quit(self):
+        '''The receiver and the projector are both switched off'''
+        receiver = MagicMock()
+        cecclient = MagicMock()
+        cecclient.switch_off.side_effect = OSError('no adapter')
+        overloader = ApplicationQuitOverloader(
+            receiver, cecclient, ActionPlan({'deadline': 3}))
+
+        code, res, _ = overloader.handle_query({'id': 1, 'method': 'Application.Quit'})
+
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(res)['result'], 'OK')
+        receiver.set_power.assert_called_once_with(False, timeout=3)
+        cecclient.switch_off.assert_called_once_with()
@@ -0,0 +1,133 @@
+import asyncio
+import json
+from kp import metrics
+from kp.jrpc import singleflight
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+
+def response(req_id) -> tuple:
+    payload = bytes(json.dumps(
+        {'jsonrpc': '2.0', 'id': req_id, 'result': 'value'}), 'utf-8')
+    return 200, payload, {'content-length': str(len(payload))}
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_handles(self):
+        '''Only the given methods are coalesced'''
+        flight = singleflight.SingleFlight(['Player.GetItem'])
+        self.assertTrue(flight.handles({'method': 'Player.GetItem'}))
+        self.assertFalse(flight.handles({'method': 'Player.Stop'}))
+        self.assertFalse(flight.handles([{'method': 'Player.GetItem'}]))
+
+    def test_coalesce(self):
+        '''Concurrent identical requests share one call'''
+        flight = singleflight.SingleFlight(['Player.GetItem'])
+        release = threading.Event()
+        call = MagicMock()
+
+        def slow_call():
+            release.wait(5)
+            return response(0)
+        call.side_effect = slow_call
+
+        results = {}
+
+        def run(req_id):
+            results[req_id] = flight.do(
+                {'id': req_id, 'method': 'Player.GetItem', 'params': {}}, call)
+
+        coalesced = metrics.SINGLE_FLIGHT.collect().get(('coalesced',), [0])[0]
+        threads = [threading.Thread(target=run, args=[i]) for i in range(3)]
+        threads[0].start()
+        while flight.leaders == 0:
+            pass
+        for thread in threads[1:]:
+            thread.start()
+        while flight.coalesced < 2:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        call.assert_called_once()
+        for req_id, (code, payload, headers) in results.items():
+            self.assertEqual(code, 200)
+            self.assertEqual(json.loads(payload)['id'], req_id)
+            self.assertEqual(headers['content-length'], str(len(payload)))
+        self.assertEqual(flight.get_stats(), {'leaders': 1, 'coalesced': 2})
+        self.assertEqual(metrics.SINGLE_FLIGHT.collect()[('coalesced',)][0], coalesced + 2)
+
+        # once done, the next request makes its own call
+        flight.do({'id': 4, 'method': 'Player.GetItem', 'params': {}}, call)
+        self.assertEqual(call.call_count, 2)
+
+    def test_different_params(self):
+        '''Requests with different parameters do not share their call'''
+        flight = singleflight.SingleFlight(['Player.GetItem'])
+        call = MagicMock(return_value=response(0))
+        flight.do({'id': 1, 'method': 'Player.GetItem', 'params': 1}, call)
+        flight.do({'id': 1, 'method': 'Player.GetItem', 'params': 2}, call)
+        self.assertEqual(call.call_count, 2)
+
+    def test_coalesce_async(self):
+        '''Concurrent identical requests share one call in the event loop'''
+        flight = singleflight.SingleFlight(['Player.GetItem'])
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return response(0)
+
+        async def run():
+            return await asyncio.gather(*[flight.do_async(
+                {'id': i, 'method': 'Player.GetItem'}, call) for i in range(3)])
+
+        results = asyncio.run(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([json.loads(r[1])['id'] for r in results], [0, 1, 2])
+        self.assertEqual(flight.coalesced, 2)
+
+    def test_cancelled_leader(self):
+        '''The leader being cancelled, like when its client is gone, does not fail the others'''
+        flight = singleflight.SingleFlight(['Player.GetItem'])
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return response(0)
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do_async({'id': 0, 'method': 'Player.GetItem'}, call))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do_async({'id': 1, 'method': 'Player.GetItem'}, call))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        result = asyncio.run(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(json.loads(result[1])['id'], 1)
+        self.assertEqual(flight._async_calls, {})
+
+    def test_failing_leader_async(self):
+        '''The error of the shared call is given to all the requests'''
+        flight = singleflight.SingleFlight(['Player.GetItem'])
+
+        async def call():
+            await asyncio.sleep(0.01)
+            raise ValueError('failure')
+
+        async def run():
+            return await asyncio.gather(*[flight.do_async(
+                {'id': i, 'method': 'Player.GetItem'}, call) for i in range(2)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
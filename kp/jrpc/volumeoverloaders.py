@@ -1,21 +1,18 @@
 import json
-from kp.avreceiver import AVReceiver
-from kp.jrpc.jrpcserver import JRPCOverloader, JRPCServer, JRPCOverloaderWithHandler
+from kp.avreceiver import BaseAVReceiver
+from kp.jrpc.jrpcserver import JRPCOverloader, RequestContext
 from kp.types import Response
 import numbers
 
 
-class JRPCAVReceiverOverloader(JRPCOverloaderWithHandler):
-    def __init__(self, server: JRPCServer, receiver: AVReceiver):
-        super().__init__(server)
+class JRPCAVReceiverOverloader(JRPCOverloader):
+    def __init__(self, receiver: BaseAVReceiver):
+        super().__init__()
         self.receiver = receiver
 
 
 class SetVolumeOverloader(JRPCAVReceiverOverloader):
-    def __init__(self, receiver: AVReceiver):
-        super().__init__(None, receiver)
-
-    def overload_query(self, params) -> Response:
+    def overload_query(self, params, context: RequestContext) -> Response:
         volume = params['volume']
         if isinstance(volume, numbers.Number):
             volume = self.receiver.set_volume(params['volume'])
@@ -29,10 +26,7 @@ class SetVolumeOverloader(JRPCAVReceiverOverloader):
 
 
 class SetMuteOverloader(JRPCAVReceiverOverloader):
-    def __init__(self, receiver: AVReceiver):
-        super().__init__(None, receiver)
-
-    def overload_query(self, params) -> Response:
+    def overload_query(self, params, context: RequestContext) -> Response:
         mute = params['mute']
         if mute == 'toggle':
             mute = not self.receiver.get_mute()
@@ -45,10 +39,7 @@ class SetMuteOverloader(JRPCAVReceiverOverloader):
 class GetPropertiesOverloader(JRPCAVReceiverOverloader):
     _AVR_PROPERTIES = {'volume', 'muted'}
 
-    def __init__(self, server: JRPCServer, receiver: AVReceiver):
-        super().__init__(server, receiver)
-
-    def overload_query(self, params) -> Response:
+    def overload_query(self, params, context: RequestContext) -> Response:
         properties = set(params['properties'])
         avr_properties = GetPropertiesOverloader._AVR_PROPERTIES.intersection(
             properties)
@@ -62,7 +53,7 @@ class GetPropertiesOverloader(JRPCAVReceiverOverloader):
                 elif prop == 'volume':
                     result[prop] = volume
         if other_properties:
-            _, response, _ = self.forward('Application.GetProperties', {
+            _, response, _ = context.forward('Application.GetProperties', {
                 'properties': list(other_properties)})
 
             response = json.loads(response)
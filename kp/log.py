@@ -1,7 +1,9 @@
 from kp.confbase import KPConfBase
+import json
 import logging
 import logging.handlers
 import sys
+from typing import Any, Dict, Iterable
 
 
 class LogConf:
@@ -13,6 +15,45 @@ class LogConf:
     }
 
 
+# settings shared by the JSONL files written apart from the logs, like the traces
+JSONL_CONFIGURATION = {
+    'backupCount': 1,
+    'enabled': False,
+    'maxBytes': 10000000
+}
+
+
+class JSONLWriter:
+    """Writes records to a rotating JSONL file through the logger of the given name, whose messages
+    do not go to the logs. conf gives enabled, path, maxBytes and backupCount"""
+
+    def __init__(self, name: str, conf: KPConfBase):
+        self.enabled = conf.enabled
+        self._logger = logging.getLogger(name)
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        for handler in list(self._logger.handlers):
+            self._logger.removeHandler(handler)
+            handler.close()
+        if self.enabled:
+            handler = logging.handlers.RotatingFileHandler(
+                conf.path, backupCount=conf.backupCount, maxBytes=conf.maxBytes)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._logger.info(json.dumps(record))
+
+
+def read_jsonl(path: str) -> Iterable[Dict[str, Any]]:
+    """Reads the records of a file written by a JSONLWriter"""
+    with open(path) as records:
+        for line in records:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
 def config_logger(conf) -> None:
     """Configure the logger 'kodiproxy' use everywhere in the code"""
     conf = KPConfBase(LogConf, conf)
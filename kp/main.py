@@ -1,11 +1,27 @@
-from kp.avreceiver import AVReceiver
+from kp.actionplan import ActionPlan
+from kp.aioserver import AsyncKodiProxyServer
+from kp.avreceiver import create_receiver
+from kp.capture import config_capture
+from kp.cecclient import CECClient
+from kp.confbase import KPConfBase
 from kp.configuration import KPConfiguration
 from kp.jrpc.jrpcserver import JRPCServer
 from kp.jrpc.register import register_overloaders
 from kp.log import config_logger
 from kp.server import KodiProxyServer
+from kp.tracing import config_tracer
 from threading import Event
-from typing import Any, Optional
+from typing import Any, Optional, Union
+
+
+def create_server(conf, jrpc_server: JRPCServer) -> Union[KodiProxyServer, AsyncKodiProxyServer]:
+    """Creates the server matching the engine chosen in the configuration"""
+    engine = KPConfBase(KodiProxyServer, conf).engine
+    if engine == 'asyncio':
+        return AsyncKodiProxyServer(conf, jrpc_server)
+    elif engine == 'threading':
+        return KodiProxyServer(conf, jrpc_server)
+    raise ValueError('Incorrect server engine: {}'.format(engine))
 
 
 def setup_and_start(conf_path: str, event: Optional[Event] = None):
@@ -13,11 +29,21 @@ def setup_and_start(conf_path: str, event: Optional[Event] = None):
     conf = KPConfiguration(conf_path)
 
     config_logger(conf.logging)
-    receiver = AVReceiver(conf.receiver)
+    config_tracer(conf.tracing)
+    config_capture(conf.capture)
+    receiver = create_receiver(conf.receiver)
+    receiver.start()
+    cecclient = CECClient(conf.cec)
+    cecclient.start()
     jrpc_server = JRPCServer(conf.jrpc)
-    register_overloaders(jrpc_server, receiver)
-    server = KodiProxyServer(conf.server, jrpc_server)
+    register_overloaders(jrpc_server, receiver, cecclient, ActionPlan(conf.shutdown))
+    server = create_server(conf.server, jrpc_server)
 
     if event:
         event.set()
-    server.serve()
+    try:
+        server.serve()
+    finally:
+        jrpc_server.close()
+        cecclient.stop()
+        receiver.stop()
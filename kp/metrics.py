@@ -0,0 +1,331 @@
+import bisect
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import weakref
+
+# in seconds
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+
+class _ShardOwner:
+    """Lives in the thread local storage of a metric. Its shard is merged into the metric when the
+    thread ends"""
+
+    def __init__(self, shard: dict):
+        self.shard = shard
+
+
+class _Metric:
+    """Base class of the metrics.
+
+    Each thread records its values in its own shard, so recording does not take any lock. The
+    shards are only merged when the metrics are collected"""
+
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        # values recorded by the threads that ended
+        self._retired: dict = dict()
+        self._lock = threading.Lock()
+
+    def _new_series(self) -> list:
+        return [0]
+
+    def _series(self, label_values: LabelValues) -> list:
+        try:
+            shard = self._local.owner.shard
+        except AttributeError:
+            shard = self._new_shard()
+        series = shard.get(label_values)
+        if series is None:
+            series = shard[label_values] = self._new_series()
+        return series
+
+    def _new_shard(self) -> dict:
+        shard = dict()
+        owner = _ShardOwner(shard)
+        self._local.owner = owner
+        with self._lock:
+            self._shards.append(shard)
+        weakref.finalize(owner, self._retire, shard)
+        return shard
+
+    def _retire(self, shard: dict) -> None:
+        with self._lock:
+            self._shards = [s for s in self._shards if s is not shard]
+            _merge(self._retired, shard)
+
+    def collect(self) -> Dict[LabelValues, list]:
+        """Returns the values of all the series, merged from all the threads"""
+        merged = dict()
+        with self._lock:
+            shards = self._shards + [self._retired]
+            for shard in shards:
+                _merge(merged, shard)
+        return merged
+
+    def _samples(self) -> Iterable[Tuple[str, LabelValues, float]]:
+        for label_values, series in sorted(self.collect().items()):
+            yield self.name, label_values, series[0]
+
+    def expose(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for name, label_values, value in self._samples():
+            lines.append('{}{} {}'.format(name, _format_labels(self.labels, label_values),
+                                          _format_value(value)))
+        return lines
+
+
+def _merge(into: dict, shard: dict) -> None:
+    # copying is atomic, while the owning thread might be adding series
+    for label_values, series in shard.copy().items():
+        series = list(series)
+        current = into.get(label_values)
+        if current is None:
+            into[label_values] = series
+        else:
+            for i, value in enumerate(series):
+                current[i] += value
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Tuple[str, ...], values: LabelValues) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(str(v))) for k, v in zip(labels, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter(_Metric):
+    """Value that only goes up"""
+
+    TYPE = 'counter'
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._series(label_values)[0] += amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down. If function is given, it gives the values when collected, either
+    as a number or as a dict from label values to numbers"""
+
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 function: Optional[Callable[[], object]] = None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._series(label_values)[0] += amount
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self._series(label_values)[0] -= amount
+
+    def collect(self) -> Dict[LabelValues, list]:
+        if self.function is None:
+            return super().collect()
+        values = self.function()
+        if not isinstance(values, dict):
+            return {(): [values]}
+        return {k if isinstance(k, tuple) else (k,): [v] for k, v in values.items()}
+
+
+class Histogram(_Metric):
+    """Distribution of values (durations in seconds) in buckets"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self) -> list:
+        # one count per bucket, then the count above the last bucket, then the sum
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._series(label_values)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *label_values: str) -> '_Timer':
+        """Context manager observing the time spent in it"""
+        return _Timer(self, label_values)
+
+    def _samples(self) -> Iterable[Tuple[str, LabelValues, float]]:
+        # unlike the other metrics, the labels of the buckets are built here
+        for label_values, series in sorted(self.collect().items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulated += count
+                yield self.name + '_bucket', label_values + (_format_value(bound),), cumulated
+            yield self.name + '_sum', label_values, series[-1]
+            yield self.name + '_count', label_values, cumulated
+
+    def expose(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for name, label_values, value in self._samples():
+            labels = self.labels + ('le',) if name.endswith('_bucket') else self.labels
+            lines.append('{}{} {}'.format(name, _format_labels(labels, label_values),
+                                          _format_value(value)))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: LabelValues):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Registry:
+    """Set of metrics exposed together"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = dict()
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Adds a metric, replacing the one with the same name if any"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = (),
+              function: Optional[Callable[[], object]] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def expose(self) -> bytes:
+        """Returns the metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return bytes('\n'.join(lines) + '\n', 'utf-8')
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'kodiproxy_requests_total', 'JSON-RPC requests handled', ('method', 'route', 'code'))
+REQUEST_DURATION = REGISTRY.histogram(
+    'kodiproxy_request_duration_seconds', 'Time to answer JSON-RPC requests', ('method', 'route'))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    'kodiproxy_requests_in_flight', 'JSON-RPC requests being handled')
+CONNECTIONS = REGISTRY.gauge(
+    'kodiproxy_connections', 'Open client connections')
+THREADS = REGISTRY.gauge(
+    'kodiproxy_threads', 'Running threads', function=threading.active_count)
+UPSTREAM_DURATION = REGISTRY.histogram(
+    'kodiproxy_upstream_duration_seconds', 'Time for Kodi to answer forwarded requests')
+UPSTREAM_ERRORS = REGISTRY.counter(
+    'kodiproxy_upstream_errors_total', 'Forwarded requests Kodi did not answer', ('reason',))
+UPSTREAM_POOL = REGISTRY.counter(
+    'kodiproxy_upstream_pool_total', 'Connections to Kodi reused (hit) or opened (miss) by the pool, '
+    'idle ones closed (eviction) and requests sent again on a new one (retry)', ('result',))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'kodiproxy_cache_lookups_total', 'Lookups of responses of Kodi in the cache', ('result',))
+CACHE_REMOVALS = REGISTRY.counter(
+    'kodiproxy_cache_removals_total', 'Responses removed from the cache before expiring', ('reason',))
+CACHE_ENTRIES = REGISTRY.gauge(
+    'kodiproxy_cache_entries', 'Responses in the cache')
+CACHE_BYTES = REGISTRY.gauge(
+    'kodiproxy_cache_bytes', 'Size of the responses in the cache')
+SINGLE_FLIGHT = REGISTRY.counter(
+    'kodiproxy_single_flight_total', 'Read requests calling Kodi (leader) or sharing the call of an '
+    'identical one (coalesced)', ('role',))
+RECEIVER_DURATION = REGISTRY.histogram(
+    'kodiproxy_receiver_command_duration_seconds', 'Time for the receiver to run commands',
+    ('command',))
+RECEIVER_QUEUE_WAIT = REGISTRY.histogram(
+    'kodiproxy_receiver_queue_wait_seconds', 'Time receiver commands wait for the previous ones')
+RECEIVER_DEDUPLICATED = REGISTRY.counter(
+    'kodiproxy_receiver_deduplicated_total', 'Receiver status reads joining one already queued')
+RECEIVER_CONNECTIONS = REGISTRY.counter(
+    'kodiproxy_receiver_connections_total', 'Connections opened to the receiver')
+RECEIVER_EVENTS = REGISTRY.counter(
+    'kodiproxy_receiver_events_total', 'State changes pushed by the receiver', ('field',))
+RECEIVER_POLLS = REGISTRY.counter(
+    'kodiproxy_receiver_polls_total', 'Background reads of the receiver status', ('result',))
+RECEIVER_POLL_SECONDS = REGISTRY.counter(
+    'kodiproxy_receiver_poll_seconds_total', 'Time spent on background reads of the receiver status')
+CEC_DURATION = REGISTRY.histogram(
+    'kodiproxy_cec_command_duration_seconds', 'Time for cec-client to run commands', ('command',))
+
+_METHOD_PATTERN = re.compile(r'^([A-Za-z]+)\.[A-Za-z]+$')
+# the namespaces of the Kodi JSON-RPC API
+_KODI_NAMESPACES = frozenset((
+    'Addons', 'Application', 'AudioLibrary', 'Favourites', 'Files', 'GUI', 'Input', 'JSONRPC', 'PVR',
+    'Player', 'Playlist', 'Profiles', 'Settings', 'System', 'Textures', 'VideoLibrary', 'XBMC'))
+# the clients choose the methods: only the registered ones and the first ones seen in the Kodi
+# namespaces get their own label, which also keys per method state like the adaptive timeouts
+MAX_METHOD_LABELS = 256
+_method_labels = set()
+_method_labels_lock = threading.Lock()
+
+
+def register_method(method: str) -> None:
+    """Gives its own label to a method, whatever the number of methods already labelled"""
+    with _method_labels_lock:
+        _method_labels.add(method)
+
+
+def method_label(method: object) -> str:
+    """Label of a JSON-RPC method, 'other' for anything that is not known to be one"""
+    if not isinstance(method, str):
+        return 'other'
+    if method in _method_labels:
+        return method
+    match = _METHOD_PATTERN.match(method)
+    if not match or match.group(1) not in _KODI_NAMESPACES:
+        return 'other'
+    with _method_labels_lock:
+        if len(_method_labels) >= MAX_METHOD_LABELS:
+            return 'other'
+        _method_labels.add(method)
+    return method
+
+
+def observe_request(method: str, route: str, code: int, duration: float) -> None:
+    """Records a JSON-RPC request once answered"""
+    REQUESTS.inc(str(method), str(route), str(code))
+    REQUEST_DURATION.observe(duration, str(method), str(route))
@@ -0,0 +1,379 @@
+import heapq
+import http.client
+import itertools
+from kp import metrics
+from kp.httppool import STALE_ERRORS
+import logging
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib import error
+
+LOGGER = logging.getLogger('kodiproxy')
+
+
+class ReceiverConnection:
+    """Kept alive HTTP connection to the web interface of the receiver, reopened whenever the
+    receiver closes it. Not thread safe: it is owned by the thread of a CommandQueue"""
+
+    def __init__(self, host: str, port: Optional[int] = None, prefix: str = '/goform/'):
+        self.host = host
+        self.port = port or 80
+        self.prefix = prefix
+        self.opened = 0
+        self._conn = http.client.HTTPConnection(self.host, self.port)
+
+    def get(self, command: str, timeout: float) -> bytes:
+        """Sends the command and returns the body of the response. Raises HTTPError if the receiver
+        answers with an error.
+
+        If the connection turns out to have been closed by the receiver, the command is sent again
+        on a new one: the commands of the receiver set absolute values, they can be repeated"""
+        reused = self._conn.sock is not None
+        try:
+            return self._get(command, timeout)
+        except STALE_ERRORS as e:
+            if not reused:
+                raise
+            LOGGER.debug('Receiver connection was closed (%s), reconnecting', e)
+            return self._get(command, timeout)
+
+    def _get(self, command: str, timeout: float) -> bytes:
+        conn = self._conn
+        conn.timeout = timeout
+        if conn.sock is None:
+            self.opened += 1
+            metrics.RECEIVER_CONNECTIONS.inc()
+        else:
+            conn.sock.settimeout(timeout)
+        path = self.prefix + command
+        try:
+            conn.request('GET', path)
+            res = conn.getresponse()
+            body = res.read()
+        except BaseException:
+            # whatever was not read would be taken for the response to the next command
+            conn.close()
+            raise
+        if res.status >= 400:
+            raise error.HTTPError('http://{}:{}{}'.format(self.host, self.port, path),
+                                  res.status, res.reason, res.msg, None)
+        return body
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class _Job:
+    def __init__(self, function: Callable[[], Any], key: Optional[str]):
+        self.function = function
+        self.key = key
+        self.queued = time.monotonic()
+        self.started = False
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class CommandQueue:
+    """Runs the commands sent to the receiver one at a time, in a single thread, which is then the
+    only one using the connection. The embedded web servers of receivers are slow to accept
+    connections and do not cope well with concurrent requests.
+
+    Commands run by priority, then in the order they were submitted. A command submitted with a key
+    joins the queued command with the same key, if any: concurrent status reads are sent once. The
+    thread is started when needed and stops after idle_timeout seconds without commands, calling
+    on_idle (to close the connection)"""
+
+    COMMAND = 0
+    STATUS = 1
+    BACKGROUND = 2
+
+    def __init__(self, name: str, idle_timeout: float = 10,
+                 on_idle: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self._heap: List[Tuple[int, int, _Job]] = []
+        self._keyed: Dict[str, Tuple[int, _Job]] = dict()
+        self._order = itertools.count()
+        self._worker: Optional[threading.Thread] = None
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        """Number of commands waiting to run"""
+        with self._cond:
+            # a job whose priority was raised is in the heap twice
+            return len(set(job for _, _, job in self._heap if not job.started))
+
+    def submit(self, function: Callable[[], Any], priority: int = COMMAND,
+               key: Optional[str] = None) -> _Job:
+        """Queues function, returns the job whose done event is set once it ran"""
+        with self._cond:
+            queued = self._keyed.get(key) if key is not None else None
+            if queued is not None:
+                metrics.RECEIVER_DEDUPLICATED.inc()
+                queued_priority, job = queued
+                if priority >= queued_priority:
+                    return job
+                # queued again with the higher priority, the worker skips the job the second time
+                self._keyed[key] = (priority, job)
+            else:
+                job = _Job(function, key)
+                if key is not None:
+                    self._keyed[key] = (priority, job)
+            heapq.heappush(self._heap, (priority, next(self._order), job))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+            else:
+                self._cond.notify()
+        return job
+
+    def run(self, function: Callable[[], Any], priority: int = COMMAND,
+            key: Optional[str] = None) -> Any:
+        """Queues function, waits for it to run and returns its result or raises its exception"""
+        if threading.current_thread() is self._worker:
+            # from a running command, queuing would wait for ever
+            return function()
+        job = self.submit(function, priority, key)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _next(self) -> Optional[_Job]:
+        with self._cond:
+            deadline = time.monotonic() + self.idle_timeout
+            while True:
+                while self._heap:
+                    _, _, job = heapq.heappop(self._heap)
+                    if job.started:
+                        continue
+                    job.started = True
+                    if job.key is not None:
+                        del self._keyed[job.key]
+                    return job
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # under the lock, a new worker cannot use the connection while it is closed
+                    self._worker = None
+                    if self.on_idle:
+                        self.on_idle()
+                    return None
+                self._cond.wait(remaining)
+
+    def _run(self) -> None:
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            metrics.RECEIVER_QUEUE_WAIT.observe(time.monotonic() - job.queued)
+            try:
+                job.result = job.function()
+            except Exception as e:
+                job.error = e
+            finally:
+                job.done.set()
+
+
+class TelnetSession:
+    """Session of the line based control protocol of Denon and Marantz receivers (on port 23).
+
+    The receiver sends events, like MV45 or PWON, both in answer to commands and whenever its state
+    changes. A background thread keeps the connection open, reconnecting when it is lost, and gives
+    each line to on_line, which returns the kind of event it is (None to ignore it). The greeting
+    lines, with the kind of their answer, are sent on each connection to ask for the current state.
+
+    Commands are pipelined: they are sent as they come, one command_interval apart at least, without
+    waiting for the answers of the previous ones.
+
+    A receiver unplugged or off the network does not close the connection: after probe_interval
+    seconds without any line, the probe is sent, like a query of the greeting, and the connection
+    is dropped if nothing comes within probe_interval more seconds"""
+
+    def __init__(self, host: str, port: int, on_line: Callable[[str], Optional[str]],
+                 greeting: Tuple[Tuple[str, Optional[str]], ...] = (), command_interval: float = 0,
+                 on_disconnect: Optional[Callable[[], None]] = None,
+                 connect_timeout: float = 5, min_retry: float = 0.5, max_retry: float = 30,
+                 probe: Optional[Tuple[str, Optional[str]]] = None, probe_interval: float = 30):
+        self.host = host
+        self.port = port
+        self.on_line = on_line
+        self.greeting = greeting
+        self.command_interval = command_interval
+        self.on_disconnect = on_disconnect
+        self.connect_timeout = connect_timeout
+        self.min_retry = min_retry
+        self.max_retry = max_retry
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.opened = 0
+        self.connected = threading.Event()
+        self._sock: Optional[socket.socket] = None
+        self._received: Dict[str, int] = dict()
+        self._tickets: Dict[str, int] = dict()
+        # the last tickets of the lines sent on a lost connection, whose answers will not come
+        self._dropped: Dict[str, int] = dict()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._last_write = float('-inf')
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Starts connecting in the background, if it is not already"""
+        with self._cond:
+            if self._worker is None:
+                self._stopped.clear()
+                self._worker = threading.Thread(
+                    target=self._run, name='kodiproxy-receiver-telnet', daemon=True)
+                self._worker.start()
+
+    def stop(self) -> None:
+        """Closes the session and waits for its thread"""
+        with self._cond:
+            worker = self._worker
+            self._worker = None
+            self._stopped.set()
+            sock = self._sock
+        if sock:
+            # unblocks the read
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if worker:
+            worker.join()
+
+    def wait_connected(self, timeout: float) -> None:
+        """Opens the session if needed and waits for it, raises TimeoutError if it is not open in
+        time. Once connected, the greeting is sent"""
+        self.start()
+        if not self.connected.wait(timeout):
+            raise TimeoutError('Not connected to {}:{}'.format(self.host, self.port))
+
+    def _connection(self, timeout: float) -> socket.socket:
+        self.wait_connected(timeout)
+        with self._cond:
+            sock = self._sock
+        if sock is None:
+            raise ConnectionResetError('Connection to {}:{} lost'.format(self.host, self.port))
+        return sock
+
+    def send(self, line: str, kind: Optional[str] = None, timeout: float = 5) -> int:
+        """Sends the line, waiting up to timeout seconds for the connection. Returns the ticket to
+        wait for the answer with, an event of the given kind"""
+        return self._send(self._connection(timeout), line, kind)
+
+    def query(self, line: str, kind: str, timeout: float = 5) -> int:
+        """Same as send, for a query: if a line is already waiting for an event of the kind, its
+        ticket is returned instead of sending the query again"""
+        sock = self._connection(timeout)
+        with self._cond:
+            ticket = self._tickets.get(kind, 0)
+            if ticket > self._received.get(kind, 0):
+                return ticket
+        return self._send(sock, line, kind)
+
+    def _send(self, sock: socket.socket, line: str, kind: Optional[str]) -> int:
+        with self._cond:
+            ticket = 0
+            if kind is not None:
+                # the n-th event of a kind answers the n-th command sent for it
+                ticket = max(self._tickets.get(kind, 0), self._received.get(kind, 0)) + 1
+                self._tickets[kind] = ticket
+        with self._write_lock:
+            delay = self._last_write + self.command_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sock.sendall(bytes(line + '\r', 'ascii'))
+            self._last_write = time.monotonic()
+        return ticket
+
+    def wait(self, kind: str, ticket: int, timeout: float) -> bool:
+        """Waits for the answer of a command, returns False if it did not come in time"""
+        with self._cond:
+            if self._cond.wait_for(lambda: self._received.get(kind, 0) >= ticket, timeout):
+                return ticket > self._dropped.get(kind, 0)
+            # the receiver ignored the command: the next events of the kind answer the next
+            # commands, which would otherwise all wait for one more event than they get
+            self._received[kind] = ticket
+            return False
+
+    def command(self, line: str, kind: Optional[str], timeout: float) -> bool:
+        """Sends the line and waits for its answer, if kind is given. Returns whether it came"""
+        deadline = time.monotonic() + timeout
+        ticket = self.send(line, kind, timeout)
+        if kind is None:
+            return True
+        return self.wait(kind, ticket, deadline - time.monotonic())
+
+    def _run(self) -> None:
+        delay = self.min_retry
+        while not self._stopped.is_set():
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+            except OSError as e:
+                LOGGER.warning('Could not connect to the receiver at %s:%d: %s', self.host, self.port, e)
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_retry)
+                continue
+            delay = self.min_retry
+            sock.settimeout(self.probe_interval if self.probe and self.probe_interval > 0 else None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.opened += 1
+            metrics.RECEIVER_CONNECTIONS.inc()
+            with self._cond:
+                if self._stopped.is_set():
+                    sock.close()
+                    return
+                self._sock = sock
+            try:
+                # before any command
+                for line, kind in self.greeting:
+                    self._send(sock, line, kind)
+                self.connected.set()
+                self._read(sock)
+            except OSError as e:
+                LOGGER.info('Connection to the receiver lost: %s', e)
+            finally:
+                self.connected.clear()
+                with self._cond:
+                    self._sock = None
+                    for kind, ticket in self._tickets.items():
+                        if ticket > self._received.get(kind, 0):
+                            self._received[kind] = self._dropped[kind] = ticket
+                    self._cond.notify_all()
+                sock.close()
+                if self.on_disconnect:
+                    self.on_disconnect()
+
+    def _read(self, sock: socket.socket) -> None:
+        buffer = b''
+        probing = False
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                if probing:
+                    raise TimeoutError('No answer from the receiver for {}s'.format(
+                        2 * self.probe_interval)) from None
+                line, kind = self.probe
+                self._send(sock, line, kind)
+                probing = True
+                continue
+            if not data:
+                return
+            probing = False
+            *lines, buffer = (buffer + data).split(b'\r')
+            for line in lines:
+                line = line.strip().decode('ascii', 'replace')
+                if not line:
+                    continue
+                kind = self.on_line(line)
+                if kind is not None:
+                    with self._cond:
+                        self._received[kind] = self._received.get(kind, 0) + 1
+                        self._cond.notify_all()
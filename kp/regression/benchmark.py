@@ -0,0 +1,279 @@
+import argparse
+import json
+from kp.regression.microbench import library_response
+from kp.regression.mock_server import MockResponse, MockServer, lognormal_latency
+from kp.regression.offline import (JRPC_PORT, KODI_RESULT, PROXY_URL, RECEIVER_PORT, TELNET_PORT,
+                                   add_default_mocks)
+from kp.regression.telnet_simulator import TelnetSimulator
+from kp.replay import replay
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+from urllib.request import urlopen
+
+ENGINES = {
+    'threading': 'kp/regression/kodiproxy_reg.json',
+    'asyncio': 'kp/regression/kodiproxy_reg_asyncio.json',
+    # the threading engine, with the telnet backend of the receiver
+    'telnet': 'kp/regression/kodiproxy_reg_telnet.json'
+}
+
+_POOL_COUNTER = re.compile(r'^kodiproxy_upstream_pool_total\{result="(\w+)"\} (\S+)$')
+
+
+class Scenario:
+    """Kind of traffic sent to the proxy. call gives the i-th request (method, params and id, or a
+    batch of them) and kodi_response what the mock of Kodi answers"""
+
+    def __init__(self, name: str, call: Callable[[int], Dict[str, Any]],
+                 kodi_response: bytes = KODI_RESULT):
+        self.name = name
+        self.call = call
+        self.kodi_response = kodi_response
+
+    def entries(self, count: int) -> List[Dict[str, Any]]:
+        # all at the same time, the replay sends them as fast as the clients can
+        return [dict(time=0, **self.call(i)) for i in range(count)]
+
+
+def _call(method: str, params: Optional[dict] = None, i: int = 1) -> Dict[str, Any]:
+    return {'method': method, 'params': params or {}, 'id': i}
+
+
+SCENARIOS = [
+    Scenario('forward', lambda i: _call('JSONRPC.Ping', i=i)),
+    Scenario('volume', lambda i: [
+        _call('Application.SetVolume', {'volume': 'increment'}, i),
+        _call('Application.SetVolume', {'volume': 'decrement'}, i),
+        _call('Application.SetMute', {'mute': 'toggle'}, i)][i % 3]),
+    Scenario('properties', lambda i: [
+        _call('Application.GetProperties', {'properties': ['volume', 'muted']}, i),
+        _call('Application.GetProperties', {'properties': ['volume', 'muted', 'name', 'version']}, i),
+        _call('Application.GetProperties', {'properties': ['name', 'version']}, i)][i % 3]),
+    Scenario('library', lambda i: _call('VideoLibrary.GetMovies', {
+        'properties': ['title', 'year', 'genre', 'plot', 'file', 'art']}, i),
+        kodi_response=library_response(2000)),
+    Scenario('batch', lambda i: {'batch': [
+        _call('Application.GetProperties', {'properties': ['volume', 'muted']}, 1),
+        _call('Player.GetActivePlayers', i=2),
+        _call('XBMC.GetInfoLabels', {'labels': ['System.Time']}, 3)]})
+]
+
+
+class ProxyProcess:
+    """Runs the proxy in its own process, so its CPU time and memory can be measured"""
+
+    def __init__(self, conf_path: str):
+        self.conf_path = conf_path
+        self.process: subprocess.Popen = None
+
+    def __enter__(self) -> 'ProxyProcess':
+        self.process = subprocess.Popen([
+            sys.executable, '-c', 'import sys; from kp.main import setup_and_start; setup_and_start(sys.argv[1])',
+            self.conf_path])
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('localhost', 43210), timeout=1).close()
+                return self
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.process.kill()
+                    raise RuntimeError('The proxy did not start')
+                time.sleep(0.05)
+
+    def __exit__(self, *args) -> None:
+        try:
+            urlopen(PROXY_URL.replace('/jsonrpc', '/quit'), timeout=5)
+            self.process.wait(10)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+
+    def cpu_time(self) -> Optional[float]:
+        """User and system CPU seconds used so far, None where /proc is not available"""
+        try:
+            with open('/proc/{}/stat'.format(self.process.pid)) as stat:
+                # the fields after the name of the command, which may contain spaces
+                fields = stat.read().rpartition(')')[2].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def peak_rss(self) -> Optional[int]:
+        """Highest resident memory in kB since the last reset_peak_rss"""
+        try:
+            with open('/proc/{}/status'.format(self.process.pid)) as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def pool_counters(self) -> Dict[str, int]:
+        """Connections to Kodi reused (hit), opened (miss)... by the pool of the proxy so far, from
+        its metrics"""
+        counters = dict()
+        with urlopen(PROXY_URL.replace('/jsonrpc', '/metrics'), timeout=5) as response:
+            for line in response.read().decode('utf-8').splitlines():
+                match = _POOL_COUNTER.match(line)
+                if match:
+                    counters[match.group(1)] = int(float(match.group(2)))
+        return counters
+
+    def reset_peak_rss(self) -> None:
+        try:
+            with open('/proc/{}/clear_refs'.format(self.process.pid), 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            pass
+
+
+def run_scenario(proxy: ProxyProcess, jrpc_mock: MockServer, receiver_mock: MockServer,
+                 scenario: Scenario, requests: int, clients: int,
+                 kodi_latency: float = 0) -> Dict[str, Any]:
+    jrpc_mock.reset_mocks()
+    receiver_mock.reset_mocks()
+    add_default_mocks(jrpc_mock, receiver_mock)
+    # the same latencies for each run, so that runs can be compared
+    latency = lognormal_latency(kodi_latency, seed=1) if kodi_latency else 0
+    jrpc_mock.mocks['kodi'] = MockResponse(
+        responses=[(200, scenario.kodi_response)], latency=latency)
+    # warms up the connection pools and the caches of the proxy
+    replay(scenario.entries(clients * 2), PROXY_URL, speed=0, concurrency=clients)
+    proxy.reset_peak_rss()
+    pool_start = proxy.pool_counters()
+    cpu_start = proxy.cpu_time()
+    report = replay(scenario.entries(requests), PROXY_URL, speed=0, concurrency=clients)
+    cpu_end = proxy.cpu_time()
+    pool_end = proxy.pool_counters()
+    latency = report.percentiles()
+    result = {
+        'requests': report.count,
+        'errors': report.errors,
+        'throughput': round(report.throughput, 3),
+        'p50': round(latency['p50'], 6),
+        'p95': round(latency['p95'], 6),
+        'p99': round(latency['p99'], 6),
+        'max': round(max(l for ls in report.latencies.values() for l in ls), 6),
+        'cpuTime': None,
+        'cpuPerRequest': None,
+        'peakRss': proxy.peak_rss(),
+        # connections to Kodi reused and opened while measuring
+        'poolReused': pool_end.get('hit', 0) - pool_start.get('hit', 0),
+        'poolOpened': pool_end.get('miss', 0) - pool_start.get('miss', 0)
+    }
+    if cpu_start is not None:
+        result['cpuTime'] = round(cpu_end - cpu_start, 3)
+        result['cpuPerRequest'] = round((cpu_end - cpu_start) / max(report.count, 1), 6)
+    return result
+
+
+def run_benchmark(engines: List[str], scenarios: List[Scenario], requests: int,
+                  clients: int, kodi_latency: float = 0) -> Dict[str, Any]:
+    """Runs the scenarios against the proxy of each engine. Returns the results by engine and by
+    scenario. kodi_latency is the median time the mock of Kodi takes to answer"""
+    results = {
+        'time': round(time.time()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'requests': requests,
+        'clients': clients,
+        'kodiLatency': kodi_latency,
+        'engines': dict()
+    }
+    # like Kodi, the mock keeps the connections open for the pool of the proxy
+    jrpc_mock = MockServer(JRPC_PORT, keep_alive=True)
+    receiver_mock = MockServer(RECEIVER_PORT)
+    # in the same state as the mock of the web interface
+    simulator = TelnetSimulator(TELNET_PORT, power=True, input='AUXB', volume=45)
+    try:
+        for engine in engines:
+            with ProxyProcess(ENGINES[engine]) as proxy:
+                for scenario in scenarios:
+                    results['engines'].setdefault(engine, dict())[scenario.name] = run_scenario(
+                        proxy, jrpc_mock, receiver_mock, scenario, requests, clients, kodi_latency)
+    finally:
+        jrpc_mock.shutdown()
+        receiver_mock.shutdown()
+        simulator.shutdown()
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns the regressions of the results compared to the baseline: throughput lower or p95
+    latency, CPU time per request or peak memory higher by more than the threshold (0.1 is 10%)"""
+    # the metrics, and whether higher is better
+    metrics = (('throughput', True), ('p95', False), ('cpuPerRequest', False), ('peakRss', False))
+    regressions = []
+    for engine, scenarios in results['engines'].items():
+        for name, result in scenarios.items():
+            base = baseline.get('engines', {}).get(engine, {}).get(name)
+            if base is None:
+                continue
+            for metric, higher_is_better in metrics:
+                value, reference = result.get(metric), base.get(metric)
+                if not value or not reference:
+                    continue
+                change = value / reference - 1
+                if (-change if higher_is_better else change) > threshold:
+                    regressions.append('{} {} {}: {} -> {} ({:+.1%})'.format(
+                        engine, name, metric, reference, value, change))
+    return regressions
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    lines = ['{:<10} {:<11} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10} {:>9} {:>7} {:>7}'.format(
+        'engine', 'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'errors', 'cpu ms/req',
+        'rss kB', 'reused', 'opened')]
+    for engine, scenarios in results['engines'].items():
+        for name, r in scenarios.items():
+            cpu = '-' if r['cpuPerRequest'] is None else '{:.3f}'.format(r['cpuPerRequest'] * 1000)
+            lines.append('{:<10} {:<11} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8} {:>10} {:>9} {:>7} {:>7}'.format(
+                engine, name, r['throughput'], r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000,
+                r['max'] * 1000, r['errors'], cpu, r['peakRss'] or '-', r.get('poolReused', '-'),
+                r.get('poolOpened', '-')))
+    return '\n'.join(lines)
+
+
+def main_benchmark(argv: Optional[List[str]] = None) -> int:
+    scenario_names = [s.name for s in SCENARIOS]
+    parser = argparse.ArgumentParser(
+        description='Measures the throughput and latency of the proxy against mocks of Kodi and the receiver')
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument('--scenarios', nargs='+', choices=scenario_names, default=scenario_names)
+    parser.add_argument('--requests', type=int, default=500, help='requests sent by scenario')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--kodi-latency', type=float, default=0,
+                        help='median seconds the mock of Kodi takes to answer (default 0)')
+    parser.add_argument('--save', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON file of previous results to compare to')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change counted as a regression (default 0.1)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.engines, [s for s in SCENARIOS if s.name in args.scenarios],
+                            args.requests, args.clients, args.kodi_latency)
+    print(format_results(results))
+    if args.save:
+        with open(args.save, 'w') as save:
+            json.dump(results, save, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        if regressions:
+            print('\nRegressions compared to {}:'.format(args.baseline))
+            print('\n'.join(regressions))
+            return 1
+        print('\nNo regression compared to {}'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
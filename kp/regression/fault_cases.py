@@ -0,0 +1,43 @@
+from kp.regression.regression_case import RegressionCase
+from kp.regression import mock_server
+from kp.regression.mock_server import MockResponse
+import time
+
+PONG = b'{"jsonrpc": "2.0", "id": 321, "result": "pong"}'
+
+
+class FaultCase(RegressionCase):
+    def test_slow(self):
+        """Slow answers of the jrpc server are waited for"""
+        self.jrpc_mock.add_mock('slow', MockResponse(
+            responses=[(200, PONG)], path='/jsonrpc', latency=0.3))
+
+        start = time.monotonic()
+        code, payload = self.open_jrpc('JSONRPC.Ping', {})
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(code, 200)
+        self.assertPayloadEqual(payload, 'pong')
+
+    def test_timeout(self):
+        """The client is told when the jrpc server does not answer in time"""
+        self.jrpc_mock.add_mock('hang', MockResponse(
+            responses=[mock_server.hang(3)], path='/jsonrpc'))
+
+        start = time.monotonic()
+        code, _ = self.open_jrpc('JSONRPC.Ping', {})
+
+        self.assertEqual(code, 408)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_reset(self):
+        """A connection reset by the jrpc server fails the request, not the next ones"""
+        self.jrpc_mock.add_mock('reset', MockResponse(
+            responses=[mock_server.RESET, (200, PONG)], path='/jsonrpc', cycle=False))
+
+        code, _ = self.open_jrpc('JSONRPC.Ping', {})
+        self.assertEqual(code, 500)
+
+        code, payload = self.open_jrpc('JSONRPC.Ping', {})
+        self.assertEqual(code, 200)
+        self.assertPayloadEqual(payload, 'pong')
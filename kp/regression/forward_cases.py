@@ -0,0 +1,48 @@
+import json
+from kp.regression.regression_case import RegressionCase
+from kp.regression.mock_server import MockResponse
+
+
+class ForwardCase(RegressionCase):
+    def test_forward(self):
+        """Queries that are not overloaded are forwarded to the jrpc server"""
+        self.jrpc_mock.add_mock('players', MockResponse(
+            responses=[(200, b'{"jsonrpc": "2.0", "id": 321, "result": []}')], path='/jsonrpc'))
+
+        code, payload = self.open_jrpc('Player.GetActivePlayers', {})
+
+        self.assertEqual(code, 200)
+        self.assertPayloadEqual(payload, [])
+        self.assertEqual(len(self.jrpc_mock.queries), 1)
+        self.assertEqual(json.loads(self.jrpc_mock.queries[0].payload)[
+                         'method'], 'Player.GetActivePlayers')
+        self.assertEqual(len(self.receiver_mock.queries), 0)
+
+    def test_forward_error(self):
+        """Errors of the jrpc server are given back to the client"""
+        self.jrpc_mock.add_mock('error', MockResponse(
+            responses=[(503, b'unavailable')], path='/jsonrpc'))
+
+        code, _ = self.open_jrpc('Player.GetActivePlayers', {})
+
+        self.assertEqual(code, 503)
+
+    def test_batch(self):
+        """Batches are split between the overloaders and the jrpc server"""
+        self.jrpc_mock.add_mock('players', MockResponse(
+            responses=[(200, b'[{"jsonrpc": "2.0", "id": 1, "result": []}]')], path='/jsonrpc'))
+
+        query = [
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'Player.GetActivePlayers'},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'System.GetProperties',
+             'params': {'properties': ['canreboot']}}
+        ]
+        code, payload = self.open_raw(query)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(payload, [
+            {'jsonrpc': '2.0', 'id': 1, 'result': []},
+            {'jsonrpc': '2.0', 'id': 2, 'result': {'canreboot': True}}
+        ])
+        self.assertEqual(len(self.jrpc_mock.queries), 1)
+        self.assertEqual(json.loads(self.jrpc_mock.queries[0].payload), query[:1])
@@ -1,5 +1,9 @@
+import json
 from kp.main import setup_and_start
 from kp.regression.mock_server import MockServer
+from kp.regression.telnet_simulator import TelnetSimulator
+from kp.regression.fault_cases import FaultCase
+from kp.regression.forward_cases import ForwardCase
 from kp.regression.regression_case import RegressionCase
 from kp.regression.power_cases import PowerCase
 from kp.regression.volume_cases import VolumeCase
@@ -11,16 +15,24 @@ import unittest
 from urllib.request import urlopen
 
 
+REGRESSION_CONFIGURATIONS = [
+    'kp/regression/kodiproxy_reg.json',
+    'kp/regression/kodiproxy_reg_asyncio.json',
+    'kp/regression/kodiproxy_reg_telnet.json'
+]
+
+
 def get_suite(testClass) -> unittest.TestSuite:
     return unittest.TestLoader().loadTestsFromTestCase(testClass)
 
 
-def main_regression() -> int:
-    RegressionCase.JRPC_MOCK = MockServer(43211)
-    RegressionCase.RECEIVER_MOCK = MockServer(43212)
+def run_regression(conf_path: str) -> int:
+    """Starts the proxy with the given configuration and runs the regression cases against it"""
+    with open(conf_path) as conf_file:
+        RegressionCase.RECEIVER_CONF = json.load(conf_file).get('receiver', {})
     event = threading.Event()
     server_thread = threading.Thread(target=setup_and_start, args=[
-        'kp/regression/kodiproxy_reg.json', event])
+        conf_path, event])
     server_thread.start()
 
     event.wait()
@@ -29,7 +41,7 @@ def main_regression() -> int:
 
     try:
         suite = unittest.TestSuite()
-        suite.addTests(map(get_suite, [PowerCase, VolumeCase]))
+        suite.addTests(map(get_suite, [FaultCase, ForwardCase, PowerCase, VolumeCase]))
 
         runner = unittest.TextTestRunner(verbosity=2)
         res = runner.run(suite)
@@ -42,8 +54,22 @@ def main_regression() -> int:
     # asks the server to shut down
     urlopen('http://localhost:43210/quit')
 
+    server_thread.join()
+    return return_code
+
+
+def main_regression() -> int:
+    RegressionCase.JRPC_MOCK = MockServer(43211)
+    RegressionCase.RECEIVER_MOCK = MockServer(43212)
+    RegressionCase.TELNET_SIMULATOR = TelnetSimulator(43213)
+
+    return_code = 0
+    for conf_path in REGRESSION_CONFIGURATIONS:
+        print('Running regression with configuration {}'.format(conf_path))
+        return_code = max(return_code, run_regression(conf_path))
+
     RegressionCase.JRPC_MOCK.shutdown()
     RegressionCase.RECEIVER_MOCK.shutdown()
+    RegressionCase.TELNET_SIMULATOR.shutdown()
 
-    server_thread.join()
     return return_code
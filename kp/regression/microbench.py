@@ -0,0 +1,378 @@
+import argparse
+import functools
+import gc
+import importlib
+import inspect
+import http.client
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+VOLUME_STATUS = b"""<?xml version="1.0" encoding="utf-8" ?>
+<item>
+<MasterVolume><value>-35.0</value></MasterVolume>
+<Mute><value>off</value></Mute>
+</item>"""
+
+# as sent by the Kore remote
+REQUEST_HEADERS = (b'Host: 192.168.1.20:8080\r\nUser-Agent: okhttp/4.9.3\r\nAccept: */*\r\n'
+                   b'Accept-Encoding: gzip\r\nConnection: keep-alive\r\n'
+                   b'Content-Type: application/json; charset=utf-8\r\nContent-Length: 98\r\n'
+                   b'Authorization: Basic a29kaTprb2Rp\r\n\r\n')
+# as sent by Kodi
+RESPONSE_HEADERS = (b'Connection: Keep-Alive\r\nContent-Length: 47\r\n'
+                    b'Content-Type: application/json\r\nDate: Sun, 18 Oct 2026 20:10:00 GMT\r\n\r\n')
+
+
+def library_response(movies: int, req_id: Any = 1) -> bytes:
+    """Response of Kodi to VideoLibrary.GetMovies, with as many movies as given"""
+    return bytes(json.dumps({'jsonrpc': '2.0', 'id': req_id, 'result': {
+        'limits': {'start': 0, 'end': movies, 'total': movies},
+        'movies': [{
+            'movieid': i,
+            'label': 'Movie {}'.format(i),
+            'title': 'Movie {}'.format(i),
+            'year': 1950 + i % 70,
+            'genre': ['Drama', 'Comedy'],
+            'plot': 'A plot that goes on for a while. ' * 8,
+            'file': '/storage/movies/movie_{}.mkv'.format(i),
+            'art': {'poster': 'image://poster_{}.jpg/'.format(i), 'fanart': 'image://fanart_{}.jpg/'.format(i)}
+        } for i in range(movies)]}}), 'utf-8')
+
+
+def _fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), 'rb') as fixture:
+        return fixture.read()
+
+
+def _headers(raw: bytes) -> http.client.HTTPMessage:
+    return http.client.parse_headers(io.BytesIO(raw))
+
+
+class _StubBody:
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.length = len(payload)
+
+    def chunks(self):
+        yield self.payload
+
+    def read(self) -> bytes:
+        return self.payload
+
+    def close(self) -> None:
+        pass
+
+
+class _StubPool:
+    """Answers right away, so only the work of the proxy is measured"""
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.headers = _headers(RESPONSE_HEADERS)
+
+    def open(self, body: bytes, headers, retry: bool = False, timeout: float = None):
+        return 200, _StubBody(self.payload), self.headers
+
+    def request(self, body: bytes, headers, retry: bool = False, timeout: float = None):
+        return 200, self.payload, self.headers
+
+
+class Unavailable(Exception):
+    """The code measured by a benchmark does not exist in the revision it runs against"""
+
+
+def _import(module: str, *names: str) -> Any:
+    """Imports a module having the given attributes, raises Unavailable otherwise"""
+    try:
+        imported = importlib.import_module(module)
+    except ImportError:
+        raise Unavailable('no module {}'.format(module))
+    for name in names:
+        if not hasattr(imported, name):
+            raise Unavailable('no {}.{}'.format(module, name))
+    return imported
+
+
+def _checked(op: Callable[[], Any], check: Callable[[Any], bool]) -> Callable[[], Any]:
+    """Runs op once and returns it if check accepts its result: otherwise the benchmark would
+    measure how fast the code fails"""
+    result = op()
+    if not check(result):
+        raise AssertionError('Unexpected result: {!r:.200}'.format(result))
+    return op
+
+
+def _answered(response: Any) -> bool:
+    """Whether the response of a handler is a 200 with results for all the queries"""
+    code, payload, _ = response
+    if code != 200:
+        return False
+    if hasattr(payload, 'read'):
+        payload = payload.read()
+    decoded = json.loads(payload)
+    return all('result' in item for item in (decoded if isinstance(decoded, list) else [decoded]))
+
+
+def _overloaders() -> dict:
+    from kp.jrpc.jrpcserver import JRPCOverloader
+
+    # --compare runs the benchmarks against older revisions too: there, the overloaders are
+    # registered as providers, called with the handler of each request, and get no context
+    class Overloader(JRPCOverloader):
+        def __call__(self, handler):
+            return self
+
+        def overload_query(self, params, context=None):
+            return 200, {'volume': 75, 'muted': False}, None
+
+    return {'Application.GetProperties': Overloader()}
+
+
+def _dispatch(request: Any, upstream: Optional[bytes] = None) -> Callable[[], Any]:
+    """Dispatch of the request by a handler of the jrpc server, Kodi answering upstream. The server
+    is only used through the methods it has had from the start, to run against any revision"""
+    jrpcserver = _import('kp.jrpc.jrpcserver', 'JRPCServer')
+    server = jrpcserver.JRPCServer({'target': 'http://localhost:8081/jsonrpc'})
+    for method, overloader in _overloaders().items():
+        server.register_overloader(method, overloader)
+    if upstream is not None:
+        if not hasattr(server, 'pool'):
+            # the requests were sent with urllib, there is nothing to stub
+            raise Unavailable('no connection pool to Kodi')
+        server.pool = server.async_pool = _StubPool(upstream)
+    headers = {'content-type': 'application/json'}
+    body = bytes(json.dumps(request), 'utf-8')
+    # a handler is created for each request
+    return _checked(lambda: server.get_handler(body, headers).dispatch(), _answered)
+
+
+def bench_avstatus_full() -> Callable[[], Any]:
+    from kp.avreceiver import AVStatus
+    status = _fixture('denon_status.xml')
+    return _checked(lambda: AVStatus(status), lambda result: result.input is not None)
+
+
+def bench_avstatus_volume() -> Callable[[], Any]:
+    from kp.avreceiver import AVStatus
+    return _checked(lambda: AVStatus(VOLUME_STATUS), lambda result: result.volume == -35)
+
+
+def bench_dispatch_forward() -> Callable[[], Any]:
+    return _dispatch({'jsonrpc': '2.0', 'id': 1, 'method': 'Player.Open',
+                      'params': {'item': {'movieid': 12}}},
+                     b'{"jsonrpc": "2.0", "id": 1, "result": "OK"}')
+
+
+def bench_dispatch_overloaded() -> Callable[[], Any]:
+    return _dispatch({'jsonrpc': '2.0', 'id': 1, 'method': 'Application.GetProperties',
+                      'params': {'properties': ['volume', 'muted']}})
+
+
+def bench_dispatch_batch_library() -> Callable[[], Any]:
+    return _dispatch([
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'Application.GetProperties',
+         'params': {'properties': ['volume', 'muted']}},
+        {'jsonrpc': '2.0', 'id': 2, 'method': 'VideoLibrary.GetMovies',
+         'params': {'properties': ['title', 'year', 'genre', 'plot', 'file', 'art']}}
+    ], b'[' + library_response(500, 2) + b']')
+
+
+def bench_enrich_http() -> Callable[[], Any]:
+    overloader = _overloaders()['Application.GetProperties']
+    payload = {'result': {'volume': 75, 'muted': False}}
+    if 'req_id' in inspect.signature(overloader._enrich_http).parameters:
+        op = functools.partial(overloader._enrich_http, payload, 1)
+    else:
+        # before the request context, the id was an attribute of the overloader
+        overloader.id = 1
+        op = functools.partial(overloader._enrich_http, payload)
+    return _checked(op, lambda result: json.loads(result[0])['id'] == 1)
+
+
+def bench_headers_lower() -> Callable[[], Any]:
+    httputils = _import('kp.httputils', 'lower_headers')
+    headers = _headers(REQUEST_HEADERS)
+    return _checked(lambda: httputils.lower_headers(headers),
+                    lambda result: result.get('content-length') == '98')
+
+
+def bench_headers_relayable() -> Callable[[], Any]:
+    httputils = _import('kp.httputils', 'relayable_headers')
+    headers = _headers(RESPONSE_HEADERS)
+    return _checked(lambda: httputils.relayable_headers(headers),
+                    lambda result: 'content-type' in result and 'connection' not in result)
+
+
+def bench_confbase_getattr() -> Callable[[], Any]:
+    from kp.avreceiver import AVReceiver
+    from kp.confbase import KPConfBase
+    conf = KPConfBase(AVReceiver, {'ip': '192.168.1.30'})
+    # a default value, the most common case, of a key that has always been there
+    return _checked(lambda: conf.desiredInput, lambda result: result == 'AUXB')
+
+
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {
+    'avstatus.full': bench_avstatus_full,
+    'avstatus.volume': bench_avstatus_volume,
+    'dispatch.forward': bench_dispatch_forward,
+    'dispatch.overloaded': bench_dispatch_overloaded,
+    'dispatch.batch_library': bench_dispatch_batch_library,
+    'overloader.enrich_http': bench_enrich_http,
+    'headers.lower': bench_headers_lower,
+    'headers.relayable': bench_headers_relayable,
+    'confbase.getattr': bench_confbase_getattr
+}
+
+
+def _time(op: Callable[[], Any], loops: int) -> float:
+    # like timeit, the garbage collector would add noise
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(loops):
+            op()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def measure(op: Callable[[], Any], min_time: float = 0.1, repeat: int = 5) -> Dict[str, float]:
+    """Returns the time of op in ns (the best of repeat runs of at least min_time seconds) and the
+    bytes it allocates (the peak of the traced memory while it runs)"""
+    loops = 1
+    while _time(op, loops) < min_time:
+        loops *= 2
+    ns = min(_time(op, loops) for _ in range(repeat)) / loops * 1e9
+
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(5):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            op()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    return {'ns': round(ns, 1), 'allocBytes': min(peaks)}
+
+
+def run(names: List[str], min_time: float = 0.1) -> Dict[str, Any]:
+    # like in production, the logs are not written
+    logger = logging.getLogger('kodiproxy')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.ERROR)
+    results = {'python': platform.python_version(), 'benchmarks': dict()}
+    for name in names:
+        try:
+            op = BENCHMARKS[name]()
+        except Unavailable as e:
+            results['benchmarks'][name] = {'skipped': str(e)}
+            continue
+        except Exception as e:
+            results['benchmarks'][name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            continue
+        results['benchmarks'][name] = measure(op, min_time)
+    return results
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    lines = ['{:<28} {:>12} {:>12}'.format('benchmark', 'ns/op', 'alloc B/op')]
+    for name, result in results['benchmarks'].items():
+        if 'error' in result:
+            lines.append('{:<28} {}'.format(name, result['error']))
+        elif 'skipped' in result:
+            lines.append('{:<28} skipped: {}'.format(name, result['skipped']))
+        else:
+            lines.append('{:<28} {:>12.1f} {:>12}'.format(name, result['ns'], result['allocBytes']))
+    return '\n'.join(lines)
+
+
+def run_revision(revision: Optional[str], names: List[str], min_time: float) -> Dict[str, Any]:
+    """Runs the benchmarks in a separate process against the code of a git revision, or of the
+    working tree if revision is None"""
+    root = subprocess.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True,
+                          check=True, text=True).stdout.strip()
+    directory = None
+    if revision is not None:
+        directory = tempfile.mkdtemp(prefix='kodiproxy-microbench-')
+        archive = subprocess.run(['git', 'archive', revision], cwd=root, capture_output=True,
+                                 check=True).stdout
+        subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+    try:
+        code = directory or root
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--json', '--min-time', str(min_time),
+             '--benchmarks'] + names,
+            cwd=code, env=dict(os.environ, PYTHONPATH=code), capture_output=True, check=True,
+            text=True).stdout
+        return json.loads(output)
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+
+
+def compare(base: Dict[str, Any], head: Dict[str, Any], threshold: float) -> List[str]:
+    """Table of the changes from base to head. The lines of the benchmarks slower by more than the
+    threshold (0.1 is 10%) are flagged"""
+    lines = ['{:<28} {:>12} {:>12} {:>8} {:>12} {:>12}'.format(
+        'benchmark', 'base ns/op', 'head ns/op', 'change', 'base B/op', 'head B/op')]
+    for name, result in head['benchmarks'].items():
+        reference = base['benchmarks'].get(name, {'skipped': 'missing'})
+        if 'error' in result or 'error' in reference:
+            lines.append('{:<28} {}'.format(name, result.get('error') or reference.get('error')))
+            continue
+        if 'skipped' in result or 'skipped' in reference:
+            lines.append('{:<28} skipped: {}'.format(name, result.get('skipped') or reference.get('skipped')))
+            continue
+        change = result['ns'] / reference['ns'] - 1
+        lines.append('{:<28} {:>12.1f} {:>12.1f} {:>+8.1%} {:>12} {:>12}{}'.format(
+            name, reference['ns'], result['ns'], change, reference['allocBytes'],
+            result['allocBytes'], '  REGRESSION' if change > threshold else ''))
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Measures the time and memory of the per request work of the proxy')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='seconds each measure runs for at least (default 0.1)')
+    parser.add_argument('--json', action='store_true', help='prints the results as JSON')
+    parser.add_argument('--compare', nargs='+', metavar='REVISION',
+                        help='compares two git revisions, the second one defaulting to the working tree')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown counted as a regression by --compare (default 0.1)')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        if len(args.compare) > 2:
+            parser.error('--compare takes one or two revisions')
+        base = run_revision(args.compare[0], args.benchmarks, args.min_time)
+        head = run_revision(args.compare[1] if len(args.compare) > 1 else None,
+                            args.benchmarks, args.min_time)
+        lines = compare(base, head, args.threshold)
+        print('\n'.join(lines))
+        return 1 if any(line.endswith('REGRESSION') for line in lines) else 0
+
+    results = run(args.benchmarks, args.min_time)
+    print(json.dumps(results) if args.json else format_results(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
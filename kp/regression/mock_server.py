@@ -1,18 +1,69 @@
 import http.server
+import math
+import random
+import socket
+import struct
 from urllib import parse
 import threading
-from typing import Any, Dict, List, Tuple
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+
+class MockFault:
+    """Response of a mock that is not an answer: the connection is reset or closed right away, or the
+    mock hangs for duration seconds before closing it, like a server that stopped responding"""
+
+    RESET = 'reset'
+    CLOSE = 'close'
+    HANG = 'hang'
+
+    def __init__(self, kind: str, duration: float = 0) -> None:
+        self.kind = kind
+        self.duration = duration
+
+
+RESET = MockFault(MockFault.RESET)
+CLOSE = MockFault(MockFault.CLOSE)
+
+
+def hang(duration: float) -> MockFault:
+    return MockFault(MockFault.HANG, duration)
+
+
+Latency = Union[float, Callable[[], float]]
+
+
+def uniform_latency(low: float, high: float, seed: Optional[int] = None) -> Callable[[], float]:
+    """Latencies evenly spread between low and high seconds"""
+    rand = random.Random(seed)
+    return lambda: rand.uniform(low, high)
+
+
+def lognormal_latency(median: float, sigma: float = 0.5, seed: Optional[int] = None) -> Callable[[], float]:
+    """Latencies around median seconds with a long tail, like most real servers"""
+    rand = random.Random(seed)
+    return lambda: rand.lognormvariate(math.log(median), sigma)
 
 
 class MockResponse:
-    """Small class to help mock response of an HTTP server"""
+    """Small class to help mock response of an HTTP server.
 
-    def __init__(self, responses: Tuple[int, bytes],
-                 method: str = None, path: str = None) -> None:
+    Each response is either a (code, payload) tuple or a MockFault. They are used in turn, starting
+    over after the last one unless cycle is False, in which case the last one is kept: this scripts
+    failure sequences like [RESET, RESET, (200, b'...')]. latency (seconds, or a function giving
+    them) delays the responses and bandwidth (bytes per second) throttles their payloads"""
+
+    def __init__(self, responses: List[Union[Tuple[int, bytes], MockFault]],
+                 method: str = None, path: str = None, latency: Latency = 0,
+                 bandwidth: Optional[float] = None, cycle: bool = True) -> None:
         self.index = 0
         self.responses = responses
         self.method = method
         self.path = path
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.cycle = cycle
+        self._lock = threading.Lock()
 
     def match(self, method: str, path: str) -> bool:
         """Returns whether this mock fits the request"""
@@ -22,12 +73,19 @@ class MockResponse:
             return False
         return True
 
-    def get_response(self) -> Tuple[int, bytes]:
+    def get_response(self) -> Union[Tuple[int, bytes], MockFault]:
         """Returns the current response to send. It cycles through its responses"""
-        res = self.responses[self.index]
-        self.index = (self.index + 1) % len(self.responses)
+        with self._lock:
+            res = self.responses[self.index]
+            if self.cycle:
+                self.index = (self.index + 1) % len(self.responses)
+            else:
+                self.index = min(self.index + 1, len(self.responses) - 1)
         return res
 
+    def get_latency(self) -> float:
+        return self.latency() if callable(self.latency) else self.latency
+
 
 class MockQuery:
     """Small class to help keep track of the queries made to the HTTP server"""
@@ -42,11 +100,23 @@ class MockQuery:
         return '{}: {} {}\n{}'.format(self.name, self.method, self.path, self.payload)
 
 
+class _MockHTTPServer(http.server.ThreadingHTTPServer):
+    # the proxy opens many connections at once under load
+    request_queue_size = 128
+
+
 class MockServer:
-    """Small mock HTTP server"""
+    """Small mock HTTP server, answering each connection in its own thread.
+
+    Unless keep_alive is set, connections are closed after each response"""
     @staticmethod
-    def ProvideMockHandler(server):
+    def ProvideMockHandler(server, keep_alive: bool = False):
         class MockHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' if keep_alive else 'HTTP/1.0'
+            # the headers and the payload are written separately, Nagle would delay the payload
+            # until the client acknowledges the headers on kept alive connections
+            disable_nagle_algorithm = True
+
             def __init__(self, *args, **kwargs) -> None:
                 self.mock_server = server
                 super(MockHandler, self).__init__(*args, **kwargs)
@@ -54,16 +124,47 @@ class MockServer:
             def log_message(self, format: str, *args: Any) -> None:
                 pass
 
+            def fault(self, fault: MockFault) -> None:
+                if fault.kind == MockFault.HANG:
+                    # cut short when the server shuts down
+                    self.mock_server.stopping.wait(fault.duration)
+                elif fault.kind == MockFault.RESET:
+                    # closing with a zero linger time sends a RST instead of a FIN
+                    self.connection.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                    self.connection.close()
+                self.close_connection = True
+
+            def write_payload(self, payload: bytes, bandwidth: Optional[float]) -> None:
+                if not bandwidth:
+                    self.wfile.write(payload)
+                    return
+                # about 50 writes per second
+                size = max(1, int(bandwidth / 50))
+                start = time.monotonic()
+                for offset in range(0, len(payload), size):
+                    self.wfile.write(payload[offset:offset + size])
+                    delay = start + (offset + size) / bandwidth - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
             def handle_mock(self, method: str, path: str, payload: str):
                 mock = self.mock_server.get_mock(method, path, payload)
                 if mock:
-                    code, payload = mock.get_response()
+                    res = mock.get_response()
+                    latency = mock.get_latency()
+                    if latency > 0:
+                        self.mock_server.stopping.wait(latency)
+                    if isinstance(res, MockFault):
+                        self.fault(res)
+                        return
+                    code, payload = res
                     self.send_response(code)
-                    if payload:
+                    if payload or keep_alive:
                         self.send_header('content-length',
-                                         len(payload))
+                                         len(payload or b''))
                         self.end_headers()
-                        self.wfile.write(payload)
+                        self.write_payload(payload or b'', mock.bandwidth)
                     else:
                         self.end_headers()
                 else:
@@ -80,16 +181,20 @@ class MockServer:
 
         return MockHandler
 
-    def __init__(self, port) -> None:
-        self.httpd = http.server.HTTPServer(
-            ('', port), MockServer.ProvideMockHandler(self))
+    def __init__(self, port, keep_alive: bool = False) -> None:
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.httpd = _MockHTTPServer(
+            ('', port), MockServer.ProvideMockHandler(self, keep_alive))
 
-        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05})
         self.thread.start()
         self.reset_mocks()
 
     def shutdown(self):
         """Shuts down the mock server"""
+        self.stopping.set()
         self.httpd.shutdown()
         self.httpd.server_close()
         self.thread.join()
@@ -98,7 +203,7 @@ class MockServer:
         """Return the first mock that matches the query and register the query"""
         res_name = '__none__'
         res_mock = None
-        for name, mock in self.mocks.items():
+        for name, mock in list(self.mocks.items()):
             if mock.match(method, path):
                 res_name = name
                 res_mock = mock
@@ -108,14 +213,17 @@ class MockServer:
 
     def reset_mocks(self):
         """To be called at the end of a test. Forgets all the mocks and the queries it received"""
-        self.mocks: Dict[str, MockResponse] = {}
-        self.queries: List[MockQuery] = []
+        with self._lock:
+            self.mocks: Dict[str, MockResponse] = {}
+            self.queries: List[MockQuery] = []
 
     def register_query(self, name: str, method: str, path: str, payload: str):
         """to keep track of queries made to the server"""
-        self.queries.append(
-            MockQuery(name, method, path, payload))
+        with self._lock:
+            self.queries.append(
+                MockQuery(name, method, path, payload))
 
     def add_mock(self, name: str, mock: MockResponse):
         """To add a mock response. The first Mock to match a query will be used"""
-        self.mocks[name] = mock
+        with self._lock:
+            self.mocks[name] = mock
@@ -0,0 +1,66 @@
+from kp.main import setup_and_start
+from kp.regression.mock_server import MockResponse, MockServer
+import threading
+from urllib.request import urlopen
+
+PROXY_URL = 'http://localhost:43210/jsonrpc'
+JRPC_PORT = 43211
+RECEIVER_PORT = 43212
+TELNET_PORT = 43213
+
+KODI_RESULT = b'{"jsonrpc": "2.0", "id": 1, "result": "OK"}'
+
+RECEIVER_STATUS = b"""<?xml version="1.0" encoding="utf-8" ?>
+<item>
+<Zone><value>MainZone</value></Zone>
+<Power><value>ON</value></Power>
+<Model><value></value></Model>
+<InputFuncSelect><value>AUXB</value></InputFuncSelect>
+<MasterVolume><value>-35.0</value></MasterVolume>
+<Mute><value>off</value></Mute>
+</item>"""
+
+RECEIVER_VOLUME = b"""<?xml version="1.0" encoding="utf-8" ?>
+<item>
+<MasterVolume><value>-35.0</value></MasterVolume>
+<Mute><value>off</value></Mute>
+</item>"""
+
+
+def add_default_mocks(jrpc_mock: MockServer, receiver_mock: MockServer) -> None:
+    """Makes the mocks answer any request, like an idle Kodi and a receiver that is on"""
+    jrpc_mock.add_mock('kodi', MockResponse(responses=[(200, KODI_RESULT)]))
+    receiver_mock.add_mock('volume', MockResponse(
+        responses=[(200, RECEIVER_VOLUME)], path='/goform/formiPhoneAppVolume.xml'))
+    # the other commands get the full status as answer
+    receiver_mock.add_mock('status', MockResponse(responses=[(200, RECEIVER_STATUS)]))
+
+
+class OfflineProxy:
+    """Runs the proxy with a regression configuration, with MockServer stand-ins of Kodi and the
+    receiver, so it can be loaded without any device. To be used as a context manager"""
+
+    def __init__(self, conf_path: str = 'kp/regression/kodiproxy_reg.json'):
+        self.conf_path = conf_path
+        self.url = PROXY_URL
+        self.jrpc_mock: MockServer = None
+        self.receiver_mock: MockServer = None
+        self._thread: threading.Thread = None
+
+    def __enter__(self) -> 'OfflineProxy':
+        # like Kodi, the mock keeps the connections open for the pool of the proxy
+        self.jrpc_mock = MockServer(JRPC_PORT, keep_alive=True)
+        self.receiver_mock = MockServer(RECEIVER_PORT)
+        add_default_mocks(self.jrpc_mock, self.receiver_mock)
+        event = threading.Event()
+        self._thread = threading.Thread(target=setup_and_start, args=[self.conf_path, event])
+        self._thread.start()
+        event.wait()
+        return self
+
+    def __exit__(self, *args) -> None:
+        # asks the server to shut down
+        urlopen(self.url.replace('/jsonrpc', '/quit'))
+        self._thread.join()
+        self.jrpc_mock.shutdown()
+        self.receiver_mock.shutdown()
@@ -1,5 +1,7 @@
 import json
 from kp.regression.mock_server import MockServer
+from kp.regression.telnet_simulator import TelnetSimulator
+import time
 import unittest
 from urllib import error, request
 from typing import Any, Tuple
@@ -9,15 +11,44 @@ class RegressionCase(unittest.TestCase):
     """Helper class to more easily handle the http mocks"""
     JRPC_MOCK = None
     RECEIVER_MOCK = None
+    TELNET_SIMULATOR = None
+    # receiver configuration of the proxy under test
+    RECEIVER_CONF: dict = {}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.jrpc_mock: MockServer = RegressionCase.JRPC_MOCK
         self.receiver_mock: MockServer = RegressionCase.RECEIVER_MOCK
+        self.telnet_simulator: TelnetSimulator = RegressionCase.TELNET_SIMULATOR
+        self.receiver_conf: dict = RegressionCase.RECEIVER_CONF
 
     def setUp(self) -> None:
         self.jrpc_mock.reset_mocks()
         self.receiver_mock.reset_mocks()
+        if self.telnet:
+            self.reset_telnet()
+
+    @property
+    def telnet(self) -> bool:
+        """Whether the proxy talks to the telnet simulator instead of the receiver mock"""
+        return self.receiver_conf.get('backend') == 'telnet'
+
+    def reset_telnet(self, timeout: float = 2) -> None:
+        """Puts the telnet simulator back in standby, on the desired input at -35 dB and muted. The
+        proxy is disconnected so that it reads this state again"""
+        simulator = self.telnet_simulator
+        simulator.power = False
+        simulator.input = self.receiver_conf.get('desiredInput', 'AUXB')
+        simulator.volume = 45
+        simulator.mute = True
+        simulator.commands.clear()
+        simulator.disconnect()
+        # the queries sent by the proxy on connection, MU? being the last one
+        deadline = time.monotonic() + timeout
+        while 'MU?' not in simulator.commands and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertIn('MU?', simulator.commands)
+        simulator.commands.clear()
 
     def assertPayloadEqual(self, response, expected_result: Any):
         """Compares what we received to what we expect, giving only the expected result part"""
@@ -36,7 +67,10 @@ class RegressionCase(unittest.TestCase):
             'method': method,
             'params': params
         }
+        return self.open_raw(query)
 
+    def open_raw(self, query: Any) -> Tuple[int, Any]:
+        """Helper function to send any json payload to the proxy"""
         headers = {'Content-Type': 'application/json'}
         req = request.Request('http://localhost:43210/jsonrpc',
                               data=bytes(json.dumps(query), 'utf-8'), headers=headers)
@@ -0,0 +1,160 @@
+import socket
+import socketserver
+import threading
+import time
+from typing import List, Optional
+
+
+class _SimulatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class TelnetSimulator:
+    """Small simulator of the telnet control protocol of Denon and Marantz receivers.
+
+    It answers PW, SI, MV and MU commands and queries like a receiver of the main zone would, and Z2
+    and Z3 ones for the other zones. The changes of its state are sent to all the connected clients.
+    latency delays the answers and, like real receivers, the input cannot be changed during
+    input_delay seconds after powering on"""
+
+    def __init__(self, port: int = 0, power: bool = False, input: str = 'NET', volume: float = 40,
+                 mute: bool = False, latency: float = 0, input_delay: float = 0) -> None:
+        self.power = power
+        self.input = input
+        # in the scale of the protocol: 80 is 0 dB
+        self.volume = volume
+        self.mute = mute
+        self.latency = latency
+        self.input_delay = input_delay
+        self.commands: List[str] = []
+        # power, input, volume and mute of zones 2 and 3
+        self.zones = {zone: {'power': False, 'input': 'SOURCE', 'volume': 40, 'mute': False}
+                      for zone in (2, 3)}
+        self._powered_on = float('-inf')
+        self._clients: List[socket.socket] = []
+        self._lock = threading.Lock()
+        self.server = _SimulatorServer(('', port), self._provide_handler())
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def _provide_handler(self):
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self) -> None:
+                with simulator._lock:
+                    simulator._clients.append(self.request)
+                buffer = b''
+                try:
+                    while True:
+                        data = self.request.recv(1024)
+                        if not data:
+                            return
+                        *lines, buffer = (buffer + data).split(b'\r')
+                        for line in lines:
+                            simulator.receive(line.decode('ascii').strip())
+                except OSError:
+                    pass
+                finally:
+                    with simulator._lock:
+                        if self.request in simulator._clients:
+                            simulator._clients.remove(self.request)
+
+        return Handler
+
+    def shutdown(self) -> None:
+        """Shuts down the simulator"""
+        self.disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def disconnect(self) -> None:
+        """Closes the connections of the clients, like a receiver being unplugged"""
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def push(self, *events: str) -> None:
+        """Sends events to all the clients"""
+        payload = b''.join(bytes(event + '\r', 'ascii') for event in events)
+        with self._lock:
+            for client in self._clients:
+                try:
+                    client.sendall(payload)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _volume_event(code: str, volume: float) -> str:
+        if volume == int(volume):
+            return '{}{:02d}'.format(code, int(volume))
+        return '{}{:02d}5'.format(code, int(volume))
+
+    def _run_zone(self, code: str, value: str) -> Optional[List[str]]:
+        zone = self.zones[int(code[1])]
+        power = code + ('ON' if zone['power'] else 'OFF')
+        if value == '?':
+            return [code + zone['input'], power, self._volume_event(code, zone['volume'])]
+        if value.startswith('MU'):
+            if value != 'MU?':
+                zone['mute'] = value == 'MUON'
+            return [code + ('MUON' if zone['mute'] else 'MUOFF')]
+        if value in ('ON', 'OFF'):
+            zone['power'] = value == 'ON'
+            return [code + value]
+        if value.isdigit():
+            zone['volume'] = int(value) / 10 if len(value) == 3 else int(value)
+            return [self._volume_event(code, zone['volume'])]
+        if not zone['power']:
+            return None
+        zone['input'] = value
+        return [code + value]
+
+    def receive(self, command: str) -> None:
+        """Runs a command and sends the resulting events"""
+        with self._lock:
+            self.commands.append(command)
+        if self.latency:
+            time.sleep(self.latency)
+        events = self._run(command)
+        if events:
+            self.push(*events)
+
+    def _run(self, command: str) -> Optional[List[str]]:
+        code, value = command[:2], command[2:]
+        if code == 'PW':
+            if value == 'ON' and not self.power:
+                self.power = True
+                self._powered_on = time.monotonic()
+            elif value == 'STANDBY':
+                self.power = False
+            return ['PW' + ('ON' if self.power else 'STANDBY'), 'ZM' + ('ON' if self.power else 'OFF')]
+        if code == 'SI':
+            if value != '?':
+                if not self.power or time.monotonic() - self._powered_on < self.input_delay:
+                    return None
+                self.input = value
+            return ['SI' + self.input]
+        if code == 'MU':
+            if value in ('ON', 'OFF'):
+                self.mute = value == 'ON'
+            return ['MU' + ('ON' if self.mute else 'OFF')]
+        if code == 'MV':
+            if value == 'UP':
+                self.volume = min(self.volume + 0.5, 98)
+            elif value == 'DOWN':
+                self.volume = max(self.volume - 0.5, 0)
+            elif value.isdigit():
+                self.volume = int(value) / 10 if len(value) == 3 else int(value)
+            return [self._volume_event('MV', self.volume), 'MVMAX 98']
+        if code in ('Z2', 'Z3'):
+            return self._run_zone(code, value)
+        return None
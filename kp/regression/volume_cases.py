@@ -28,8 +28,13 @@ class VolumeCase(RegressionCase):
         code, payload = self.open_jrpc('Application.SetVolume', {'volume': 66})
 
         self.assertEqual(code, 200)
-        self.assertPayloadEqual(payload, 75)
-        self.assertEqual(self.receiver_mock.queries[0].payload, '1+-40.0')
+        if self.telnet:
+            # the volume the receiver answers with
+            self.assertPayloadEqual(payload, 66)
+            self.assertEqual(self.telnet_simulator.commands, ['MV40'])
+        else:
+            self.assertPayloadEqual(payload, 75)
+            self.assertEqual(self.receiver_mock.queries[0].payload, '1+-40.0')
 
     def test_incr_volume(self):
         """Incrementing the volume targets the receiver"""
@@ -46,8 +51,41 @@ class VolumeCase(RegressionCase):
             'Application.SetVolume', {'volume': 'increment'})
 
         self.assertEqual(code, 200)
+        if self.telnet:
+            self.assertPayloadEqual(payload, 76)
+            self.assertEqual(self.telnet_simulator.commands, ['MV46'])
+            return
         self.assertPayloadEqual(payload, 75)
-        self.assertEqual(self.receiver_mock.queries[1].payload, '1+-34.0')
+        # the status is only read if the last one is too old
+        self.assertEqual(self.receiver_mock.queries[-1].name, 'volume')
+        self.assertEqual(self.receiver_mock.queries[-1].payload, '1+-34.0')
+
+    def test_status_snapshot(self):
+        """Reads following a command use the status it returned, unless the snapshot is disabled"""
+        self.receiver_mock.add_mock('volume', MockResponse(
+            responses=[(200, VolumeCase.VOLUME_STATUS)],
+            path='/goform/formiPhoneAppVolume.xml'
+        ))
+        self.receiver_mock.add_mock('status', MockResponse(
+            responses=[(200, VolumeCase.FULL_STATUS)],
+            path='/goform/formMainZone_MainZoneXmlStatus.xml'
+        ))
+
+        self.open_jrpc('Application.SetVolume', {'volume': 66})
+        code, payload = self.open_jrpc('Application.GetProperties', {
+                                       'properties': ['volume', 'muted']})
+
+        self.assertEqual(code, 200)
+        if self.telnet:
+            # the state is pushed by the receiver
+            self.assertPayloadEqual(payload, {'muted': True, 'volume': 66})
+            self.assertEqual(self.telnet_simulator.commands, ['MV40'])
+        elif self.receiver_conf.get('statusMaxAge') == 0:
+            self.assertPayloadEqual(payload, {'muted': True, 'volume': 75})
+            self.assertEqual([q.name for q in self.receiver_mock.queries], ['volume', 'status'])
+        else:
+            self.assertPayloadEqual(payload, {'muted': False, 'volume': 75})
+            self.assertEqual([q.name for q in self.receiver_mock.queries], ['volume'])
 
     def test_get_properties_volume(self):
         """Getting the volume properties queries the receiver"""
@@ -62,6 +100,9 @@ class VolumeCase(RegressionCase):
         self.assertEqual(code, 200)
         self.assertPayloadEqual(payload, {'muted': True, 'volume': 75})
         self.assertEqual(len(self.jrpc_mock.queries), 0)
+        if self.telnet:
+            # known since the connection
+            self.assertEqual(self.telnet_simulator.commands, [])
 
     def test_get_properties_other(self):
         """Getting the other properties targets the jrpc server"""
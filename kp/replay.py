@@ -0,0 +1,171 @@
+import argparse
+from concurrent import futures
+import http.client
+from kp import capture, log
+from kp.tracing import percentile
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+from urllib import parse
+
+
+class ReplayReport:
+    """Latencies and outcomes of the replayed requests"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+        self.codes: Dict[str, int] = dict()
+        self.errors = 0
+        self.elapsed = 0.
+        self._lock = threading.Lock()
+
+    def add(self, method: str, code: Optional[int], latency: float) -> None:
+        with self._lock:
+            self.latencies.setdefault(method, []).append(latency)
+            if code is None:
+                self.errors += 1
+                code = 'error'
+            self.codes[str(code)] = self.codes.get(str(code), 0) + 1
+
+    @property
+    def count(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    @property
+    def throughput(self) -> float:
+        """Requests per second"""
+        return self.count / self.elapsed if self.elapsed else 0.
+
+    def percentiles(self, method: Optional[str] = None) -> Dict[str, float]:
+        """p50, p95 and p99 latencies, in seconds, of a method or of all the requests"""
+        if method is None:
+            latencies = sorted(l for ls in self.latencies.values() for l in ls)
+        else:
+            latencies = sorted(self.latencies.get(method, []))
+        return {'p{}'.format(q): percentile(latencies, q) for q in (50, 95, 99)}
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'elapsed': round(self.elapsed, 6),
+            'throughput': round(self.throughput, 3),
+            'codes': dict(self.codes),
+            'latency': self.percentiles(),
+            'methods': {m: dict(count=len(l), **self.percentiles(m)) for m, l in self.latencies.items()}
+        }
+
+    def summary(self) -> str:
+        p = self.percentiles()
+        lines = [
+            '{} requests in {:.3f}s: {:.1f} req/s, {} errors'.format(
+                self.count, self.elapsed, self.throughput, self.errors),
+            'codes: ' + ', '.join('{} {}'.format(c, n) for c, n in sorted(self.codes.items())),
+            'latency: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+                p['p50'] * 1000, p['p95'] * 1000, p['p99'] * 1000),
+            '',
+            '{:<48} {:>6} {:>9} {:>9} {:>9}'.format('method', 'count', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for method, latencies in sorted(self.latencies.items(), key=lambda m: -len(m[1])):
+            p = self.percentiles(method)
+            lines.append('{:<48} {:>6} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                method[:48], len(latencies), p['p50'] * 1000, p['p95'] * 1000, p['p99'] * 1000))
+        return '\n'.join(lines)
+
+
+class _Client:
+    """Keeps a connection to the proxy for each thread of the replay"""
+
+    def __init__(self, url: str, timeout: float):
+        parsed = parse.urlparse(url)
+        self.host = parsed.netloc
+        self.path = parsed.path or '/'
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def post(self, body: bytes) -> int:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+        try:
+            conn.request('POST', self.path, body, {'content-type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except BaseException:
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+def _method(entry: Dict[str, Any]) -> str:
+    if 'batch' in entry:
+        return 'batch'
+    return str(entry.get('method', 'other'))
+
+
+def replay(entries: Iterable[Dict[str, Any]], url: str, speed: float = 1., concurrency: int = 4,
+           timeout: float = 10) -> ReplayReport:
+    """Sends the captured requests to the proxy at url and measures their latency.
+
+    With a speed of 1, the requests are sent with the same delays between them as when they were
+    captured, 2 sends them twice as fast and 0 as fast as possible. At most concurrency requests are
+    in flight: when they are all slow, the next ones are late"""
+    entries = sorted(entries, key=lambda e: e['time'])
+    report = ReplayReport()
+    client = _Client(url, timeout)
+    slots = threading.Semaphore(concurrency)
+
+    def send(entry: Dict[str, Any], body: bytes) -> None:
+        start = time.perf_counter()
+        try:
+            code = client.post(body)
+        except Exception:
+            code = None
+        finally:
+            slots.release()
+        report.add(_method(entry), code, time.perf_counter() - start)
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency,
+                                    thread_name_prefix='kodiproxy-replay') as executor:
+        start = time.perf_counter()
+        for entry in entries:
+            if speed > 0:
+                delay = start + (entry['time'] - entries[0]['time']) / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            body = capture.encode(entry)
+            slots.acquire()
+            executor.submit(send, entry, body)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Replays a capture of the proxy traffic and reports its throughput and latency')
+    parser.add_argument('path', help='JSONL file written by the capture')
+    parser.add_argument('--url', default='http://localhost:8080/jsonrpc',
+                        help='jsonrpc url of the proxy')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='1 replays at the original pace, 2 twice as fast, 0 as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='maximum number of requests in flight')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for each request')
+    parser.add_argument('--offline', action='store_true',
+                        help='starts a proxy with mock Kodi and receiver instead of using --url')
+    args = parser.parse_args(argv)
+    entries = list(log.read_jsonl(args.path))
+    if args.offline:
+        # needs the working directory to be the root of the repository, like the regression
+        from kp.regression.offline import OfflineProxy
+        with OfflineProxy() as proxy:
+            report = replay(entries, proxy.url, args.speed, args.concurrency, args.timeout)
+    else:
+        report = replay(entries, args.url, args.speed, args.concurrency, args.timeout)
+    print(report.summary())
+    return 1 if report.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,13 @@
 import http.server
+from kp import capture, httputils, metrics, tracing
 from kp.confbase import KPConfBase
 from kp.jrpc.jrpcserver import JRPCServer
 import logging
+import socket
 import socketserver
 from socket import timeout
 import sys
+import time
 import traceback
 from urllib import parse
 
@@ -15,41 +18,149 @@ class KodiProxyServer:
     """Class to create the Kodi proxy"""
 
     _DEFAULT_CONFIGURATION = {
+        'engine': 'threading',
         'host': '',
+        'keepAliveTimeout': 15,
+        'maxKeepAliveRequests': 100,
         'port': 8080
     }
 
     @staticmethod
-    def ProvideProxyHandler(jrpc_path: str, jrpc_server: JRPCServer):
+    def ProvideProxyHandler(jrpc_path: str, jrpc_server: JRPCServer,
+                            keep_alive_timeout: float = None, max_keep_alive_requests: int = 100):
         class KodiProxyHandler(http.server.BaseHTTPRequestHandler):
             """Class to handle all the http requests"""
+            # HTTP/1.1 keeps the connections alive unless the client asks otherwise
+            protocol_version = 'HTTP/1.1'
+            # idle delay after which a kept alive connection is closed
+            timeout = keep_alive_timeout
 
             def __init__(self, *args, **kwargs):
                 self.jrpc_path = jrpc_path
                 self.jrpc_server = jrpc_server
+                self.requests_served = 0
                 super(KodiProxyHandler, self).__init__(*args, **kwargs)
 
             def log_message(self, format, *args) -> None:
                 return
 
+            def setup(self) -> None:
+                super().setup()
+                # headers and body are separate writes, which Nagle's algorithm would delay until
+                # the client acknowledges the headers (up to 40ms with delayed acks)
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                metrics.CONNECTIONS.inc()
+
+            def finish(self) -> None:
+                metrics.CONNECTIONS.dec()
+                super().finish()
+
+            def parse_request(self) -> bool:
+                self.requests_served += 1
+                return super().parse_request()
+
+            def send_response(self, code: int, message: str = None) -> None:
+                super().send_response(code, message)
+                if self.requests_served >= max_keep_alive_requests:
+                    # also sets close_connection
+                    self.send_header('connection', 'close')
+
+            def _send_payload(self, code: int, payload, headers) -> int:
+                """Sends a response, returns the number of bytes of its body"""
+                # date and server are added by send_response
+                headers = httputils.relayable_headers(
+                    headers or {}, dropped=('date', 'server'))
+                chunked = False
+                if isinstance(payload, bytes):
+                    headers['content-length'] = str(len(payload))
+                elif payload.length is not None:
+                    headers['content-length'] = str(payload.length)
+                elif self.request_version == 'HTTP/1.1':
+                    headers['transfer-encoding'] = 'chunked'
+                    chunked = True
+                else:
+                    # the end of the body is given by closing the connection
+                    self.close_connection = True
+                self.send_response(code)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if isinstance(payload, bytes):
+                    self.wfile.write(payload)
+                    return len(payload)
+                size = 0
+                try:
+                    for chunk in payload.chunks():
+                        self.wfile.write(httputils.chunk(chunk) if chunked else chunk)
+                        size += len(chunk)
+                    if chunked:
+                        self.wfile.write(httputils.chunk(b''))
+                    return size
+                except BaseException:
+                    # the headers are sent, the client can only know something is wrong if we close
+                    self.close_connection = True
+                    raise
+                finally:
+                    payload.close()
+
+            def _reply_error(self, code: int) -> None:
+                # unlike send_error, it does not close the connection
+                payload = bytes('{} {}'.format(
+                    code, self.responses[code][0]), 'latin-1')
+                self._send_payload(
+                    code, payload, {'content-type': 'text/plain'})
+
+            def _read_body(self) -> bytes:
+                if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+                    return self._read_chunked()
+                length = self.headers['content-length']
+                if length:
+                    return self.rfile.read(int(length))
+                if self.request_version == 'HTTP/1.0':
+                    # the body runs until the client closes its side
+                    self.close_connection = True
+                    return self.rfile.read()
+                return None
+
+            def _read_chunked(self) -> bytes:
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';', 1)[0], 16)
+                    if size == 0:
+                        # skips the trailers
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                            pass
+                        return b''.join(chunks)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+
             def _dispatch_jrpc(self, request) -> None:
-                headers = dict()
-                for k, v in self.headers.items():
-                    headers[k.lower()] = v
+                headers = httputils.lower_headers(self.headers)
+                start = time.perf_counter()
+                metrics.REQUESTS_IN_FLIGHT.inc()
+                trace = tracing.TRACER.start()
                 handler = self.jrpc_server.get_handler(
                     request, headers)
-                code, payload, headers = handler.dispatch()
+                code = 500
+                size = 0
                 try:
-                    self.send_response(code)
-                    for k, v in headers.items():
-                        self.send_header(k, v)
-                    self.end_headers()
-                    self.wfile.write(payload)
-                    LOGGER.debug(
-                        'Reponse payload successfully sent: %s', payload)
-                except Exception as e:
-                    LOGGER.error('Failed to send response with error: %s', e)
-                    LOGGER.info('Trace: %s', traceback.format_exc())
+                    with tracing.stage('dispatch'):
+                        code, payload, headers = handler.dispatch()
+                    try:
+                        with tracing.stage('write'):
+                            size = self._send_payload(code, payload, headers)
+                        LOGGER.debug(
+                            'Reponse payload successfully sent: %s', payload)
+                    except Exception as e:
+                        LOGGER.error('Failed to send response with error: %s', e)
+                        LOGGER.info('Trace: %s', traceback.format_exc())
+                finally:
+                    duration = time.perf_counter() - start
+                    metrics.REQUESTS_IN_FLIGHT.dec()
+                    metrics.observe_request(handler.method, handler.route, code, duration)
+                    capture.CAPTURE.record(request, self.client_address[0], duration, code, size)
+                    tracing.TRACER.finish(
+                        trace, handler.method, handler.route, code)
 
             def do_GET(self) -> None:
                 (_, _, path, _, query, _) = parse.urlparse(self.path)
@@ -57,12 +168,15 @@ class KodiProxyServer:
                 if path == '/quit':
                     self.send_error(204)
                     self.server.shutdown()
+                elif path == '/metrics':
+                    self._send_payload(200, metrics.REGISTRY.expose(), {
+                                       'content-type': metrics.CONTENT_TYPE})
                 elif path != self.jrpc_path:
-                    self.send_error(404)
+                    self._reply_error(404)
                 else:
                     params = parse.parse_qs(query)
                     if ('request' not in params) or (len(params) != 1) or (len(params['request']) != 1):
-                        self.send_error(400)
+                        self._reply_error(400)
                     else:
                         self._dispatch_jrpc(
                             bytes(params['request'][0], 'utf-8'))
@@ -71,13 +185,18 @@ class KodiProxyServer:
                 (_, _, path, _, _, _) = parse.urlparse(self.path)
                 LOGGER.info('Received POST %s', path)
                 LOGGER.debug('%s', self.headers)
-                if path != self.jrpc_path:
-                    self.send_error(404)
+                try:
+                    payload = self._read_body()
+                except ValueError:
+                    # framing is broken, the connection cannot be reused
+                    self.send_error(400)
+                    return
+                if payload is None:
+                    # we could not tell where the next request starts
+                    self.send_error(411)
+                elif path != self.jrpc_path:
+                    self._reply_error(404)
                 else:
-                    # works whether content-length is present or not
-                    length = self.headers['content-length']
-                    payload = self.rfile.read(
-                        int(length)) if length else self.rfile.read()
                     self._dispatch_jrpc(payload)
 
             def do_HEAD(self) -> None:
@@ -92,7 +211,8 @@ class KodiProxyServer:
         LOGGER.info('Server configuration:\n%s', conf)
         self.port = conf.port
         self.httpd = http.server.ThreadingHTTPServer(
-            (conf.host, conf.port), KodiProxyServer.ProvideProxyHandler('/jsonrpc', jrpc_server))
+            (conf.host, conf.port), KodiProxyServer.ProvideProxyHandler(
+                '/jsonrpc', jrpc_server, conf.keepAliveTimeout, conf.maxKeepAliveRequests))
 
     def serve(self) -> None:
         """Starts the server"""
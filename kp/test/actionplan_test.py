@@ -0,0 +1,47 @@
+from kp import actionplan
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+
+class TestActionPlan(unittest.TestCase):
+    def test_parallel(self):
+        '''The actions run at the same time'''
+        plan = actionplan.ActionPlan({'deadline': 1})
+        barrier = threading.Barrier(2, timeout=1)
+
+        results = plan.run({'first': barrier.wait, 'second': barrier.wait})
+
+        self.assertEqual(results, {'first': 'ok', 'second': 'ok'})
+
+    def test_results(self):
+        '''Errors and actions that do not finish in time are reported'''
+        plan = actionplan.ActionPlan({'deadline': 0.1})
+        release = threading.Event()
+
+        start = time.monotonic()
+        results = plan.run({
+            'fails': MagicMock(side_effect=ValueError('broken')),
+            'hangs': release.wait,
+            'works': MagicMock()
+        })
+        release.set()
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(results, {
+            'fails': 'failed: broken',
+            'hangs': 'timeout',
+            'works': 'ok'
+        })
+
+    def test_background(self):
+        '''In background, run returns without waiting for the actions'''
+        plan = actionplan.ActionPlan({'background': True})
+        release = threading.Event()
+        action = MagicMock(side_effect=lambda: release.wait(1))
+
+        self.assertIsNone(plan.run({'action': action}))
+        release.set()
+        plan.executor.shutdown(wait=True)
+        action.assert_called_once()
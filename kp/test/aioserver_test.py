@@ -0,0 +1,225 @@
+from kp import aioserver, log
+import http.client
+import socket
+import threading
+from typing import Tuple
+import time
+import unittest
+from unittest.mock import ANY, AsyncMock, MagicMock
+from urllib import error, request
+
+
+def serve(httpd: aioserver.AsyncKodiProxyServer):
+    httpd.serve()
+
+
+class TestAsyncServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.jrpc_mock = MagicMock()
+        cls.server = aioserver.AsyncKodiProxyServer({
+            'ip': '0.0.0.0',
+            'port': 43213,
+            'maxKeepAliveRequests': 3
+        }, cls.jrpc_mock)
+        cls.thread = threading.Thread(
+            target=serve, args=[cls.server])
+        cls.thread.start()
+        log.config_logger({
+            'type': 'null'
+        })
+
+    def setUp(self):
+        self.jrpc_mock.reset_mock(return_value=True, side_effect=True)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.thread.join()
+
+    def open(self, url: str, data: bytes = None, headers: dict = {}) -> Tuple[int, bytes, dict]:
+        try:
+            req = request.Request(
+                'http://0.0.0.0:43213/{}'.format(url),
+                data=data,
+                headers=headers
+            )
+            res = request.urlopen(req)
+            return res.getcode(), res.read(), res.info()
+        except error.HTTPError as e:
+            return e.getcode(), e.read(), e.headers
+
+    def test_error_get(self) -> None:
+        code, _, _ = self.open('test')
+        self.assertEqual(code, 404)
+
+        code, _, _ = self.open('jsonrpc')
+        self.assertEqual(code, 400)
+
+        code, _, _ = self.open('jsonrpc?invalid=invalid')
+        self.assertEqual(code, 400)
+
+    def test_error_post(self) -> None:
+        code, _, _ = self.open('test', b'some payload')
+        self.assertEqual(code, 404)
+
+    def test_dispatch_get(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch_async = AsyncMock(return_value=(200, b'handler_response', {
+            'handler_header': 'handler_header_value'}))
+        code, payload, headers = self.open('jsonrpc?request=jrpc%3Dpayload')
+
+        self.assertEqual(code, 200)
+        self.assertEqual(payload, b'handler_response')
+        self.assertEqual(headers['handler_header'], 'handler_header_value')
+        self.assertEqual(headers['content-length'], '16')
+
+        self.jrpc_mock.get_handler.assert_called_once_with(
+            b'jrpc=payload', ANY)
+        handler.dispatch_async.assert_awaited_once()
+
+    def test_dispatch_post(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch_async = AsyncMock(
+            return_value=(200, b'handler_response', {}))
+        self.open('jsonrpc', data=b'jrpc%3Dpayload')
+
+        self.jrpc_mock.get_handler.assert_called_once_with(
+            b'jrpc%3Dpayload', ANY)
+        handler.dispatch_async.assert_awaited_once()
+
+    def test_keep_alive(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch_async = AsyncMock(
+            return_value=(200, b'handler_response', {'transfer-encoding': 'chunked'}))
+        conn = http.client.HTTPConnection('0.0.0.0', 43213)
+        try:
+            conn.request('GET', '/invalid')
+            res = conn.getresponse()
+            self.assertEqual(res.status, 404)
+            res.read()
+            sock = conn.sock
+
+            # the error did not close the connection
+            conn.request('POST', '/jsonrpc', body=b'payload')
+            res = conn.getresponse()
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.getheader('content-length'), '16')
+            self.assertIsNone(res.getheader('transfer-encoding'))
+            self.assertEqual(res.read(), b'handler_response')
+            self.assertIs(conn.sock, sock)
+
+            # the maximum number of requests is reached
+            conn.request('POST', '/jsonrpc', body=b'payload')
+            res = conn.getresponse()
+            self.assertEqual(res.getheader('connection'), 'close')
+            self.assertEqual(res.read(), b'handler_response')
+        finally:
+            conn.close()
+
+    def test_pipelining(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch_async = AsyncMock(
+            return_value=(200, b'handler_response', {'transfer-encoding': 'chunked'}))
+        request = b'POST /jsonrpc HTTP/1.1\r\nContent-Length: 7\r\n\r\npayload'
+        with socket.create_connection(('0.0.0.0', 43213)) as sock:
+            sock.sendall(request + request)
+            sock.shutdown(socket.SHUT_WR)
+            data = b''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data.count(b'handler_response'), 2)
+
+    def test_length_required(self) -> None:
+        with socket.create_connection(('0.0.0.0', 43213)) as sock:
+            sock.sendall(b'POST /jsonrpc HTTP/1.1\r\n\r\n')
+            self.assertTrue(sock.recv(4096).startswith(b'HTTP/1.1 411'))
+
+    def test_stream(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        payload = MagicMock()
+        payload.length = None
+
+        async def chunks():
+            yield b'first'
+            yield b'second'
+        payload.chunks = chunks
+        handler.dispatch_async = AsyncMock(return_value=(200, payload, {}))
+        conn = http.client.HTTPConnection('0.0.0.0', 43213)
+        try:
+            conn.request('POST', '/jsonrpc', body=b'payload')
+            res = conn.getresponse()
+            # without length, the body is chunked
+            self.assertEqual(res.getheader('transfer-encoding'), 'chunked')
+            self.assertEqual(res.read(), b'firstsecond')
+        finally:
+            conn.close()
+        # the body is closed once the last chunk is sent, possibly after the client received it
+        for _ in range(100):
+            if payload.close.called:
+                break
+            time.sleep(0.01)
+        payload.close.assert_called_once()
+
+
+class TestAsyncServerShutdown(unittest.TestCase):
+    def test_shutdown(self) -> None:
+        '''The connections still handled when the server stops are cancelled'''
+        server = aioserver.AsyncKodiProxyServer({'port': 0}, MagicMock())
+        thread = threading.Thread(target=serve, args=[server])
+        thread.start()
+        with socket.create_connection(('0.0.0.0', server.socket.getsockname()[1])) as sock:
+            # the body never comes
+            sock.sendall(b'POST /jsonrpc HTTP/1.1\r\nContent-Length: 7\r\n\r\npay')
+            time.sleep(0.05)
+            server.shutdown()
+            thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(server._connections, {})
+        self.assertTrue(server.loop.is_closed())
+
+
+class TestAsyncServerTimeouts(unittest.TestCase):
+    def setUp(self) -> None:
+        self.jrpc_mock = MagicMock()
+        handler = MagicMock()
+        handler.dispatch_async = AsyncMock(return_value=(200, b'handler_response', {}))
+        self.jrpc_mock.get_handler.return_value = handler
+        self.server = aioserver.AsyncKodiProxyServer({
+            'port': 0,
+            'keepAliveTimeout': 0.1,
+            'requestTimeout': 0.5
+        }, self.jrpc_mock)
+        thread = threading.Thread(target=serve, args=[self.server])
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def post_slowly(self, delay: float) -> bytes:
+        with socket.create_connection(('0.0.0.0', self.server.socket.getsockname()[1])) as sock:
+            sock.sendall(b'POST /jsonrpc HTTP/1.1\r\nContent-Length: 7\r\n\r\npay')
+            time.sleep(delay)
+            try:
+                sock.sendall(b'load')
+            except OSError:
+                pass
+            return sock.recv(4096)
+
+    def test_slow_body(self) -> None:
+        '''The keep alive timeout only applies until a request starts'''
+        response = self.post_slowly(0.2)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.jrpc_mock.get_handler.assert_called_once_with(b'payload', ANY)
+
+    def test_request_timeout(self) -> None:
+        '''Requests not received in time are answered with a 408'''
+        self.assertTrue(self.post_slowly(0.7).startswith(b'HTTP/1.1 408'))
+        self.jrpc_mock.get_handler.assert_not_called()
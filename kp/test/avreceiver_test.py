@@ -1,6 +1,12 @@
 from kp import avreceiver
+from kp.regression.microbench import FIXTURES
+from kp.regression.telnet_simulator import TelnetSimulator
+import os
+import threading
+import time
 import unittest
 from unittest.mock import call, patch, MagicMock
+import xml.etree.ElementTree as ET
 
 
 conf_mock = {
@@ -12,6 +18,33 @@ conf_mock = {
 }
 
 
+STANDBY_STATUS = b"""<?xml version="1.0" encoding="utf-8" ?>
+<item>
+<Zone><value>MainZone</value></Zone>
+<Power><value>STANDBY</value></Power>
+<Model><value></value></Model>
+<InputFuncSelect><value>AUXB</value></InputFuncSelect>
+<MasterVolume><value>--</value></MasterVolume>
+<Mute><value>off</value></Mute>
+</item>"""
+
+ON_STATUS = b"""<?xml version="1.0" encoding="utf-8" ?>
+<item>
+<Zone><value>MainZone</value></Zone>
+<Power><value>ON</value></Power>
+<Model><value></value></Model>
+<InputFuncSelect><value>NET</value></InputFuncSelect>
+<MasterVolume><value>-70.0</value></MasterVolume>
+<Mute><value>on</value></Mute>
+</item>"""
+
+VOLUME_STATUS = b"""<?xml version="1.0" encoding="utf-8" ?>
+<item>
+<MasterVolume><value>-60.0</value></MasterVolume>
+<Mute><value>off</value></Mute>
+</item>"""
+
+
 class MockStatus:
     def __init__(self, inp=None, mute=None, power=None, volume=None):
         self.input = inp
@@ -23,32 +56,14 @@ class MockStatus:
 class TestAVStatus(unittest.TestCase):
     def test_full_status(self):
         '''Decoding of the response to the get status command'''
-        status = avreceiver.AVStatus(
-            b"""<?xml version="1.0" encoding="utf-8" ?>
-            <item>
-            <Zone><value>MainZone</value></Zone>
-            <Power><value>STANDBY</value></Power>
-            <Model><value></value></Model>
-            <InputFuncSelect><value>AUXB</value></InputFuncSelect>
-            <MasterVolume><value>--</value></MasterVolume>
-            <Mute><value>off</value></Mute>
-            </item>""")
+        status = avreceiver.AVStatus(STANDBY_STATUS)
 
         self.assertEqual(status.input, 'AUXB')
         self.assertEqual(status.mute, False)
         self.assertEqual(status.power, False)
         self.assertEqual(status.volume, '--')
 
-        status = avreceiver.AVStatus(
-            b"""<?xml version="1.0" encoding="utf-8" ?>
-            <item>
-            <Zone><value>MainZone</value></Zone>
-            <Power><value>ON</value></Power>
-            <Model><value></value></Model>
-            <InputFuncSelect><value>NET</value></InputFuncSelect>
-            <MasterVolume><value>-70.0</value></MasterVolume>
-            <Mute><value>on</value></Mute>
-            </item>""")
+        status = avreceiver.AVStatus(ON_STATUS)
 
         self.assertEqual(status.input, 'NET')
         self.assertEqual(status.mute, True)
@@ -57,12 +72,7 @@ class TestAVStatus(unittest.TestCase):
 
     def test_partial_status(self):
         '''Decoding of status when the response is partial'''
-        status = avreceiver.AVStatus(
-            b"""<?xml version="1.0" encoding="utf-8" ?>
-            <item>
-            <MasterVolume><value>-60.0</value></MasterVolume>
-            <Mute><value>off</value></Mute>
-            </item>""")
+        status = avreceiver.AVStatus(VOLUME_STATUS)
 
         self.assertIsNone(status.input)
         self.assertEqual(status.mute, False)
@@ -70,6 +80,68 @@ class TestAVStatus(unittest.TestCase):
         self.assertEqual(status.volume, -60)
 
 
+    def test_scan(self):
+        '''The scan of the status gives the same values as the parser'''
+        with open(os.path.join(FIXTURES, 'denon_status.xml'), 'rb') as fixture:
+            statuses = [fixture.read()]
+        statuses += [STANDBY_STATUS, ON_STATUS, VOLUME_STATUS,
+                     b'<item><Power><value>ON</value></Power><InputFuncSelect><value></value>'
+                     b'</InputFuncSelect></item>']
+        for response in statuses:
+            self.assertEqual(avreceiver.scan_values(response, avreceiver.AVStatus.TAGS),
+                             avreceiver.parse_values(response, avreceiver.AVStatus.TAGS))
+            scanned = avreceiver.AVStatus(response)
+            with patch('avreceiver.scan_values', return_value=None):
+                parsed = avreceiver.AVStatus(response)
+            self.assertEqual(vars(scanned), vars(parsed))
+
+    def test_scan_fields(self):
+        '''Every field of the full status is read the same, scanned or parsed'''
+        with open(os.path.join(FIXTURES, 'denon_status.xml'), 'rb') as fixture:
+            response = fixture.read()
+        tags = tuple(element.tag for element in ET.fromstring(response))
+        scanned = tuple(tag for tag in tags if avreceiver.scan_values(response, (tag,)) is not None)
+        self.assertGreater(len(scanned), len(tags) // 2)
+        for tag in tags:
+            with self.subTest(tag):
+                status = avreceiver.AVStatus(response, (tag,))
+                with patch('avreceiver.scan_values', return_value=None):
+                    self.assertEqual(vars(status), vars(avreceiver.AVStatus(response, (tag,))))
+        self.assertEqual(avreceiver.scan_values(response, scanned),
+                         avreceiver.parse_values(response, scanned))
+
+    def test_scan_repeated(self):
+        '''The last element of a repeated tag wins, as when parsed'''
+        response = (b'<item><Power><value>STANDBY</value></Power><MasterVolume><value>-40.0</value>'
+                    b'</MasterVolume><Power><value>ON</value></Power></item>')
+        self.assertEqual(avreceiver.scan_values(response, avreceiver.AVStatus.TAGS),
+                         {'Power': 'ON', 'MasterVolume': '-40.0'})
+        self.assertEqual(avreceiver.scan_values(response, avreceiver.AVStatus.TAGS),
+                         avreceiver.parse_values(response, avreceiver.AVStatus.TAGS))
+        self.assertTrue(avreceiver.AVStatus(response).power)
+
+    def test_scan_fallback(self):
+        '''What the scan cannot read safely is parsed'''
+        for response in [
+                b'<item><Power><value>O&#78;</value></Power></item>',
+                b'<item><Power><value><![CDATA[ON]]></value></Power></item>',
+                b'<item><Power version="2"><value>ON</value></Power></item>',
+                b'<item><Zone><value>Main</value></Zone></item>']:
+            self.assertIsNone(avreceiver.scan_values(response, avreceiver.AVStatus.TAGS))
+        self.assertEqual(avreceiver.AVStatus(
+            b'<item><Power><value>O&#78;</value></Power></item>').power, True)
+        with self.assertRaises(ET.ParseError):
+            avreceiver.AVStatus(b'<html>Not found')
+
+    def test_extra_tags(self):
+        '''Other fields can be asked for'''
+        with open(os.path.join(FIXTURES, 'denon_status.xml'), 'rb') as fixture:
+            status = avreceiver.AVStatus(fixture.read(), ('FriendlyName', 'selectSurround', 'Missing'))
+        self.assertEqual(status.extra, {
+            'FriendlyName': 'Denon AVR-X2300W', 'selectSurround': 'STEREO                    '})
+        self.assertEqual(status.volume, -35)
+
+
 class TestAVReceiver(unittest.TestCase):
     def check_int(self, value, expected: int):
         self.assertIsInstance(value, int)
@@ -91,27 +163,32 @@ class TestAVReceiver(unittest.TestCase):
         self.check_float(receiver._percent_to_db(25), -65)
         self.check_float(receiver._percent_to_db(100), conf_mock['maxVolume'])
 
-    @patch('avreceiver.request.urlopen')
-    def test_send_command(self, mock: MagicMock):
+    def test_send_command(self):
         '''Test internal send command method'''
         receiver = avreceiver.AVReceiver(conf_mock)
-
-        mock.return_value.read.return_value = b'''<?xml version="1.0" encoding="utf-8" ?>
-            <item>
-            <Zone><value>MainZone</value></Zone>
-            <Power><value>ON</value></Power>
-            <Model><value></value></Model>
-            <InputFuncSelect><value>NET</value></InputFuncSelect>
-            <MasterVolume><value>-70.0</value></MasterVolume>
-            <Mute><value>on</value></Mute>
-            </item>'''
+        receiver.connection.get = MagicMock(return_value=ON_STATUS)
 
         status = receiver._send_command('someurl')
 
-        mock.assert_called_once_with(
-            'http://{}:{}/goform/someurl'.format(conf_mock['ip'], conf_mock['port']), timeout=5)
-
+        receiver.connection.get.assert_called_once_with('someurl', 5)
         self.assertEqual(status.volume, -70)
+        self.assertEqual(receiver.connection.host, conf_mock['ip'])
+        self.assertEqual(receiver.connection.port, conf_mock['port'])
+
+    def test_zone_commands(self):
+        '''The commands of the other zones take their number'''
+        receiver = avreceiver.AVReceiver(dict(conf_mock, zone=2))
+        receiver.connection.get = MagicMock(return_value=ON_STATUS)
+
+        receiver.set_mute(True)
+        receiver._get_status()
+        receiver._send_command(receiver._power_command + 'On')
+
+        receiver.connection.get.assert_has_calls([
+            call('formiPhoneAppMute.xml?2+MuteOn', 5),
+            call('formZone2_Zone2XmlStatus.xml', 5),
+            call('formiPhoneAppPower.xml?2+PowerOn', 5)])
+        self.assertEqual(receiver._source_command, 'formiPhoneAppDirect.xml?Z2')
 
     def test_incr_volume(self):
         '''Correctly increment the volume'''
@@ -175,12 +252,12 @@ class TestAVReceiver(unittest.TestCase):
             call('formiPhoneAppVolume.xml?1+-80.0')
         ])
 
-    @patch('avreceiver.request.urlopen')
-    @patch('avreceiver.time.sleep')
-    def test_power_on(self, mock_sleep: MagicMock, mock_open: MagicMock):
+    def test_power_on(self):
         '''When asked to be switched on, we send the command 
         to turn on, then try to set the input until successful'''
         receiver = avreceiver.AVReceiver(conf_mock)
+        mock_get = receiver.connection.get = MagicMock(return_value=b'')
+        receiver.power.min_delay = 0
 
         receiver._send_command = MagicMock()
         receiver._send_command.side_effect = [
@@ -192,7 +269,7 @@ class TestAVReceiver(unittest.TestCase):
             MockStatus(inp=conf_mock['desiredInput'])
         ]
 
-        res = receiver.set_power(True)
+        res = receiver.set_power(True, timeout=1)
 
         receiver._send_command.assert_has_calls([
             call('formMainZone_MainZoneXmlStatus.xml'),
@@ -203,15 +280,62 @@ class TestAVReceiver(unittest.TestCase):
             call('formMainZone_MainZoneXmlStatus.xml')
         ])
 
-        self.assertEqual(mock_sleep.call_count, 4)
-        self.assertEqual(mock_open.call_count, 4)
-        mock_open.assert_any_call(
-            'http://{}:{}/goform/formiPhoneAppDirect.xml?SI{}'.format(
-                conf_mock['ip'], conf_mock['port'], conf_mock['desiredInput']),
-            timeout=5)
+        self.assertEqual(mock_get.call_count, 4)
+        mock_get.assert_any_call(
+            'formiPhoneAppDirect.xml?SI{}'.format(conf_mock['desiredInput']), 5)
 
         self.assertEqual(res, True)
 
+    def test_power_on_timeout(self):
+        '''We give up if the receiver does not switch to the input in time'''
+        receiver = avreceiver.AVReceiver(dict(conf_mock, powerOnTimeout=0.1))
+        mock_open = receiver.connection.get = MagicMock(return_value=b'')
+        receiver.power.min_delay = 0.02
+
+        receiver._send_command = MagicMock()
+        receiver._send_command.return_value = MockStatus(power=True, inp='NET')
+
+        self.assertEqual(receiver.set_power(True, timeout=1), False)
+        # the delay between retries doubles
+        self.assertLess(mock_open.call_count, 4)
+
+    def test_power_immediate(self):
+        '''By default, the requested state is returned right away and repeated requests join the
+        transition in flight'''
+        receiver = avreceiver.AVReceiver(conf_mock)
+        blocker = threading.Event()
+
+        receiver._send_command = MagicMock()
+        receiver._send_command.side_effect = lambda _: blocker.wait() and MockStatus(
+            power=True, inp=conf_mock['desiredInput'])
+
+        self.assertEqual(receiver.set_power(True), True)
+        transition = receiver.power.request(True)
+        self.assertIs(receiver.power.request(True), transition)
+        self.assertFalse(transition.done.is_set())
+
+        blocker.set()
+        self.assertTrue(transition.wait(1))
+        self.assertEqual(transition.result, True)
+        receiver._send_command.assert_called_once_with(
+            'formMainZone_MainZoneXmlStatus.xml')
+
+    def test_power_interrupted(self):
+        '''Powering off interrupts the power on in progress'''
+        receiver = avreceiver.AVReceiver(conf_mock)
+        mock_open = receiver.connection.get = MagicMock(return_value=b'')
+        receiver.power.min_delay = 10
+
+        receiver._send_command = MagicMock()
+        receiver._send_command.return_value = MockStatus(power=True, inp='NET')
+
+        power_on = receiver.power.request(True)
+        power_off = receiver.power.request(False)
+
+        self.assertTrue(power_off.wait(1))
+        self.assertEqual(power_on.result, False)
+        mock_open.assert_not_called()
+
     def test_power_off(self):
         '''Power off the receiver'''
         receiver = avreceiver.AVReceiver(conf_mock)
@@ -220,7 +344,7 @@ class TestAVReceiver(unittest.TestCase):
         receiver._send_command.return_value = MockStatus(
             inp=conf_mock['desiredInput'], power=True)
 
-        res = receiver.set_power(False)
+        res = receiver.set_power(False, timeout=1)
 
         receiver._send_command.assert_has_calls([
             call('formMainZone_MainZoneXmlStatus.xml'),
@@ -237,9 +361,454 @@ class TestAVReceiver(unittest.TestCase):
         receiver._send_command.return_value = MockStatus(
             inp='NET', power=True)
 
-        res = receiver.set_power(False)
+        res = receiver.set_power(False, timeout=1)
 
         receiver._send_command.assert_called_once_with(
             'formMainZone_MainZoneXmlStatus.xml')
 
         self.assertEqual(res, False)
+
+
+class TestAVState(unittest.TestCase):
+    @patch('avreceiver.time.monotonic')
+    def test_state(self, monotonic_mock: MagicMock):
+        '''The state keeps the fields it received for max_age'''
+        state = avreceiver.AVState()
+        monotonic_mock.return_value = 100
+        state.update(MockStatus(volume=-30, mute=False))
+        monotonic_mock.return_value = 101
+        state.update(MockStatus(mute=True))
+
+        status = state.get(('volume', 'mute'), 2)
+        self.assertEqual(status.volume, -30)
+        self.assertEqual(status.mute, True)
+        self.assertIsNone(status.power)
+
+        # the volume is too old, the mute is not
+        monotonic_mock.return_value = 102.5
+        self.assertIsNone(state.get(('volume', 'mute'), 2))
+        self.assertEqual(state.get(('mute',), 2).mute, True)
+        # never received
+        self.assertIsNone(state.get(('power',), 2))
+
+        state.invalidate('mute')
+        self.assertIsNone(state.get(('mute',), 2))
+
+
+class TestAVReceiverState(unittest.TestCase):
+    STATUS = b'''<?xml version="1.0" encoding="utf-8" ?>
+        <item>
+        <Power><value>ON</value></Power>
+        <InputFuncSelect><value>DINP</value></InputFuncSelect>
+        <MasterVolume><value>-65.0</value></MasterVolume>
+        <Mute><value>off</value></Mute>
+        </item>'''
+
+    MUTE = b'''<?xml version="1.0" encoding="utf-8" ?>
+        <item><Mute><value>on</value></Mute></item>'''
+
+    def test_reads_from_state(self):
+        '''Reads are served from the state of the last statuses'''
+        receiver = avreceiver.AVReceiver(conf_mock)
+        mock = receiver.connection.get = MagicMock(return_value=TestAVReceiverState.STATUS)
+
+        self.assertEqual(receiver.get_volume(), (25, False))
+        self.assertEqual(receiver.get_mute(), False)
+        self.assertEqual(receiver.get_power(), True)
+        mock.assert_called_once()
+
+        # the response to a command updates the state
+        mock.return_value = TestAVReceiverState.MUTE
+        receiver.set_mute(True)
+        self.assertEqual(receiver.get_volume(), (25, True))
+        self.assertEqual(mock.call_count, 2)
+
+    def test_stale_state(self):
+        '''Without max age, the receiver is always asked'''
+        receiver = avreceiver.AVReceiver(dict(conf_mock, statusMaxAge=0))
+        mock = receiver.connection.get = MagicMock(return_value=TestAVReceiverState.STATUS)
+
+        receiver.get_volume()
+        receiver.get_volume()
+        self.assertEqual(mock.call_count, 2)
+
+    def test_concurrent_reads(self):
+        '''Status reads queued at the same time are sent once'''
+        receiver = avreceiver.AVReceiver(dict(conf_mock, statusMaxAge=0))
+        blocker = threading.Event()
+        receiver.connection.get = MagicMock(side_effect=lambda *_: blocker.wait() and TestAVReceiverState.MUTE)
+        mock = MagicMock(return_value=TestAVReceiverState.STATUS)
+
+        # the first command holds the queue while the reads are queued
+        mute = threading.Thread(target=receiver.set_mute, args=[True])
+        mute.start()
+        while not receiver.connection.get.called:
+            time.sleep(0.001)
+        receiver.connection.get = mock
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(receiver.get_volume()))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while len(receiver.commands) < 1:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        blocker.set()
+        for thread in threads + [mute]:
+            thread.join()
+
+        mock.assert_called_once_with('formMainZone_MainZoneXmlStatus.xml', 5)
+        self.assertEqual(results, [(25, False)] * 3)
+
+
+class TestStatusPoller(unittest.TestCase):
+    def receiver(self, **conf) -> avreceiver.AVReceiver:
+        receiver = avreceiver.AVReceiver(dict(conf_mock, statusMaxAge=0, **conf))
+        self.addCleanup(receiver.stop)
+        return receiver
+
+    def wait_polls(self, poller: avreceiver.StatusPoller, polls: int):
+        deadline = time.monotonic() + 2
+        while poller.polls < polls and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertGreaterEqual(poller.polls, polls)
+
+    def test_disabled(self):
+        '''The receiver is not polled by default'''
+        receiver = self.receiver()
+        receiver.start()
+        self.assertFalse(receiver.poller.running)
+        self.assertEqual(receiver.poller.max_age(), 0)
+
+    def test_interval(self):
+        '''Polls are fast when the receiver is on the desired input or was recently used'''
+        receiver = self.receiver(pollInterval=1, pollStandbyInterval=30, pollRecentWindow=60)
+        poller = receiver.poller
+        self.assertEqual(poller.interval(), 30)
+
+        receiver.state.update(MockStatus(power=True, inp='NET'))
+        self.assertEqual(poller.interval(), 30)
+        receiver.state.update(MockStatus(power=True, inp=conf_mock['desiredInput']))
+        self.assertEqual(poller.interval(), 1)
+
+        receiver.state.update(MockStatus(power=False))
+        poller.touch()
+        self.assertEqual(poller.interval(), 1)
+        with patch('avreceiver.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(poller.interval(), 30)
+
+    def test_reads_from_poll(self):
+        '''While polling, reads are served from the polled state'''
+        receiver = self.receiver(pollInterval=0.02)
+        mock = receiver.connection.get = MagicMock(return_value=TestAVReceiverState.STATUS)
+        receiver.start()
+        self.wait_polls(receiver.poller, 2)
+
+        calls = mock.call_count
+        self.assertEqual(receiver.get_volume(), (25, False))
+        self.assertEqual(receiver.get_power(), True)
+        self.assertLessEqual(mock.call_count, calls + 1)
+        mock.assert_called_with('formMainZone_MainZoneXmlStatus.xml', 5)
+
+        receiver.stop()
+        self.assertFalse(receiver.poller.running)
+        calls = mock.call_count
+        time.sleep(0.05)
+        self.assertEqual(mock.call_count, calls)
+
+    def test_failure(self):
+        '''After a failure, the receiver is polled slowly and asked directly for reads'''
+        receiver = self.receiver(pollInterval=0.01, pollStandbyInterval=10)
+        receiver.connection.get = MagicMock(side_effect=OSError('unreachable'))
+        receiver.start()
+        self.wait_polls(receiver.poller, 1)
+        time.sleep(0.05)
+
+        self.assertEqual(receiver.poller.polls, 1)
+        self.assertEqual(receiver.poller.failures, 1)
+        self.assertEqual(receiver.poller.interval(), 10)
+        self.assertEqual(receiver.poller.max_age(), 0)
+
+        # a status received in the mean time shows that the receiver is back
+        receiver.connection.get = MagicMock(return_value=TestAVReceiverState.STATUS)
+        receiver.get_volume()
+        self.assertFalse(receiver.poller.failing())
+        self.wait_polls(receiver.poller, 2)
+
+
+class TestTelnetAVReceiver(unittest.TestCase):
+    def setUp(self) -> None:
+        self.simulator = TelnetSimulator(power=True, input='NET', volume=45, mute=False)
+        self.addCleanup(self.simulator.shutdown)
+        self.receiver = avreceiver.create_receiver(dict(
+            conf_mock, backend='telnet', ip='localhost', telnetPort=self.simulator.port,
+            telnetCommandInterval=0, timeout=1))
+        self.addCleanup(self.receiver.stop)
+
+    def test_create(self):
+        '''The backend is chosen by the configuration'''
+        self.assertIsInstance(self.receiver, avreceiver.TelnetAVReceiver)
+        self.assertNotIsInstance(avreceiver.create_receiver(conf_mock), avreceiver.TelnetAVReceiver)
+        # none of the web interface
+        self.assertNotIsInstance(self.receiver, avreceiver.AVReceiver)
+        self.assertFalse(hasattr(self.receiver, 'commands'))
+        with self.assertRaises(ValueError):
+            avreceiver.create_receiver(dict(conf_mock, backend='serial'))
+
+    def test_volume_transform(self):
+        '''Volume translation from and to the protocol'''
+        self.assertEqual(avreceiver.TelnetAVReceiver._telnet_to_db('45'), -35)
+        self.assertEqual(avreceiver.TelnetAVReceiver._telnet_to_db('455'), -34.5)
+        self.assertEqual(avreceiver.TelnetAVReceiver._telnet_to_db('05'), -75)
+        self.assertEqual(avreceiver.TelnetAVReceiver._db_to_telnet(-35.0), '45')
+        self.assertEqual(avreceiver.TelnetAVReceiver._db_to_telnet(-34.5), '455')
+        self.assertEqual(avreceiver.TelnetAVReceiver._db_to_telnet(-75.0), '05')
+
+    def test_reads(self):
+        '''Reads are served from the pushed state'''
+        self.assertEqual(self.receiver.get_volume(), (75, False))
+        self.assertEqual(self.receiver.get_power(), False)
+        self.simulator.push('MV60', 'MUON')
+        deadline = time.monotonic() + 1
+        while self.receiver.get_volume() != (100, True) and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(self.receiver.get_volume(), (100, True))
+        # only the queries sent on connection
+        self.assertEqual(self.simulator.commands, ['PW?', 'SI?', 'MV?', 'MU?'])
+
+    def test_commands(self):
+        '''Commands return the state they result in'''
+        self.assertEqual(self.receiver.set_volume(25), 25)
+        self.assertEqual(self.simulator.volume, 15)
+        self.assertEqual(self.receiver.set_mute(True), True)
+        self.assertEqual(self.receiver.incr_volume(True), 26)
+        self.assertEqual(self.simulator.volume, 16)
+        self.assertEqual(self.simulator.commands[-3:], ['MV15', 'MUON', 'MV16'])
+
+    def test_power(self):
+        '''The input is set once the receiver accepts it'''
+        self.simulator.power = False
+        self.simulator.input_delay = 0.1
+        self.receiver.power.min_delay = 0.02
+        self.assertEqual(self.receiver.set_power(True, timeout=2), True)
+        self.assertEqual(self.simulator.input, conf_mock['desiredInput'])
+        self.assertEqual(self.receiver.get_power(), True)
+
+        self.assertEqual(self.receiver.set_power(False, timeout=2), False)
+        self.assertEqual(self.simulator.power, False)
+        self.assertEqual(self.receiver.get_power(), False)
+
+    def test_standby(self):
+        '''In standby, the volume is unknown'''
+        self.simulator.power = False
+        self.receiver.start()
+        deadline = time.monotonic() + 1
+        while self.receiver.state.get(('power', 'mute'), 10) is None and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.receiver.state.invalidate('volume', 'mute')
+        self.assertEqual(self.receiver.get_volume(), (0, False))
+
+    def test_reconnect(self):
+        '''The state is forgotten when the session is lost, then received again'''
+        self.receiver.get_volume()
+        self.simulator.disconnect()
+        self.simulator.volume = 30
+        deadline = time.monotonic() + 2
+        while self.receiver.get_volume() != (50, False) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.receiver.get_volume(), (50, False))
+
+
+    def test_zone(self):
+        '''The other zones use their own commands and ignore the events of the main zone'''
+        self.simulator.zones[2].update(power=True, input=conf_mock['desiredInput'], volume=30)
+        receiver = avreceiver.create_receiver(dict(
+            conf_mock, backend='telnet', ip='localhost', telnetPort=self.simulator.port,
+            telnetCommandInterval=0, timeout=1, zone=2))
+        self.addCleanup(receiver.stop)
+
+        self.assertEqual(receiver.get_power(), True)
+        self.assertEqual(receiver.get_volume(), (50, False))
+        self.assertEqual(receiver.set_volume(25), 25)
+        self.assertEqual(self.simulator.zones[2]['volume'], 15)
+        self.assertEqual(self.simulator.volume, 45)
+        self.assertEqual(receiver.set_mute(True), True)
+        self.assertEqual(receiver.set_power(False, timeout=2), False)
+        self.assertEqual(self.simulator.zones[2], dict(
+            power=False, input=conf_mock['desiredInput'], volume=15, mute=True))
+        self.assertEqual(self.simulator.power, True)
+
+
+class TestAVReceiverGroup(unittest.TestCase):
+    def create_group(self, policy: str = 'primary', delay: float = 0) -> avreceiver.AVReceiverGroup:
+        group = avreceiver.create_receiver(dict(conf_mock, policy=policy, members=[
+            {}, {'zone': 2, 'maxVolume': -50}]))
+        for member in group.members:
+            def set_volume(volume, member=member):
+                time.sleep(delay)
+                return volume
+            member.set_volume = MagicMock(side_effect=set_volume)
+            member.get_power = MagicMock(return_value=True)
+        return group
+
+    def test_create(self):
+        '''The members share the configuration of the group'''
+        group = avreceiver.create_receiver([{'ip': 'first'}, {'ip': 'second', 'maxVolume': -30}])
+        self.assertIsInstance(group, avreceiver.AVReceiverGroup)
+        self.assertEqual([m.name for m in group.members], ['receiver', 'receiver2'])
+        self.assertEqual([m.connection.host for m in group.members], ['first', 'second'])
+
+        group = self.create_group()
+        self.assertEqual([m.zone for m in group.members], [1, 2])
+        self.assertEqual([m.connection.host for m in group.members], ['the_host', 'the_host'])
+        self.assertEqual([m.max_volume for m in group.members], [-20, -50])
+        with self.assertRaises(ValueError):
+            avreceiver.create_receiver(dict(conf_mock, policy='some', members=[{}, {}]))
+
+    def test_fan_out(self):
+        '''The commands are sent to all the members at the same time'''
+        group = self.create_group(delay=0.2)
+        start = time.monotonic()
+        self.assertEqual(group.set_volume(30), 30)
+        self.assertLess(time.monotonic() - start, 0.35)
+        for member in group.members:
+            member.set_volume.assert_called_once_with(30)
+
+    def test_primary(self):
+        '''With the primary policy, only the first member matters'''
+        group = self.create_group()
+        group.members[1].set_volume.side_effect = TimeoutError()
+        self.assertEqual(group.set_volume(30), 30)
+        group.members[0].set_volume.side_effect = TimeoutError()
+        with self.assertRaises(TimeoutError):
+            group.set_volume(30)
+        # reads only ask the first member
+        group.members[1].get_power.return_value = False
+        self.assertEqual(group.get_power(), True)
+        group.members[1].get_power.assert_not_called()
+
+    def test_all(self):
+        '''With the all policy, every member must succeed'''
+        group = self.create_group('all')
+        group.members[1].get_power.return_value = False
+        self.assertEqual(group.get_power(), False)
+        group.members[1].set_volume.side_effect = TimeoutError()
+        with self.assertRaises(TimeoutError):
+            group.set_volume(30)
+
+    def test_any(self):
+        '''With the any policy, one member is enough'''
+        group = self.create_group('any')
+        group.members[0].get_power.return_value = False
+        self.assertEqual(group.get_power(), True)
+        group.members[0].set_volume.side_effect = TimeoutError()
+        self.assertEqual(group.set_volume(30), 30)
+        group.members[1].set_volume.side_effect = TimeoutError()
+        with self.assertRaises(TimeoutError):
+            group.set_volume(30)
+
+
+class TestVolumeAggregator(unittest.TestCase):
+    def test_burst(self):
+        '''Increments received during the window are applied at once'''
+        apply = MagicMock(return_value=42)
+        aggregator = avreceiver.VolumeAggregator(apply, 0.1)
+
+        results = []
+        threads = [threading.Thread(target=lambda d: results.append(aggregator.add(d)), args=[d])
+                   for d in [1, 1, 1, -1, 1]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        apply.assert_called_once_with(3)
+        self.assertEqual(results, [42] * 5)
+
+        # a new window starts afterwards
+        aggregator.add(-1)
+        apply.assert_called_with(-1)
+
+    def test_in_flight(self):
+        '''Without window, increments are applied right away, or gathered while a command runs'''
+        release = threading.Event()
+        started = threading.Event()
+
+        def apply(delta):
+            started.set()
+            release.wait()
+            return delta
+        aggregator = avreceiver.VolumeAggregator(MagicMock(side_effect=apply), 0)
+
+        results = []
+        threads = [threading.Thread(target=lambda d: results.append(aggregator.add(d)), args=[d])
+                   for d in [1, 1, 2, 3, 4]]
+        threads[0].start()
+        # the first increment is sent at once
+        self.assertTrue(started.wait(1))
+        for thread in threads[1:]:
+            thread.start()
+        while aggregator._pending is None or aggregator._pending.delta < 10:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(aggregator._apply.call_args_list, [call(1), call(10)])
+        self.assertEqual(sorted(results), [1, 10, 10, 10, 10])
+
+        start = time.monotonic()
+        aggregator.add(-1)
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_error(self):
+        '''All the callers of a window get the error'''
+        apply = MagicMock(side_effect=ValueError('failure'))
+        aggregator = avreceiver.VolumeAggregator(apply, 0.01)
+
+        with self.assertRaises(ValueError):
+            aggregator.add(1)
+
+    def test_receiver(self):
+        '''Increments of the receiver go through the aggregator'''
+        receiver = avreceiver.AVReceiver(dict(conf_mock, volumeWindow=0.05))
+        receiver._send_command = MagicMock()
+        receiver._send_command.side_effect = [
+            MockStatus(volume=-36), MockStatus(volume=-34)]
+
+        threads = [threading.Thread(target=receiver.incr_volume, args=[True])
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        receiver._send_command.assert_has_calls([
+            call('formMainZone_MainZoneXmlStatus.xml'),
+            call('formiPhoneAppVolume.xml?1+-34.0')
+        ])
+        self.assertEqual(receiver._send_command.call_count, 2)
+
+    def test_receiver_concurrent(self):
+        '''Without window, concurrent increments all move the volume, with few requests'''
+        receiver = avreceiver.AVReceiver(conf_mock)
+        volume = [-49.0]
+        requests = []
+
+        def get(command, timeout):
+            requests.append(command)
+            time.sleep(0.05)
+            if command.startswith('formiPhoneAppVolume.xml'):
+                volume[0] = float(command.rpartition('+')[2])
+            return ON_STATUS.replace(b'-70.0', bytes(str(volume[0]), 'ascii'))
+        receiver.connection.get = get
+
+        threads = [threading.Thread(target=receiver.incr_volume, args=[True]) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(volume[0], -39.0)
+        # the status, the first increment, then the others together
+        self.assertEqual(len(requests), 3)
@@ -0,0 +1,43 @@
+from kp import capture
+from kp.regression import benchmark
+import json
+import unittest
+
+
+class TestBenchmark(unittest.TestCase):
+    @staticmethod
+    def results(**values) -> dict:
+        result = {'requests': 100, 'errors': 0, 'throughput': 1000, 'p50': 0.002, 'p95': 0.005,
+                  'p99': 0.01, 'max': 0.02, 'cpuTime': 0.1, 'cpuPerRequest': 0.001, 'peakRss': 30000}
+        result.update(values)
+        return {'engines': {'threading': {'forward': result}}}
+
+    def test_compare(self):
+        '''Only changes for the worse beyond the threshold are regressions'''
+        baseline = TestBenchmark.results()
+        self.assertEqual(benchmark.compare(TestBenchmark.results(), baseline, 0.1), [])
+        self.assertEqual(benchmark.compare(
+            TestBenchmark.results(throughput=2000, p95=0.001), baseline, 0.1), [])
+        self.assertEqual(benchmark.compare(
+            TestBenchmark.results(throughput=950, p95=0.0054), baseline, 0.1), [])
+
+        regressions = benchmark.compare(
+            TestBenchmark.results(throughput=800, p95=0.006), baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('threading forward throughput'))
+        self.assertTrue(regressions[1].startswith('threading forward p95'))
+
+    def test_compare_missing(self):
+        '''Scenarios and metrics absent from the baseline are skipped'''
+        baseline = {'engines': {'asyncio': {'forward': {}}}}
+        self.assertEqual(benchmark.compare(TestBenchmark.results(), baseline, 0.1), [])
+        self.assertEqual(benchmark.compare(
+            TestBenchmark.results(cpuPerRequest=None), TestBenchmark.results(), 0.1), [])
+
+    def test_scenarios(self):
+        '''The scenarios give valid jrpc requests'''
+        for scenario in benchmark.SCENARIOS:
+            entries = scenario.entries(3)
+            self.assertEqual(len(entries), 3)
+            for entry in entries:
+                json.loads(capture.encode(entry))
@@ -0,0 +1,130 @@
+import asyncio
+from kp import breaker
+import unittest
+from unittest.mock import MagicMock, patch
+from urllib import error
+
+
+class TestAdaptiveTimeout(unittest.TestCase):
+    def test_adapt(self):
+        '''The timeout follows the latencies, within its bounds'''
+        timeout = breaker.AdaptiveTimeout(0.5, 5)
+        # not enough samples yet
+        for _ in range(7):
+            timeout.observe(0.1)
+        self.assertEqual(timeout.get(), 5)
+
+        timeout.observe(0.1)
+        self.assertEqual(timeout.get(), 0.5)
+
+        for _ in range(20):
+            timeout.observe(1)
+        self.assertGreater(timeout.get(), 1)
+        self.assertLessEqual(timeout.get(), 5)
+
+    def test_on_timeout(self):
+        '''Timeouts push the timeout up'''
+        timeout = breaker.AdaptiveTimeout(0.1, 5)
+        for _ in range(10):
+            timeout.observe(0.1)
+        before = timeout.get()
+        timeout.on_timeout(before)
+        self.assertGreater(timeout.get(), before)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    @patch('breaker.time.monotonic')
+    def test_transitions(self, monotonic_mock: MagicMock):
+        monotonic_mock.return_value = 100
+        circuit = breaker.CircuitBreaker('test', 2, 10)
+
+        circuit.record_failure()
+        self.assertTrue(circuit.allow())
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.CircuitBreaker.OPEN)
+        self.assertFalse(circuit.allow())
+
+        # a single trial once the reset timeout is elapsed
+        monotonic_mock.return_value = 110
+        self.assertTrue(circuit.allow())
+        self.assertEqual(circuit.state, breaker.CircuitBreaker.HALF_OPEN)
+        self.assertFalse(circuit.allow())
+
+        # the trial failed
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.CircuitBreaker.OPEN)
+        self.assertFalse(circuit.allow())
+
+        monotonic_mock.return_value = 120
+        self.assertTrue(circuit.allow())
+        circuit.record_success()
+        self.assertEqual(circuit.state, breaker.CircuitBreaker.CLOSED)
+        self.assertTrue(circuit.allow())
+
+    def test_disabled(self):
+        circuit = breaker.CircuitBreaker('test', 0, 10)
+        for _ in range(10):
+            circuit.record_failure()
+        self.assertTrue(circuit.allow())
+
+
+class TestBackendGuard(unittest.TestCase):
+    def test_call(self):
+        '''The function gets the timeout, its failures open the circuit'''
+        guard = breaker.BackendGuard('test', 0.5, 5, 2, 10, answers=(error.HTTPError,))
+        function = MagicMock(return_value='result')
+
+        self.assertEqual(guard.call(function, 'key'), 'result')
+        function.assert_called_once_with(5)
+
+        # the backend answered
+        function.side_effect = error.HTTPError('url', 500, 'error', {}, None)
+        for _ in range(3):
+            with self.assertRaises(error.HTTPError):
+                guard.call(function, 'key')
+        self.assertEqual(guard.breaker.state, breaker.CircuitBreaker.CLOSED)
+
+        function.side_effect = ConnectionRefusedError()
+        for _ in range(2):
+            with self.assertRaises(ConnectionRefusedError):
+                guard.call(function, 'key')
+        function.reset_mock()
+        with self.assertRaises(breaker.CircuitOpenError):
+            guard.call(function, 'key')
+        function.assert_not_called()
+
+    def test_unexpected_error(self):
+        '''An error which is neither a failure nor an answer leaves the circuit as it is'''
+        guard = breaker.BackendGuard('test', 0.5, 5, 2, 10)
+        with self.assertRaises(ConnectionRefusedError):
+            guard.call(MagicMock(side_effect=ConnectionRefusedError()), 'key')
+        with self.assertRaises(ValueError):
+            guard.call(MagicMock(side_effect=ValueError()), 'key')
+        with self.assertRaises(ConnectionRefusedError):
+            guard.call(MagicMock(side_effect=ConnectionRefusedError()), 'key')
+        self.assertEqual(guard.breaker.state, breaker.CircuitBreaker.OPEN)
+
+    def test_call_async(self):
+        '''Timeouts of a coroutine function open the circuit'''
+        guard = breaker.BackendGuard('test', 0.5, 5, 2, 10, failures=(OSError, asyncio.TimeoutError))
+
+        async def function(timeout: float):
+            raise asyncio.TimeoutError()
+
+        async def run():
+            for _ in range(2):
+                with self.assertRaises(asyncio.TimeoutError):
+                    await guard.call_async(function, 'key')
+            with self.assertRaises(breaker.CircuitOpenError):
+                await guard.call_async(function, 'key')
+
+        asyncio.run(run())
+        self.assertEqual(guard.breaker.state, breaker.CircuitBreaker.OPEN)
+        self.assertEqual(guard.timeout('key'), 5)
+
+    def test_timeouts_by_key(self):
+        guard = breaker.BackendGuard('test', 0.5, 5, 2, 10)
+        for _ in range(10):
+            guard.call(lambda timeout: None, 'fast')
+        self.assertEqual(guard.timeout('fast'), 0.5)
+        self.assertEqual(guard.timeout('slow'), 5)
@@ -0,0 +1,58 @@
+import json
+from kp import capture, log
+import os
+import tempfile
+import unittest
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'capture.jsonl')
+
+    def tearDown(self) -> None:
+        capture.Capture()
+        self.directory.cleanup()
+
+    def read(self) -> list:
+        return list(log.read_jsonl(self.path))
+
+    def test_disabled(self):
+        capture.Capture({'path': self.path}).record(b'{}', '127.0.0.1', 0.1, 200, 10)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_record(self):
+        '''Requests are written with their method, params and timings'''
+        capturer = capture.Capture({'enabled': True, 'path': self.path})
+        capturer.record(b'{"jsonrpc": "2.0", "id": 3, "method": "Player.GetItem", "params": {"a": 1}}',
+                        '127.0.0.1', 0.25, 200, 42)
+        capturer.record(b'[{"method": "Player.GetItem"}, {"id": 2, "method": "Input.Up"}]',
+                        '127.0.0.1', 0.5, 200, 12)
+        capturer.record(b'not json', '127.0.0.2', 0.1, 400, 0)
+
+        entries = self.read()
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[0]['method'], 'Player.GetItem')
+        self.assertEqual(entries[0]['params'], {'a': 1})
+        self.assertEqual(entries[0]['id'], 3)
+        self.assertEqual(entries[0]['client'], '127.0.0.1')
+        self.assertEqual(entries[0]['duration'], 0.25)
+        self.assertEqual(entries[0]['size'], 42)
+        self.assertEqual(entries[1]['batch'], [
+            {'method': 'Player.GetItem', 'params': None},
+            {'method': 'Input.Up', 'params': None, 'id': 2}])
+        self.assertEqual(entries[2]['text'], 'not json')
+        self.assertLessEqual(entries[0]['time'], entries[1]['time'] + 0.25)
+
+    def test_encode(self):
+        '''The captured requests are rebuilt as they were received'''
+        requests = [
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'Player.GetItem', 'params': {'a': 1}},
+            [{'jsonrpc': '2.0', 'method': 'Input.Up'}, {'jsonrpc': '2.0', 'id': 2, 'method': 'Input.Down'}],
+            [1, {'jsonrpc': '2.0', 'id': None, 'method': 'Input.Down'}],
+            'string'
+        ]
+        for request in requests:
+            entry = capture.describe(bytes(json.dumps(request), 'utf-8'))
+            self.assertEqual(json.loads(capture.encode(entry)), request)
+        self.assertEqual(capture.encode(capture.describe(b'not json')), b'not json')
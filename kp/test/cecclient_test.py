@@ -0,0 +1,68 @@
+from kp.cecclient import CECClient, CECError
+import os
+import signal
+import sys
+import time
+import unittest
+
+
+def fake_conf(**kwargs) -> dict:
+    conf = {
+        'binary': sys.executable,
+        'args': [os.path.join(os.path.dirname(__file__), 'fake_cec_client.py')],
+        'startTimeout': 5
+    }
+    conf.update(kwargs)
+    return conf
+
+
+class TestCECClient(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = CECClient(fake_conf())
+
+    def tearDown(self) -> None:
+        self.client.stop()
+
+    def test_session(self):
+        '''All the commands go through the same process'''
+        pid = self.client.pipe('pid', expect='pid:')
+        self.client.switch_off()
+        self.client.switch_on()
+        self.assertEqual(self.client.power_status(), 'standby')
+        self.assertEqual(self.client.pipe('pid', expect='pid:'), pid)
+        self.assertEqual(self.client.restarts, 0)
+
+    def test_timeout(self):
+        '''A command fails if the expected answer does not come in time'''
+        with self.assertRaises(CECError):
+            self.client.pipe('on 0', expect='never', timeout=0.1)
+        # the next commands are not affected
+        self.assertEqual(self.client.power_status(), 'standby')
+
+    def test_restart(self):
+        '''cec-client is restarted when it exits'''
+        pid = self.client.pipe('pid', expect='pid:')
+        with self.assertRaises(CECError):
+            self.client.pipe('crash', expect='never')
+        self.assertEqual(self.client.power_status(), 'standby')
+        self.assertNotEqual(self.client.pipe('pid', expect='pid:'), pid)
+        self.assertEqual(self.client.restarts, 1)
+
+    def test_eager_restart(self):
+        '''cec-client is restarted as soon as it exits, before the next command'''
+        pid = int(self.client.pipe('pid', expect='pid:').partition(':')[2])
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + 5
+        while self.client.restarts == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.client.restarts, 1)
+        self.assertNotEqual(int(self.client.pipe('pid', expect='pid:').partition(':')[2]), pid)
+
+    def test_missing_binary(self):
+        '''Commands fail if cec-client cannot be run'''
+        client = CECClient(fake_conf(binary='/does/not/exist'))
+        try:
+            with self.assertRaises(CECError):
+                client.switch_off()
+        finally:
+            client.stop()
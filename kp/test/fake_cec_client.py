@@ -0,0 +1,15 @@
+"""Stands for cec-client in the tests of CECClient"""
+import sys
+
+print('opening a connection to the CEC adapter...')
+print('waiting for input', flush=True)
+for line in sys.stdin:
+    cmd = line.strip()
+    if cmd == 'q':
+        break
+    elif cmd == 'crash':
+        sys.exit(1)
+    elif cmd == 'pow 0':
+        print('power status: standby', flush=True)
+    elif cmd == 'pid':
+        print('pid: {}'.format(__import__('os').getpid()), flush=True)
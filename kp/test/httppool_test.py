@@ -0,0 +1,170 @@
+import asyncio
+import http.server
+from kp import httppool, metrics
+import socket
+import threading
+import unittest
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        return
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.server.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PoolTestBase:
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.httpd = http.server.ThreadingHTTPServer(
+            ('localhost', 0), KeepAliveHandler)
+        cls.httpd.connections = set()
+        # closing connections on purpose makes the server complain
+        cls.httpd.handle_error = lambda *args: None
+        cls.url = 'http://localhost:{}/jsonrpc'.format(
+            cls.httpd.server_address[1])
+        cls.thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        cls.thread.join()
+
+    def setUp(self):
+        self.httpd.connections.clear()
+
+
+class TestHTTPConnectionPool(PoolTestBase, unittest.TestCase):
+    def test_reuse(self):
+        '''Connections are reused between requests'''
+        hits = metrics.UPSTREAM_POOL.collect().get(('hit',), [0])[0]
+        pool = httppool.HTTPConnectionPool(self.url)
+        for i in range(3):
+            code, payload, _ = pool.request(b'payload', {})
+            self.assertEqual(code, 200)
+            self.assertEqual(payload, b'payload')
+        pool.close()
+
+        self.assertEqual(len(self.httpd.connections), 1)
+        self.assertEqual(pool.stats.misses, 1)
+        self.assertEqual(pool.stats.hits, 2)
+        # also exposed in the metrics
+        self.assertEqual(metrics.UPSTREAM_POOL.collect()[('hit',)][0], hits + 2)
+
+    def test_no_pooling(self):
+        '''With a size of 0, connections are never reused'''
+        pool = httppool.HTTPConnectionPool(self.url, max_size=0)
+        pool.request(b'payload', {})
+        pool.request(b'payload', {})
+
+        self.assertEqual(len(self.httpd.connections), 2)
+        self.assertEqual(pool.stats.hits, 0)
+
+    def test_idle_eviction(self):
+        '''Connections idle for too long are not reused'''
+        pool = httppool.HTTPConnectionPool(self.url, idle_timeout=0)
+        pool.request(b'payload', {})
+        pool.request(b'payload', {})
+        pool.close()
+
+        self.assertEqual(pool.stats.evictions, 1)
+        self.assertEqual(len(self.httpd.connections), 2)
+
+    def test_stale_retry(self):
+        '''A connection closed while being used is retried if allowed'''
+        pool = httppool.HTTPConnectionPool(self.url)
+        pool.request(b'payload', {})
+        conn, _ = pool._idle[0]
+        # makes the stale connection look fine, to only be noticed once used
+        pool._is_stale = lambda *args: False
+        conn.sock.shutdown(socket.SHUT_RDWR)
+
+        with self.assertRaises(OSError):
+            pool.request(b'payload', {})
+
+        pool.request(b'payload', {})
+        pool._idle[0][0].sock.shutdown(socket.SHUT_RDWR)
+        code, payload, _ = pool.request(b'payload', {}, retry=True)
+        self.assertEqual(code, 200)
+        self.assertEqual(payload, b'payload')
+        self.assertEqual(pool.stats.retries, 1)
+        pool.close()
+
+
+    def test_stream(self):
+        '''Bodies can be read by pieces, the connection is reused once they are read'''
+        pool = httppool.HTTPConnectionPool(self.url, chunk_size=3)
+        code, body, _ = pool.open(b'payload', {})
+        self.assertEqual(code, 200)
+        self.assertEqual(body.length, 7)
+        self.assertEqual(list(body.chunks()), [b'pay', b'loa', b'd'])
+        pool.request(b'payload', {})
+        pool.close()
+
+        self.assertEqual(len(self.httpd.connections), 1)
+
+    def test_stream_closed(self):
+        '''A body closed before being read does not give its connection back'''
+        pool = httppool.HTTPConnectionPool(self.url, chunk_size=3)
+        _, body, _ = pool.open(b'payload', {})
+        next(body.chunks())
+        body.close()
+
+        self.assertEqual(len(pool._idle), 0)
+
+
+class TestAsyncHTTPConnectionPool(PoolTestBase, unittest.TestCase):
+    def test_reuse(self):
+        '''Connections are reused between requests'''
+        async def run():
+            pool = httppool.AsyncHTTPConnectionPool(self.url)
+            res = [await pool.request(b'payload', {}) for i in range(3)]
+            pool.close()
+            return pool, res
+
+        pool, res = asyncio.run(run())
+        self.assertEqual([r[:2] for r in res], [(200, b'payload')] * 3)
+        self.assertEqual(len(self.httpd.connections), 1)
+        self.assertEqual(pool.stats.hits, 2)
+
+    def test_stale_retry(self):
+        '''A connection closed by the server is retried if allowed'''
+        async def run():
+            pool = httppool.AsyncHTTPConnectionPool(self.url)
+            await pool.request(b'payload', {})
+            pool._is_stale = lambda *args: False
+            # server side closing, seen by the client once it tries to read
+            reader, _, _ = pool._idle[0]
+            reader.feed_eof()
+            res = await pool.request(b'payload', {}, retry=True)
+            pool.close()
+            return pool, res
+
+        pool, res = asyncio.run(run())
+        self.assertEqual(res[:2], (200, b'payload'))
+        self.assertEqual(pool.stats.retries, 1)
+
+    def test_stream(self):
+        '''Bodies can be read by pieces, the connection is reused once they are read'''
+        async def run():
+            pool = httppool.AsyncHTTPConnectionPool(self.url, chunk_size=3)
+            _, body, _ = await pool.open(b'payload', {})
+            chunks = [chunk async for chunk in body.chunks()]
+            await pool.request(b'payload', {})
+            pool.close()
+            return body, chunks
+
+        body, chunks = asyncio.run(run())
+        self.assertEqual(body.length, 7)
+        self.assertEqual(chunks, [b'pay', b'loa', b'd'])
+        self.assertEqual(len(self.httpd.connections), 1)
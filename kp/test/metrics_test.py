@@ -0,0 +1,87 @@
+from kp import metrics
+import threading
+import unittest
+from unittest.mock import patch
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_threads(self):
+        '''The values recorded by all the threads are merged, even after they ended'''
+        counter = metrics.Counter('test_total', 'Test counter', ('key',))
+
+        def record():
+            for _ in range(1000):
+                counter.inc('a')
+            counter.inc('b', amount=2)
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('a')
+
+        self.assertEqual(counter.collect(), {('a',): [4001], ('b',): [8]})
+        self.assertEqual(counter.expose(), [
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{key="a"} 4001',
+            'test_total{key="b"} 8'
+        ])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', ('key',), buckets=(0.1, 1))
+
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.1, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(2.5, 'a')
+
+        self.assertEqual(histogram.expose(), [
+            '# HELP test_seconds Test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{key="a",le="0.1"} 2',
+            'test_seconds_bucket{key="a",le="1"} 3',
+            'test_seconds_bucket{key="a",le="+Inf"} 4',
+            'test_seconds_sum{key="a"} 3.15',
+            'test_seconds_count{key="a"} 4'
+        ])
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('test_gauge', 'Test gauge')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.expose()[2], 'test_gauge 1')
+
+        gauge = metrics.Gauge('test_gauge', 'Test gauge', ('key',),
+                              function=lambda: {'a': 3, 'b': 4})
+        self.assertEqual(gauge.expose()[2:], ['test_gauge{key="a"} 3', 'test_gauge{key="b"} 4'])
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        registry.counter('test_total', 'Test "counter"', ('key',)).inc('quote"d\\')
+
+        self.assertEqual(registry.expose(), b'\n'.join([
+            b'# HELP test_total Test "counter"',
+            b'# TYPE test_total counter',
+            b'test_total{key="quote\\"d\\\\"} 1',
+            b''
+        ]))
+
+    def test_method_label(self):
+        self.assertEqual(metrics.method_label('Player.GetItem'), 'Player.GetItem')
+        self.assertEqual(metrics.method_label('random stuff'), 'other')
+        self.assertEqual(metrics.method_label(None), 'other')
+        self.assertEqual(metrics.method_label(['Player.GetItem']), 'other')
+        # not a namespace of Kodi
+        self.assertEqual(metrics.method_label('Random.Stuff'), 'other')
+
+    def test_method_label_bounded(self):
+        '''Past the limit, only the methods already labelled and the registered ones keep their label'''
+        with patch.object(metrics, '_method_labels', set()), patch.object(metrics, 'MAX_METHOD_LABELS', 2):
+            self.assertEqual(metrics.method_label('Player.GetItem'), 'Player.GetItem')
+            self.assertEqual(metrics.method_label('Player.Open'), 'Player.Open')
+            self.assertEqual(metrics.method_label('Player.Stop'), 'other')
+            self.assertEqual(metrics.method_label('Player.GetItem'), 'Player.GetItem')
+            metrics.register_method('Custom.Method')
+            self.assertEqual(metrics.method_label('Custom.Method'), 'Custom.Method')
@@ -0,0 +1,56 @@
+from kp.regression import microbench
+import unittest
+from unittest.mock import MagicMock, patch
+
+
+class TestMicrobench(unittest.TestCase):
+    def test_benchmarks(self):
+        '''Each benchmark runs against the current code'''
+        for name, benchmark in microbench.BENCHMARKS.items():
+            with self.subTest(name):
+                benchmark()()
+
+    def test_previous_overloaders(self):
+        '''The overloader of the fixtures also works as a provider getting no context, as registered
+        by the revisions before the request context'''
+        overloader = microbench._overloaders()['Application.GetProperties']
+        self.assertIs(overloader(MagicMock()), overloader)
+        self.assertEqual(overloader.overload_query({'properties': ['volume']})[0], 200)
+
+    def test_measure(self):
+        result = microbench.measure(lambda: [0] * 1000, min_time=0.001, repeat=2)
+        self.assertGreater(result['ns'], 0)
+        self.assertGreaterEqual(result['allocBytes'], 8000)
+
+    def test_unavailable(self):
+        '''Benchmarks of code missing from a revision are skipped, the others still run'''
+        def missing():
+            return microbench._import('kp.httputils', 'missing').missing
+        with patch.dict(microbench.BENCHMARKS, {'missing': missing}):
+            results = microbench.run(['missing', 'confbase.getattr'], min_time=0.001)
+        self.assertEqual(results['benchmarks']['missing'], {'skipped': 'no kp.httputils.missing'})
+        self.assertGreater(results['benchmarks']['confbase.getattr']['ns'], 0)
+        self.assertIn('skipped: no kp.httputils.missing', microbench.format_results(results))
+
+    def test_failing(self):
+        '''Benchmarks whose code does not give the expected result are reported as errors'''
+        def failing():
+            return microbench._dispatch({'jsonrpc': '2.0', 'id': 1, 'method': 'Player.Open'},
+                                        b'{"jsonrpc": "2.0", "id": 1, "error": {"code": -32601}}')
+        with patch.dict(microbench.BENCHMARKS, {'failing': failing}):
+            results = microbench.run(['failing'], min_time=0.001)
+        self.assertIn('AssertionError', results['benchmarks']['failing']['error'])
+
+    def test_compare(self):
+        base = {'benchmarks': {'a': {'ns': 100, 'allocBytes': 10}, 'b': {'ns': 100, 'allocBytes': 10},
+                               'c': {'error': 'AttributeError'}, 'e': {'skipped': 'no kp.httputils'}}}
+        head = {'benchmarks': {'a': {'ns': 105, 'allocBytes': 10}, 'b': {'ns': 120, 'allocBytes': 10},
+                               'c': {'ns': 100, 'allocBytes': 10}, 'd': {'ns': 100, 'allocBytes': 10},
+                               'e': {'ns': 100, 'allocBytes': 10}}}
+        lines = microbench.compare(base, head, 0.1)
+        self.assertEqual(len(lines), 6)
+        self.assertFalse(lines[1].endswith('REGRESSION'))
+        self.assertTrue(lines[2].endswith('REGRESSION'))
+        self.assertIn('AttributeError', lines[3])
+        self.assertIn('skipped: missing', lines[4])
+        self.assertIn('skipped: no kp.httputils', lines[5])
@@ -0,0 +1,80 @@
+import http.client
+from kp.regression import mock_server
+from kp.regression.mock_server import MockResponse, MockServer
+import threading
+import time
+import unittest
+
+
+class TestMockServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.mock = MockServer(0)
+        self.port = self.mock.httpd.server_address[1]
+
+    def tearDown(self) -> None:
+        self.mock.shutdown()
+
+    def post(self, timeout: float = 5) -> http.client.HTTPResponse:
+        conn = http.client.HTTPConnection('localhost', self.port, timeout=timeout)
+        self.addCleanup(conn.close)
+        conn.request('POST', '/jsonrpc', b'{}', {'content-length': '2'})
+        return conn.getresponse()
+
+    def test_concurrent(self):
+        '''Slow responses do not hold back the other requests'''
+        self.mock.add_mock('slow', MockResponse(responses=[(200, b'ok')], latency=0.3))
+        threads = [threading.Thread(target=lambda: self.post().read()) for _ in range(5)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(len(self.mock.queries), 5)
+
+    def test_latency_distribution(self):
+        '''Latencies are drawn from the distribution, the same ones for the same seed'''
+        uniform = mock_server.uniform_latency(0.1, 0.2, seed=3)
+        values = [uniform() for _ in range(100)]
+        self.assertTrue(all(0.1 <= v <= 0.2 for v in values))
+        again = mock_server.uniform_latency(0.1, 0.2, seed=3)
+        self.assertEqual(values, [again() for _ in range(100)])
+
+        lognormal = mock_server.lognormal_latency(0.05, seed=1)
+        values = sorted(lognormal() for _ in range(1001))
+        self.assertAlmostEqual(values[500], 0.05, delta=0.01)
+
+    def test_bandwidth(self):
+        '''The payload is throttled'''
+        self.mock.add_mock('slow', MockResponse(responses=[(200, b'x' * 5000)], bandwidth=20000))
+        start = time.monotonic()
+        self.assertEqual(len(self.post().read()), 5000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_faults(self):
+        '''Faults are scripted in the responses'''
+        self.mock.add_mock('flaky', MockResponse(responses=[
+            mock_server.RESET, mock_server.CLOSE, mock_server.hang(1), (200, b'ok')], cycle=False))
+
+        with self.assertRaises((ConnectionResetError, http.client.RemoteDisconnected)):
+            self.post()
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.post()
+        with self.assertRaises(TimeoutError):
+            self.post(timeout=0.2)
+        for _ in range(2):
+            self.assertEqual(self.post().read(), b'ok')
+
+    def test_keep_alive(self):
+        mock = MockServer(0, keep_alive=True)
+        try:
+            mock.add_mock('ok', MockResponse(responses=[(200, b'ok'), (204, b'')]))
+            conn = http.client.HTTPConnection('localhost', mock.httpd.server_address[1])
+            for expected in (b'ok', b'', b'ok'):
+                conn.request('POST', '/jsonrpc', b'{}')
+                self.assertEqual(conn.getresponse().read(), expected)
+            conn.close()
+        finally:
+            mock.shutdown()
@@ -0,0 +1,268 @@
+from kp.receiverio import CommandQueue, ReceiverConnection, TelnetSession
+from kp.regression import mock_server
+from kp.regression.mock_server import MockResponse, MockServer
+from kp.regression.telnet_simulator import TelnetSimulator
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from urllib import error
+
+
+class TestReceiverConnection(unittest.TestCase):
+    def start_mock(self, keep_alive: bool) -> ReceiverConnection:
+        mock = MockServer(0, keep_alive=keep_alive)
+        self.addCleanup(mock.shutdown)
+        self.mock = mock
+        connection = ReceiverConnection('localhost', mock.httpd.server_address[1])
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_keep_alive(self):
+        '''The connection is reused as long as the receiver keeps it open'''
+        connection = self.start_mock(True)
+        self.mock.add_mock('status', MockResponse(responses=[(200, b'a'), (200, b'b')]))
+
+        self.assertEqual(connection.get('status.xml', 1), b'a')
+        self.assertEqual(connection.get('status.xml?1+x', 1), b'b')
+        self.assertEqual(connection.opened, 1)
+        self.assertEqual([q.path for q in self.mock.queries], ['/goform/status.xml'] * 2)
+        self.assertEqual(self.mock.queries[1].payload, '1+x')
+
+    def test_closing_receiver(self):
+        '''A new connection is opened when the receiver closes them'''
+        connection = self.start_mock(False)
+        self.mock.add_mock('status', MockResponse(responses=[(200, b'a')]))
+
+        connection.get('status.xml', 1)
+        connection.get('status.xml', 1)
+        self.assertEqual(connection.opened, 2)
+
+    def test_reconnect(self):
+        '''A command sent on a connection closed by the receiver is sent again on a new one'''
+        connection = self.start_mock(True)
+        self.mock.add_mock('status', MockResponse(
+            responses=[(200, b'a'), mock_server.CLOSE, (200, b'b')], cycle=False))
+
+        connection.get('status.xml', 1)
+        self.assertEqual(connection.get('status.xml', 1), b'b')
+        self.assertEqual(connection.opened, 2)
+
+    def test_error(self):
+        '''Errors of the receiver are raised as HTTPError, the connection stays usable'''
+        connection = self.start_mock(True)
+        self.mock.add_mock('status', MockResponse(responses=[(500, b'error'), (200, b'a')]))
+
+        with self.assertRaises(error.HTTPError) as raised:
+            connection.get('status.xml', 1)
+        self.assertEqual(raised.exception.code, 500)
+        self.assertEqual(connection.get('status.xml', 1), b'a')
+        self.assertEqual(connection.opened, 1)
+
+
+class TestCommandQueue(unittest.TestCase):
+    def hold(self, queue: CommandQueue) -> threading.Event:
+        '''Keeps the worker busy until the returned event is set'''
+        blocker = threading.Event()
+        started = threading.Event()
+        queue.submit(lambda: started.set() or blocker.wait())
+        started.wait(1)
+        return blocker
+
+    def test_priority(self):
+        '''Commands run by priority, then in order'''
+        queue = CommandQueue('test')
+        blocker = self.hold(queue)
+        order = []
+        jobs = [queue.submit(lambda: order.append('poll'), CommandQueue.BACKGROUND),
+                queue.submit(lambda: order.append('status'), CommandQueue.STATUS),
+                queue.submit(lambda: order.append('volume'), CommandQueue.COMMAND),
+                queue.submit(lambda: order.append('mute'), CommandQueue.COMMAND)]
+        blocker.set()
+        for job in jobs:
+            self.assertTrue(job.done.wait(1))
+        self.assertEqual(order, ['volume', 'mute', 'status', 'poll'])
+
+    def test_deduplication(self):
+        '''Commands with the same key join the queued one, and raise its priority'''
+        queue = CommandQueue('test')
+        blocker = self.hold(queue)
+        function = MagicMock(return_value=42)
+        order = []
+        poll = queue.submit(function, CommandQueue.BACKGROUND, 'status')
+        queue.submit(lambda: order.append('command'), CommandQueue.STATUS)
+        status = queue.submit(MagicMock(), CommandQueue.COMMAND, 'status')
+        self.assertIs(status, poll)
+        self.assertEqual(len(queue), 2)
+        blocker.set()
+
+        self.assertEqual(queue.run(lambda: order.append('last'), CommandQueue.BACKGROUND), None)
+        function.assert_called_once()
+        self.assertEqual(status.result, 42)
+        self.assertEqual(order, ['command', 'last'])
+        # the running command can be queued again
+        self.assertIsNot(queue.submit(function, key='status'), poll)
+
+    def test_error(self):
+        '''The exception of a command is raised to its caller, the next ones still run'''
+        queue = CommandQueue('test')
+        with self.assertRaises(ValueError):
+            queue.run(MagicMock(side_effect=ValueError('failure')))
+        self.assertEqual(queue.run(lambda: 1), 1)
+
+    def test_nested(self):
+        '''A command can run another one'''
+        queue = CommandQueue('test')
+        self.assertEqual(queue.run(lambda: queue.run(lambda: 2) + 1), 3)
+
+    def test_idle(self):
+        '''The worker stops when there is nothing to do, and is started again when needed'''
+        on_idle = MagicMock()
+        queue = CommandQueue('test', 0.05, on_idle)
+        queue.run(lambda: None)
+        worker = queue._worker
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+        on_idle.assert_called_once()
+
+        self.assertEqual(queue.run(lambda: threading.current_thread().name), 'test')
+        self.assertIsNot(queue._worker, worker)
+
+    def test_single_thread(self):
+        '''Commands run one at a time, whatever the number of callers'''
+        queue = CommandQueue('test')
+        running = []
+        overlaps = []
+
+        def command():
+            running.append(1)
+            overlaps.append(len(running))
+            time.sleep(0.002)
+            running.pop()
+
+        threads = [threading.Thread(target=queue.run, args=[command]) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [1] * 10)
+
+
+class TestTelnetSession(unittest.TestCase):
+    def setUp(self) -> None:
+        self.simulator = TelnetSimulator(volume=45)
+        self.addCleanup(self.simulator.shutdown)
+        self.lines = []
+        self.session = TelnetSession('localhost', self.simulator.port, self.on_line, (('PW?', 'PW'),),
+                                     min_retry=0.01)
+        self.addCleanup(self.session.stop)
+
+    def on_line(self, line: str):
+        self.lines.append(line)
+        return None if line.startswith('MVMAX') else line[:2]
+
+    def wait_for(self, condition, timeout: float = 1):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(condition())
+
+    def test_command(self):
+        '''Commands wait for their answer, the greeting is sent on connection'''
+        self.assertTrue(self.session.command('MV50', 'MV', 1))
+        self.assertEqual(self.simulator.commands, ['PW?', 'MV50'])
+        self.assertIn('MV50', self.lines)
+        self.assertIn('PWSTANDBY', self.lines)
+        # no answer to an unknown command
+        self.assertFalse(self.session.command('XX1', 'XX', 0.05))
+
+    def test_pipelined(self):
+        '''Commands are sent without waiting for the answers of the previous ones'''
+        self.session.command('PW?', 'PW', 1)
+        self.simulator.latency = 0.05
+        start = time.monotonic()
+        tickets = [self.session.send('MV{}'.format(40 + i), 'MV') for i in range(5)]
+        self.assertLess(time.monotonic() - start, 0.05)
+        for ticket in tickets:
+            self.assertTrue(self.session.wait('MV', ticket, 1))
+        self.assertEqual([l for l in self.lines if l.startswith('MV4')],
+                         ['MV40', 'MV41', 'MV42', 'MV43', 'MV44'])
+
+    def test_ignored(self):
+        '''A command ignored by the receiver does not delay the answers of the next ones'''
+        # the input cannot be changed in standby
+        self.assertFalse(self.session.command('SIAUXB', 'SI', 0.05))
+        self.assertTrue(self.session.command('PWON', 'PW', 1))
+        start = time.monotonic()
+        self.assertTrue(self.session.command('SIAUXB', 'SI', 1))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_pushed(self):
+        '''Events sent by the receiver on its own are given to on_line'''
+        self.session.start()
+        self.wait_for(lambda: 'PWSTANDBY' in self.lines)
+        self.simulator.push('MV30')
+        self.wait_for(lambda: 'MV30' in self.lines)
+
+    def test_reconnect(self):
+        '''The session reconnects when the connection is lost'''
+        on_disconnect = MagicMock()
+        self.session.on_disconnect = on_disconnect
+        self.session.command('PW?', 'PW', 1)
+        self.simulator.disconnect()
+        self.wait_for(lambda: on_disconnect.called)
+        self.assertTrue(self.session.command('MU?', 'MU', 1))
+        self.assertEqual(self.session.opened, 2)
+        self.assertEqual(self.simulator.commands.count('PW?'), 3)
+
+        # the answers of the lines sent on the lost connection are not waited for
+        self.simulator.latency = 0.2
+        ticket = self.session.send('MV50', 'MV')
+        self.simulator.disconnect()
+        self.assertFalse(self.session.wait('MV', ticket, 1))
+        self.simulator.latency = 0
+        self.assertTrue(self.session.command('MV51', 'MV', 1))
+
+    def test_probe(self):
+        '''The receiver is probed when quiet, the connection is kept as long as it answers'''
+        self.session.probe = ('PW?', 'PW')
+        self.session.probe_interval = 0.05
+        self.session.command('PW?', 'PW', 1)
+        self.wait_for(lambda: self.simulator.commands.count('PW?') >= 4)
+        self.assertEqual(self.session.opened, 1)
+        # the answers of the probes do not answer the next queries
+        self.assertTrue(self.session.command('PW?', 'PW', 1))
+
+    def test_dead_peer(self):
+        '''A connection on which nothing comes back, even to the probe, is dropped'''
+        with socket.socket() as server:
+            server.bind(('localhost', 0))
+            server.listen()
+            on_disconnect = MagicMock()
+            session = TelnetSession('localhost', server.getsockname()[1], self.on_line,
+                                    on_disconnect=on_disconnect, probe=('PW?', 'PW'),
+                                    probe_interval=0.05)
+            self.addCleanup(session.stop)
+            session.start()
+            peer, _ = server.accept()
+            self.addCleanup(peer.close)
+            peer.settimeout(1)
+            # no greeting: the first line is the probe
+            self.assertEqual(peer.recv(16), b'PW?\r')
+            self.assertEqual(peer.recv(16), b'')
+            self.wait_for(lambda: on_disconnect.called)
+
+    def test_unreachable(self):
+        '''Commands fail when the receiver cannot be reached'''
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        session = TelnetSession('localhost', port, self.on_line, min_retry=0.01)
+        self.addCleanup(session.stop)
+        with self.assertRaises(TimeoutError):
+            session.command('PW?', 'PW', 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+from kp import replay
+from kp.regression.mock_server import MockResponse, MockServer
+import time
+import unittest
+
+
+class TestReplay(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.mock = MockServer(0)
+        cls.url = 'http://localhost:{}/jsonrpc'.format(cls.mock.httpd.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.mock.shutdown()
+
+    def setUp(self) -> None:
+        self.mock.reset_mocks()
+        self.mock.add_mock('ok', MockResponse(responses=[(200, b'{"result": "OK"}')]))
+
+    def entries(self, count: int, interval: float) -> list:
+        return [{'time': 100 + i * interval, 'method': 'Player.GetItem', 'params': {}, 'id': i}
+                for i in range(count)]
+
+    def test_replay(self):
+        '''All the requests are sent and measured'''
+        entries = self.entries(20, 0.01)
+        entries.append({'time': 99, 'batch': [{'method': 'Input.Up', 'params': None, 'id': 1}]})
+
+        report = replay.replay(entries, self.url, speed=0, concurrency=4)
+
+        self.assertEqual(report.count, 21)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(report.codes, {'200': 21})
+        self.assertEqual(len(self.mock.queries), 21)
+        batches = [json.loads(q.payload) for q in self.mock.queries if q.payload.startswith('[')]
+        self.assertEqual(batches, [[{'jsonrpc': '2.0', 'id': 1, 'method': 'Input.Up'}]])
+        result = report.as_dict()
+        self.assertEqual(result['methods']['Player.GetItem']['count'], 20)
+        self.assertGreater(result['throughput'], 0)
+        self.assertLessEqual(result['latency']['p50'], result['latency']['p99'])
+
+    def test_speed(self):
+        '''The delays between the requests are scaled by the speed'''
+        start = time.perf_counter()
+        report = replay.replay(self.entries(3, 0.2), self.url, speed=2, concurrency=1)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        self.assertEqual(report.count, 3)
+
+    def test_errors(self):
+        '''Requests that get no answer are counted as errors'''
+        report = replay.replay(self.entries(2, 0), 'http://localhost:1/jsonrpc', speed=0)
+        self.assertEqual(report.errors, 2)
+        self.assertEqual(report.codes, {'error': 2})
@@ -1,6 +1,9 @@
 from kp import log, server
+import http.client
+import socket
 import threading
 from typing import Tuple
+import time
 import unittest
 from unittest.mock import ANY, MagicMock
 from urllib import error, request
@@ -16,7 +19,8 @@ class TestServer(unittest.TestCase):
         cls.jrpc_mock = MagicMock()
         cls.server = server.KodiProxyServer({
             'ip': '0.0.0.0',
-            'port': 43210
+            'port': 43210,
+            'maxKeepAliveRequests': 3
         }, cls.jrpc_mock)
         cls.thread = threading.Thread(
             target=serve, args=[cls.server])
@@ -84,3 +88,98 @@ class TestServer(unittest.TestCase):
         self.jrpc_mock.get_handler.assert_called_once_with(
             b'jrpc%3Dpayload', ANY)
         handler.dispatch.assert_called_once()
+
+    def test_metrics(self) -> None:
+        handler = MagicMock()
+        handler.method = 'Test.Method'
+        handler.route = 'overloaded'
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch.return_value = (200, b'handler_response', {})
+        self.open('jsonrpc', data=b'payload')
+
+        # the request is recorded once its response is sent
+        for _ in range(100):
+            code, payload, headers = self.open('metrics')
+            if b'Test.Method' in payload:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(code, 200)
+        self.assertTrue(headers['content-type'].startswith('text/plain'))
+        self.assertIn(
+            b'kodiproxy_requests_total{method="Test.Method",route="overloaded",code="200"}', payload)
+        self.assertIn(
+            b'kodiproxy_request_duration_seconds_count{method="Test.Method",route="overloaded"}', payload)
+
+    def test_keep_alive(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch.return_value = (200, b'handler_response', {'transfer-encoding': 'chunked'})
+        conn = http.client.HTTPConnection('0.0.0.0', 43210)
+        try:
+            conn.request('GET', '/invalid')
+            res = conn.getresponse()
+            self.assertEqual(res.status, 404)
+            res.read()
+            sock = conn.sock
+
+            # the error did not close the connection
+            conn.request('POST', '/jsonrpc', body=b'payload')
+            res = conn.getresponse()
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.getheader('content-length'), '16')
+            self.assertIsNone(res.getheader('transfer-encoding'))
+            self.assertEqual(res.read(), b'handler_response')
+            self.assertIs(conn.sock, sock)
+
+            # the maximum number of requests is reached
+            conn.request('POST', '/jsonrpc', body=b'payload')
+            res = conn.getresponse()
+            self.assertEqual(res.getheader('connection'), 'close')
+            self.assertEqual(res.read(), b'handler_response')
+        finally:
+            conn.close()
+
+    def test_pipelining(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        handler.dispatch.return_value = (200, b'handler_response', {'transfer-encoding': 'chunked'})
+        request = b'POST /jsonrpc HTTP/1.1\r\nContent-Length: 7\r\n\r\npayload'
+        with socket.create_connection(('0.0.0.0', 43210)) as sock:
+            sock.sendall(request + request)
+            sock.shutdown(socket.SHUT_WR)
+            data = b''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data.count(b'handler_response'), 2)
+
+    def test_length_required(self) -> None:
+        with socket.create_connection(('0.0.0.0', 43210)) as sock:
+            sock.sendall(b'POST /jsonrpc HTTP/1.1\r\n\r\n')
+            self.assertTrue(sock.recv(4096).startswith(b'HTTP/1.1 411'))
+
+    def test_stream(self) -> None:
+        handler = MagicMock()
+        self.jrpc_mock.get_handler.return_value = handler
+        payload = MagicMock()
+        payload.length = None
+        payload.chunks.return_value = iter([b'first', b'second'])
+        handler.dispatch.return_value = (200, payload, {})
+        conn = http.client.HTTPConnection('0.0.0.0', 43210)
+        try:
+            conn.request('POST', '/jsonrpc', body=b'payload')
+            res = conn.getresponse()
+            # without length, the body is chunked
+            self.assertEqual(res.getheader('transfer-encoding'), 'chunked')
+            self.assertEqual(res.read(), b'firstsecond')
+        finally:
+            conn.close()
+        # the body is closed once the last chunk is sent, possibly after the client received it
+        for _ in range(100):
+            if payload.close.called:
+                break
+            time.sleep(0.01)
+        payload.close.assert_called_once()
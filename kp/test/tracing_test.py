@@ -0,0 +1,80 @@
+import json
+from kp import log, tracing
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'traces.jsonl')
+
+    def tearDown(self) -> None:
+        tracing.Tracer()
+        self.directory.cleanup()
+
+    def read(self) -> list:
+        return list(log.read_jsonl(self.path))
+
+    def test_disabled(self):
+        '''Without a trace, stages are not recorded'''
+        tracer = tracing.Tracer()
+        self.assertIsNone(tracer.start())
+        with tracing.stage('stage'):
+            self.assertIsNone(tracing.current())
+
+    @patch('tracing.time.monotonic')
+    def test_slow(self, monotonic_mock):
+        '''Slow traces are always written, with their stages'''
+        tracer = tracing.Tracer({
+            'enabled': True, 'path': self.path, 'sampleRate': 0, 'slowThreshold': 1})
+        monotonic_mock.side_effect = [10, 10.5, 11, 11.2]
+        token = tracer.start()
+        with tracing.stage('forward'):
+            pass
+        tracer.finish(token, 'Player.GetItem', 'forwarded', 200)
+        self.assertIsNone(tracing.current())
+
+        traces = self.read()
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(traces[0]['method'], 'Player.GetItem')
+        self.assertEqual(traces[0]['duration'], 1.2)
+        self.assertEqual(traces[0]['stages'], [
+            {'name': 'forward', 'start': 0.5, 'duration': 0.5}])
+
+    def test_sampling(self):
+        '''Fast traces are only written if they are sampled'''
+        tracer = tracing.Tracer({
+            'enabled': True, 'path': self.path, 'sampleRate': 0, 'slowThreshold': 10})
+        tracer.finish(tracer.start(), 'Player.GetItem', 'forwarded', 200)
+        self.assertEqual(self.read(), [])
+
+        tracer.sample_rate = 1
+        tracer.finish(tracer.start(), 'Player.GetItem', 'forwarded', 200)
+        self.assertEqual(len(self.read()), 1)
+
+    def test_summarize(self):
+        traces = [{
+            'id': i, 'method': 'Application.SetVolume', 'route': 'overloaded', 'code': 200,
+            'duration': i / 10, 'stages': [{'name': 'receiver:volume', 'start': 0, 'duration': i / 20}]
+        } for i in range(1, 5)]
+        with open(self.path, 'w') as output:
+            output.write('\n'.join(map(json.dumps, traces)))
+
+        summary = tracing.summarize(log.read_jsonl(self.path), top=2).split('\n')
+
+        self.assertTrue(summary[1].startswith('Application.SetVolume (overloaded)'))
+        self.assertEqual(summary[1].split()[2:], ['4', '200.0', '400.0', '400.0', '1.000'])
+        self.assertTrue(summary[4].startswith('receiver'))
+        # the 2 slowest requests
+        self.assertEqual(len(summary), 9)
+        self.assertIn('#4', summary[7])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(tracing.percentile(values, 50), 50)
+        self.assertEqual(tracing.percentile(values, 99), 99)
+        self.assertEqual(tracing.percentile([3], 95), 3)
+        self.assertEqual(tracing.percentile([], 95), 0)
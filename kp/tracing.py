@@ -0,0 +1,161 @@
+import argparse
+import contextlib
+import contextvars
+import itertools
+from kp.confbase import KPConfBase
+from kp.log import JSONL_CONFIGURATION, JSONLWriter, read_jsonl
+import math
+import random
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar('kodiproxy_trace', default=None)
+
+
+class Trace:
+    """Timings of the stages of a request, relative to its start"""
+
+    def __init__(self, trace_id: int):
+        self.id = trace_id
+        self.start = time.monotonic()
+        self.stages: List[Dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            # list.append is atomic, stages can be recorded from several threads
+            self.stages.append({
+                'name': name,
+                'start': round(start - self.start, 6),
+                'duration': round(end - start, 6)
+            })
+
+
+def current() -> Optional[Trace]:
+    """Returns the trace of the request being handled, if it is traced"""
+    return _CURRENT.get()
+
+
+# nullcontext can be entered any number of times, a single one saves an allocation per stage
+_NO_STAGE = contextlib.nullcontext()
+
+
+def stage(name: str):
+    """Context manager recording a stage in the current trace, if any"""
+    trace = _CURRENT.get()
+    return trace.stage(name) if trace else _NO_STAGE
+
+
+class TraceConf:
+    _DEFAULT_CONFIGURATION = dict(
+        JSONL_CONFIGURATION, path='kodiproxy_traces.jsonl', sampleRate=0.01, slowThreshold=1)
+
+
+class Tracer:
+    """Creates the traces of the requests and writes the sampled and slow ones to a JSONL file"""
+
+    def __init__(self, conf=None):
+        conf = KPConfBase(TraceConf, conf)
+        self._writer = JSONLWriter('kodiproxy.traces', conf)
+        self.enabled = self._writer.enabled
+        self.sample_rate = conf.sampleRate
+        self.slow_threshold = conf.slowThreshold
+        self._ids = itertools.count(1)
+
+    def start(self) -> Optional[contextvars.Token]:
+        """Starts tracing the request handled in the current context"""
+        if not self.enabled:
+            return None
+        return _CURRENT.set(Trace(next(self._ids)))
+
+    def finish(self, token: Optional[contextvars.Token], method: str, route: str, code: int) -> None:
+        """Ends the trace started in the current context, and writes it if it is sampled or slow"""
+        if token is None:
+            return
+        trace = _CURRENT.get()
+        _CURRENT.reset(token)
+        duration = time.monotonic() - trace.start
+        if duration < self.slow_threshold and random.random() >= self.sample_rate:
+            return
+        self._writer.write({
+            'time': round(time.time(), 3),
+            'id': trace.id,
+            'method': str(method),
+            'route': str(route),
+            'code': code,
+            'duration': round(duration, 6),
+            'slow': duration >= self.slow_threshold,
+            'stages': trace.stages
+        })
+
+
+TRACER = Tracer()
+
+
+def config_tracer(conf) -> None:
+    """Configures the tracer used by the servers"""
+    global TRACER
+    TRACER = Tracer(conf)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Returns the q-th percentile (0-100) of sorted values, by the nearest rank method"""
+    if not values:
+        return 0.
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(traces: Iterable[dict], top: int = 10) -> str:
+    """Summary of the slowest methods and stages of the traces"""
+    by_method: Dict[str, List[float]] = dict()
+    by_stage: Dict[str, List[float]] = dict()
+    slowest = []
+    for trace in traces:
+        by_method.setdefault('{method} ({route})'.format(**trace), []).append(trace['duration'])
+        for trace_stage in trace['stages']:
+            # receiver:volume and receiver:status are the same stage
+            by_stage.setdefault(trace_stage['name'].partition(':')[0], []).append(
+                trace_stage['duration'])
+        slowest.append(trace)
+
+    def table(title: str, values: Dict[str, List[float]]) -> List[str]:
+        lines = ['{:<48} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+            title, 'count', 'p50 ms', 'p95 ms', 'max ms', 'total s')]
+        stats = []
+        for name, durations in values.items():
+            durations.sort()
+            stats.append((sum(durations), name, durations))
+        for total, name, durations in sorted(stats, reverse=True)[:top]:
+            lines.append('{:<48} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.3f}'.format(
+                name[:48], len(durations), percentile(durations, 50) * 1000,
+                percentile(durations, 95) * 1000, durations[-1] * 1000, total))
+        return lines
+
+    lines = table('method', by_method) + [''] + table('stage', by_stage) + ['', 'slowest requests']
+    for trace in sorted(slowest, key=lambda t: t['duration'], reverse=True)[:top]:
+        stages = ', '.join('{} {:.1f}'.format(s['name'], s['duration'] * 1000)
+                           for s in trace['stages'])
+        lines.append('{:>9.1f} ms  #{} {} ({}): {}'.format(
+            trace['duration'] * 1000, trace['id'], trace['method'], trace['route'], stages))
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Summarizes the slowest methods and stages of a trace file')
+    parser.add_argument('path', help='JSONL file written by the tracer')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of lines of each table')
+    args = parser.parse_args(argv)
+    print(summarize(read_jsonl(args.path), args.top))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())